@@ -0,0 +1,207 @@
+# Batch mode for the forest influence tool (secondtoolrefactored)
+# runs every block of a cutblock feature class through a pool of worker processes
+# each block gets its own folder and scratch geodatabase under <workspace>\blocks, so
+# blocks never share temp1.gdb and can run at the same time
+# results for all blocks go to one table (csv + geodatabase table in the workspace), and every block's
+# latest results are kept across batches in results.sqlite in the workspace (see resultstore),
+# the pdf report of each block is written to that block's folder (by the worker that ran it),
+# and forest_influence_summary.pdf in the workspace has the totals and a page for every block
+
+import arcpy
+import os, csv
+import multiprocessing
+import numpy as np
+import commonstuff as cs
+import secondtoolrefactored as fi
+import stagetrace as st
+import stagecache
+import summaryreport
+import resultstore
+
+block_field = "SubSettingName"
+scratch_gdb_name = "scratch.gdb"
+results_name = "forest_influence_results"
+results_gdb_name = "batch_results.gdb"
+summary_name = "forest_influence_summary.pdf"
+
+# report key -> results table field name and numpy type
+result_fields = [
+    ("Block ID", "Block_ID", "<U64"),
+    ("Block gross area", "Gross_Area", "<f8"),
+    ("Retention area", "Retention_Area", "<f8"),
+    ("Non merch/non forest area", "Non_Merch_Area", "<f8"),
+    ("Harvestable area", "Harvestable_Area", "<f8"),
+    ("Number of single trees", "Single_Trees", "<i4"),
+    ("Area of Forest Influence", "Forest_Influence_Area", "<f8"),
+    ("Percent harvestable area covered by Forest Influence", "Forest_Influence_Pct", "<f8"),
+    ("Status", "Status", "<U254"),
+]
+
+# Function to make a block id safe to use as a folder name
+def block_folder_name(block_id):
+    return fi.block_file_name(block_id)
+
+# Function to list the distinct block ids in the cutblock feature class
+def list_block_ids(cutblocks, block_field=block_field):
+    values = cs.read_columns(cutblocks, [block_field], null_value={block_field: ""})[block_field]
+    return list(dict.fromkeys(v for v in values.tolist() if v))
+
+# Function run in a worker - processes one block in its own folder and returns its report
+# job holds the inputs of run_batch plus block_id; block_field, single_trees_path, influence_engine,
+# keep_intermediates, static_areas, stage_cache and render_map (headless map, on by default) are optional (the worker daemon gets jobs like this too)
+def run_block(job):
+    block_id = job["block_id"]
+    block_workspace = os.path.join(job["workspace"], "blocks", block_folder_name(block_id))
+    if not os.path.exists(block_workspace):
+        os.makedirs(block_workspace)
+    # stage records of the block go to its folder and back to the parent with the report
+    st.start_run(block_workspace, "trace")
+    try:
+        # layer over all cutblocks with only this block selected, so the
+        # adjacent blocks can still be found by switching the selection
+        cutblock = arcpy.MakeFeatureLayer_management(job["cutblocks"], "batch_cutblock").getOutput(0)
+        where = arcpy.AddFieldDelimiters(job["cutblocks"], job.get("block_field", block_field)) + " = '" + block_id.replace("'", "''") + "'"
+        arcpy.SelectLayerByAttribute_management(cutblock, "NEW_SELECTION", where)
+        try:
+            report = fi.process_block(cutblock, job["retention_areas"], job["non_merch_areas"], job["tree_layer"], job["chm"],
+                                      job["adjacent_cutblocks"], block_workspace, scratch_gdb_name, job.get("single_trees_path", ""), block_id,
+                                      os.path.join(block_workspace, "forest_influence_map.png"),
+                                      os.path.join(block_workspace, "report.pdf"),
+                                      job.get("influence_engine", "POLYGON"), render_map=job.get("render_map", True),
+                                      keep_intermediates=job.get("keep_intermediates"), clear_scratch=True,
+                                      static_areas=job.get("static_areas"),
+                                      stage_cache=stagecache.StageCache(job["stage_cache"], worker=True) if job.get("stage_cache") else None)
+        finally:
+            arcpy.Delete_management(cutblock)
+        report["Status"] = "OK"
+    except Exception as e:
+        cs.writelog("Block " + str(block_id) + " failed: " + str(e))
+        report = {"Block ID": block_id, "Status": "Failed: " + str(e)}
+    report["Trace"] = st.finish_run()
+    return report
+
+# Function to write all block reports to one results table
+def write_results(reports, workspace):
+    results = np.zeros(len(reports), dtype=[(name, dtype) for key, name, dtype in result_fields])
+    for i, report in enumerate(reports):
+        for key, name, dtype in result_fields:
+            value = report.get(key)
+            if value is None:
+                value = np.nan if dtype == "<f8" else ("" if dtype.startswith("<U") else 0)
+            results[name][i] = int(value) if dtype == "<i4" else value
+
+    results_csv = os.path.join(workspace, results_name + ".csv")
+    with open(results_csv, "w", newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(results.dtype.names)
+        writer.writerows(results.tolist())
+
+    results_gdb = os.path.join(workspace, results_gdb_name)
+    if not arcpy.Exists(results_gdb):
+        arcpy.CreateFileGDB_management(workspace, results_gdb_name)
+    results_table = os.path.join(results_gdb, results_name)
+    cs.deletelyr(results_table)
+    arcpy.da.NumPyArrayToTable(results, results_table)
+
+    # a block that ran again replaces its row, a failed block only gets its new status
+    store = resultstore.ResultStore(os.path.join(workspace, resultstore.store_name))
+    run_id = store.start_run("forest_influence_batch", {"blocks": len(reports)})
+    store.upsert([dict((name, report[key]) for key, name, dtype in result_fields if report.get(key) is not None)
+                  for report in reports], run_id)
+    store.finish_run(run_id)
+    store.close()
+    cs.writelog("Batch results written to " + results_csv + ", " + results_table + " and " + store.path)
+    return results_table
+
+# Function to run every block in the cutblock feature class through a process pool
+# processes defaults to the number of cores
+# notify=True mails one digest with every block's status and the results csv when the batch is done
+def run_batch(cutblocks, retention_areas, non_merch_areas, tree_layer, chm, adjacent_cutblocks, workspace,
+              single_trees_path="", influence_engine="POLYGON", processes=None, block_field=block_field,
+              keep_intermediates=None, stage_cache_folder=None, notify=False):
+    block_ids = list_block_ids(cutblocks, block_field)
+    cs.writelog("Running " + str(len(block_ids)) + " blocks")
+
+    # retention and non merch per block in one pass over each layer, instead of once per block
+    retention_totals = fi.static_layer_totals(cutblocks, block_field, retention_areas)
+    non_merch_totals = fi.static_layer_totals(cutblocks, block_field, non_merch_areas)
+    jobs = [{
+        "block_id": block_id,
+        "block_field": block_field,
+        "cutblocks": cutblocks,
+        "retention_areas": retention_areas,
+        "non_merch_areas": non_merch_areas,
+        "tree_layer": tree_layer,
+        "chm": chm,
+        "adjacent_cutblocks": adjacent_cutblocks,
+        "workspace": workspace,
+        "single_trees_path": single_trees_path,
+        "influence_engine": influence_engine,
+        "keep_intermediates": keep_intermediates,
+        "stage_cache": stage_cache_folder,
+        "static_areas": {"retention": retention_totals.get(block_id, 0), "non_merch": non_merch_totals.get(block_id, 0)}
+    } for block_id in block_ids]
+
+    if stage_cache_folder:
+        # the shared gdb is made here, the workers each add entries to a gdb of their own
+        stagecache.StageCache(stage_cache_folder).prepare()
+    if notify:
+        cs.notification_queue().begin_digest("Forest influence batch: " + str(len(jobs)) + " blocks")
+    reports = []
+    if jobs:
+        cs.set_worker_executable()
+        pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(jobs)))
+        try:
+            for report in pool.imap_unordered(run_block, jobs):
+                reports.append(report)
+                cs.counter(len(jobs), len(reports))
+                if notify:
+                    cs.email("Block " + str(report["Block ID"]), report["Status"])
+        finally:
+            pool.close()
+            pool.join()
+
+    # same order as the blocks in the feature class
+    order = dict((block_id, i) for i, block_id in enumerate(block_ids))
+    reports.sort(key=lambda r: order[r["Block ID"]])
+    write_results(reports, workspace)
+    # the summary reuses the report images the workers made for the block pdfs
+    summary_pdf = os.path.join(workspace, summary_name)
+    try:
+        summaryreport.write_summary_pdf(reports, summary_pdf)
+    except Exception as e:
+        cs.writelog("No summary report: " + str(e))
+    if notify:
+        failed = len([r for r in reports if r["Status"] != "OK"])
+        cs.notification_queue().end_digest(str(len(reports) - failed) + " blocks processed, " + str(failed) + " failed",
+                                           {os.path.join(workspace, results_name + ".csv"): results_name + ".csv",
+                                            summary_pdf: summary_name})
+    if stage_cache_folder:
+        stagecache.StageCache(stage_cache_folder).evict()
+    st.write_records([record for report in reports for record in report.get("Trace", [])], os.path.join(workspace, "batch_trace"))
+    return reports
+
+def main():
+    cutblocks = arcpy.GetParameterAsText(0)
+    retention_areas = arcpy.GetParameterAsText(1)
+    non_merch_areas = arcpy.GetParameterAsText(2)
+    tree_layer = arcpy.GetParameterAsText(3)
+    chm = arcpy.GetParameterAsText(4)
+    adjacent_cutblocks = arcpy.GetParameterAsText(5)
+    workspace = arcpy.GetParameterAsText(6)
+    single_trees_path = arcpy.GetParameterAsText(7)  # Optional
+    influence_engine = arcpy.GetParameterAsText(8) or "POLYGON"  # Optional - POLYGON or RASTER
+    processes = arcpy.GetParameterAsText(9)  # Optional - defaults to the number of cores
+    keep_intermediates = arcpy.GetParameterAsText(10)  # Optional - intermediates to write to disk, ; separated or ALL
+    keep_intermediates = keep_intermediates if keep_intermediates in ("", "ALL") else keep_intermediates.split(";")
+    stage_cache_folder = arcpy.GetParameterAsText(11)  # Optional - folder to cache stage outputs in between runs
+    notify = arcpy.GetParameterAsText(12).lower() == "true"  # Optional - mail a digest of the batch
+
+    reports = run_batch(cutblocks, retention_areas, non_merch_areas, tree_layer, chm, adjacent_cutblocks, workspace,
+                        single_trees_path, influence_engine, int(processes) if processes else None,
+                        keep_intermediates=keep_intermediates, stage_cache_folder=stage_cache_folder or None, notify=notify)
+    failed = [r["Block ID"] for r in reports if r["Status"] != "OK"]
+    cs.writelog(str(len(reports) - len(failed)) + " blocks processed, " + str(len(failed)) + " failed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# Benchmark runner for the forest influence (secondtoolrefactored) and Immediate OM
+# (forestiinfluencetool) pipelines on synthetic data
+# builds a landscape with syntheticdata, runs both pipelines on the shapely geometry backend with
+# stage tracing on, and writes the stage records to <out>/<name>.json/.csv (see stagetrace)
+# a run can be compared with an earlier one to catch stages that got slower
+#
+#   python benchmark.py --blocks 100 --engine RASTER --out bench --name raster_100
+#   python benchmark.py --blocks 100 --out bench --name after --baseline bench/before.json
+#
+# The blocks go through the tool's own stage functions; their raster steps (CHM window, ring clip,
+# RasterToPoint, rasterizing the harvest area) run on the shapely backend's Grids. Only the map image
+# and the pdf are left out, so the numbers cover the geometry and array work.
+
+import os, sys, json, argparse
+import numpy as np
+import commonstuff as cs
+import geometrybackend as gb
+import stagetrace as st
+import syntheticdata as sd
+import landscapeindex as li
+from scratchstore import ScratchStore
+
+block_field = sd.block_field
+
+
+# Function to run the forest influence pipeline for every block of a synthetic landscape
+# the stages are the ones secondtoolrefactored.process_block runs, on the shapely backend
+# engine - POLYGON (points, buffers, dissolve) or RASTER (influenceraster), returns block id -> areas
+def bench_forest_influence(paths, chm_source, scratch, engine="POLYGON", cell_size=5, subdivide=5):
+    import secondtoolrefactored as fi
+    backend = gb.get_backend()
+    cutblocks = backend.read(paths["cutblocks"])
+    with st.stage("static_layer_totals", inputs=[paths["retention"], paths["non_merch"]]):
+        retention_totals = fi.static_layer_totals(paths["cutblocks"], block_field, paths["retention"])
+        non_merch_totals = fi.static_layer_totals(paths["cutblocks"], block_field, paths["non_merch"])
+    results = {}
+    for n, block_id in enumerate(cutblocks.attributes[block_field].tolist()):
+        st.set_block(block_id)
+        cutblock = backend.add("memory\\benchmark_cutblock", cutblocks.take(np.array([n])))
+        net_harvestable_area = fi.determine_net_harvestable_area(cutblock, paths["non_merch"], paths["retention"], scratch)
+        # the other blocks are the adjacent cutblocks, erased from the ring around this one
+        generalized_chm = fi.process_chm_or_trees(chm_source, cutblock, paths["cutblocks"], net_harvestable_area, scratch, None, cell_size)
+
+        if engine.upper() == "RASTER":
+            forest_influence_raster, influence_area = fi.calculate_forest_influence_raster(generalized_chm, net_harvestable_area, scratch,
+                                                                                           subdivide)
+            clipped_tree_height_buffers = None
+        else:
+            chm_points = fi.convert_chm_to_points(generalized_chm, scratch)
+            tree_height_buffers = fi.buffer_and_merge_points(chm_points, scratch)
+            clipped_tree_height_buffers = fi.clip_tree_height_buffers(tree_height_buffers, net_harvestable_area, scratch)
+
+        areas = fi.calculate_areas(cutblock, block_id, net_harvestable_area, clipped_tree_height_buffers, paths["retention"], paths["non_merch"],
+                                   static_areas={"retention": retention_totals.get(block_id, 0), "non_merch": non_merch_totals.get(block_id, 0)})
+        if clipped_tree_height_buffers is None:
+            areas["influence"] = influence_area
+        results[block_id] = areas
+        scratch.clear()
+    st.set_block(None)
+    return results
+
+# Function to run Immediate OM for every block, through the landscape index when index_folder is given
+def bench_immediate_om(paths, layers, scratch, index_folder=None):
+    import forestiinfluencetool as foi
+    landscape_index = None
+    if index_folder:
+        with st.stage("open_landscape_index"):
+            vri_path = sd.write_geojson(layers, index_folder, ["vri"])["vri"]
+            landscape_index = li.open_index(vri_path, ["PROJ_AGE", "BGC_ZONE", "BGC_SUBZONE"])
+    om = foi.immediate_om_per_block(paths["cutblocks"], paths["vri"], scratch, landscape_index=landscape_index)
+    scratch.clear()
+    return om
+
+# Function to generate a landscape and time both pipelines on it
+# the stage records go to <out>/<name>.json and .csv, returns the records
+# memory - track peak allocations per stage, off by default as tracemalloc slows the python stages down
+def run_benchmark(n_blocks, out, name="benchmark", seed=0, engine="POLYGON", immediate_om=True, use_index=False, memory=False):
+    gb.set_backend("shapely")
+    if not os.path.exists(out):
+        os.makedirs(out)
+    st.start_run(out, name, memory=memory)
+    try:
+        with st.stage("generate_landscape") as stage:
+            layers = sd.generate_landscape(n_blocks, seed)
+            stage.output(layers["vri"].geometries)
+        paths = sd.register(layers)
+        scratch = ScratchStore(out, "benchmark_scratch.gdb")
+        bench_forest_influence(paths, layers["chm"], scratch, engine)
+        if immediate_om:
+            bench_immediate_om(paths, layers, scratch, os.path.join(out, "landscape") if use_index else None)
+    finally:
+        records = st.finish_run()
+    # the settings go in with the records so runs are only compared like for like
+    with open(os.path.join(out, name + ".json"), "w") as f:
+        json.dump({"blocks": n_blocks, "seed": seed, "engine": engine, "index": use_index, "memory": memory, "records": records}, f,
+                  indent=2)
+    return records
+
+# Function to total the stage records of a run by stage
+def stage_totals(records):
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_mb": 0.0})
+        total["calls"] += 1
+        total["wall_s"] += record["wall_s"]
+        total["cpu_s"] += record["cpu_s"]
+        total["peak_mb"] = max(total["peak_mb"], record["peak_mb"] or 0.0)
+    return totals
+
+def read_run(path):
+    with open(path) as f:
+        run = json.load(f)
+    return run if isinstance(run, dict) else {"records": run}
+
+# Function to compare a run with a baseline run, stage by stage
+# a stage is a regression when its total wall time grew by more than tolerance (0.15 = 15 %)
+# and by more than min_seconds; returns the regressed stages
+def compare(baseline_path, current_path, tolerance=0.15, min_seconds=0.05):
+    baseline, current = read_run(baseline_path), read_run(current_path)
+    for setting in ("blocks", "seed", "engine", "index", "memory"):
+        if baseline.get(setting) != current.get(setting):
+            cs.writelog("Warning: runs differ in " + setting + " (" + str(baseline.get(setting)) + " vs " + str(current.get(setting)) + ")")
+    before, after = stage_totals(baseline["records"]), stage_totals(current["records"])
+    regressions = []
+    for stage in sorted(set(before) | set(after), key=lambda s: -after.get(s, {"wall_s": 0})["wall_s"]):
+        old, new = before.get(stage, {}).get("wall_s"), after.get(stage, {}).get("wall_s")
+        if old is None or new is None:
+            cs.writelog("{0:<32} {1}".format(stage, "only in the baseline" if new is None else "new stage"))
+            continue
+        change = (new - old) / old if old else 0.0
+        slower = change > tolerance and new - old > min_seconds
+        if slower:
+            regressions.append(stage)
+        cs.writelog("{0:<32} {1:9.3f}s -> {2:9.3f}s {3:+7.1%}{4}".format(stage, old, new, change, "  SLOWER" if slower else ""))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the forest influence and Immediate OM pipelines on synthetic data")
+    parser.add_argument("--blocks", type=int, default=25, help="number of cutblocks in the synthetic landscape")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default="POLYGON", choices=["POLYGON", "RASTER"])
+    parser.add_argument("--out", default="benchmark", help="folder for the results")
+    parser.add_argument("--name", default="benchmark", help="results go to <out>/<name>.json and .csv")
+    parser.add_argument("--no-immediate-om", action="store_true", help="only run the forest influence pipeline")
+    parser.add_argument("--index", action="store_true", help="run Immediate OM through the landscape index")
+    parser.add_argument("--memory", action="store_true", help="record peak memory per stage (slows the run down)")
+    parser.add_argument("--baseline", help="earlier <name>.json to compare with, exits with 1 when a stage got slower")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    run_benchmark(args.blocks, args.out, args.name, args.seed, args.engine, not args.no_immediate_om, args.index, args.memory)
+    if args.baseline:
+        regressions = compare(args.baseline, os.path.join(args.out, args.name + ".json"), args.tolerance)
+        if regressions:
+            cs.writelog("Slower stages: " + ", ".join(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# Windowed reader for the CHM raster
+# reads just the window a block needs (its bounding box plus a halo) as an array, instead of
+# running Clip_management on the full CHM and writing a new raster for every block
+#
+# The raster is read in fixed-size tiles and decoded tiles are kept in a memory-bounded
+# LRU cache. The cache is shared by every reader in the process by default, so neighbouring
+# blocks processed one after another in a batch (worker) reuse the tiles they share. Tiles of a
+# raster on disk are keyed on its modification time too, so a CHM that is replaced between runs
+# of a warm worker is read again (the old tiles drop out of the LRU).
+# Nodata comes back as 0 (no trees), the way the influence engine treats it.
+# read_resampled / block_reduce aggregate the window onto a coarser grid (the 5 m CHM) in
+# numpy, without writing and re-reading a raster for Resample_management.
+
+from collections import OrderedDict
+import math
+import numpy as np
+import commonstuff as cs
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+
+# LRU cache of decoded tiles, bounded by bytes
+class TileCache(object):
+
+    def __init__(self, max_mb=512):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Function to get a tile, reading it with loader() when it isn't cached
+    def get(self, key, loader):
+        if key in self.tiles:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        self.misses += 1
+        tile = loader()
+        if tile.nbytes <= self.max_bytes:
+            self.tiles[key] = tile
+            self.bytes += tile.nbytes
+            while self.bytes > self.max_bytes:
+                old_key, old_tile = self.tiles.popitem(last=False)
+                self.bytes -= old_tile.nbytes
+        return tile
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "tiles": len(self.tiles), "mb": self.bytes / 1048576.0,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+    def clear(self):
+        self.tiles.clear()
+        self.bytes = 0
+
+
+# cache used by readers that aren't given their own
+shared_cache = TileCache()
+
+
+# Raster on disk read through arcpy, one RasterToNumPyArray call per tile
+class ArcpyRasterSource(object):
+
+    def __init__(self, path):
+        raster = arcpy.Raster(path)
+        self.modified = cs.dataset_modified(raster.catalogPath)
+        self.key = (raster.catalogPath, self.modified)
+        self.xmin, self.ymax = raster.extent.XMin, raster.extent.YMax
+        self.cell_width, self.cell_height = raster.meanCellWidth, raster.meanCellHeight
+        self.nrows, self.ncols = raster.height, raster.width
+        self.spatial_reference = raster.spatialReference
+        # from the raster statistics, None when it has none
+        self.maximum = raster.maximum
+        self.raster = raster
+
+    def read(self, row, col, nrows, ncols):
+        lower_left = arcpy.Point(self.xmin + col * self.cell_width, self.ymax - (row + nrows) * self.cell_height)
+        return arcpy.RasterToNumPyArray(self.raster, lower_left, ncols, nrows, nodata_to_value=0).astype(np.float32)
+
+
+# Array (or memory-mapped .npy) with its top left corner and cell size, for rasters that are
+# already in memory and for running without arcpy
+class ArraySource(object):
+
+    def __init__(self, array, xmin, ymax, cell_size, key=None):
+        self.array = array
+        self.key = key if key is not None else id(array)
+        self.xmin, self.ymax = xmin, ymax
+        self.cell_width = self.cell_height = cell_size
+        self.nrows, self.ncols = array.shape
+        self.spatial_reference = None
+
+    def read(self, row, col, nrows, ncols):
+        tile = np.asarray(self.array[row:row + nrows, col:col + ncols], dtype=np.float32)
+        return np.nan_to_num(tile, nan=0.0)
+
+
+class WindowedRasterReader(object):
+
+    # source - a raster path or a source object like ArraySource
+    def __init__(self, source, tile_size=512, cache=None):
+        self.source = ArcpyRasterSource(source) if isinstance(source, str) else source
+        self.tile_size = tile_size
+        self.cache = cache if cache is not None else shared_cache
+
+    @property
+    def cell_size(self):
+        return self.source.cell_width
+
+    def tile(self, tile_row, tile_col):
+        source, size = self.source, self.tile_size
+        row, col = tile_row * size, tile_col * size
+        return self.cache.get((source.key, size, tile_row, tile_col),
+                              lambda: source.read(row, col, min(size, source.nrows - row), min(size, source.ncols - col)))
+
+    # Function to read the cells covering a box, snapped outwards to the raster grid
+    # returns the array and the (xmin, ymax) of its top left corner
+    def read_window(self, xmin, ymin, xmax, ymax):
+        row0, row1, col0, col1 = self.cell_range(xmin, ymin, xmax, ymax)
+        row0, col0 = max(row0, 0), max(col0, 0)
+        row1, col1 = min(row1, self.source.nrows), min(col1, self.source.ncols)
+        return self.read_cells(row0, row1, col0, col1), self.corner(row0, col0)
+
+    # Function to read a block's bounding box plus a halo (metres) around it
+    def read_block_window(self, bounds, halo=100):
+        xmin, ymin, xmax, ymax = bounds
+        return self.read_window(xmin - halo, ymin - halo, xmax + halo, ymax + halo)
+
+    # Function to read a box straight onto a coarser grid, factor x factor cells per output cell
+    # (e.g. factor 5 takes a 1 m CHM to 5 m), see block_reduce for the reducers
+    # the output grid lines up with the raster origin, so every block lands on the same grid,
+    # and the box is read one strip of tile rows at a time so only one strip is ever at full resolution
+    def read_resampled(self, xmin, ymin, xmax, ymax, factor, reducer="mean"):
+        row0, row1, col0, col1 = self.cell_range(xmin, ymin, xmax, ymax)
+        row0, col0 = (max(row0, 0) // factor) * factor, (max(col0, 0) // factor) * factor
+        row1 = min(-(-row1 // factor) * factor, -(-self.source.nrows // factor) * factor)
+        col1 = min(-(-col1 // factor) * factor, -(-self.source.ncols // factor) * factor)
+        out = np.zeros((max(row1 - row0, 0) // factor, max(col1 - col0, 0) // factor), dtype=np.float32)
+        strip = max(self.tile_size // factor, 1) * factor
+        for r in range(row0, row1, strip):
+            cells = self.read_cells(r, min(r + strip, row1), col0, col1)
+            out[(r - row0) // factor:(r - row0 + cells.shape[0]) // factor] = block_reduce(cells, factor, reducer)
+        return out, self.corner(row0, col0)
+
+    # Function to turn a box into a row/column range, snapped outwards, not limited to the raster
+    def cell_range(self, xmin, ymin, xmax, ymax):
+        source = self.source
+        col0 = int(math.floor((xmin - source.xmin) / source.cell_width))
+        col1 = int(math.ceil((xmax - source.xmin) / source.cell_width))
+        row0 = int(math.floor((source.ymax - ymax) / source.cell_height))
+        row1 = int(math.ceil((source.ymax - ymin) / source.cell_height))
+        return row0, row1, col0, col1
+
+    def corner(self, row, col):
+        return (self.source.xmin + col * self.source.cell_width, self.source.ymax - row * self.source.cell_height)
+
+    # Function to read a range of cells through the tile cache, cells off the raster come back as 0
+    def read_cells(self, row0, row1, col0, col1):
+        source, size = self.source, self.tile_size
+        window = np.zeros((max(row1 - row0, 0), max(col1 - col0, 0)), dtype=np.float32)
+        first_row, last_row = max(row0, 0), min(row1, source.nrows)
+        first_col, last_col = max(col0, 0), min(col1, source.ncols)
+        if first_row >= last_row or first_col >= last_col:
+            return window
+        for tile_row in range(first_row // size, (last_row - 1) // size + 1):
+            for tile_col in range(first_col // size, (last_col - 1) // size + 1):
+                tile = self.tile(tile_row, tile_col)
+                r0, c0 = tile_row * size, tile_col * size
+                r_start, r_end = max(first_row, r0), min(last_row, r0 + tile.shape[0])
+                c_start, c_end = max(first_col, c0), min(last_col, c0 + tile.shape[1])
+                window[r_start - row0:r_end - row0, c_start - col0:c_end - col0] = tile[r_start - r0:r_end - r0, c_start - c0:c_end - c0]
+        return window
+
+
+# Function to aggregate an array onto a grid factor times coarser
+# reducer - "mean", "max" or "bilinear"; bilinear gives what Resample_management BILINEAR gives
+# when the grids line up: the value at the centre of each coarse cell, interpolated from the
+# middle fine cell (odd factor) or the middle 2 x 2 fine cells (even factor)
+# rows and columns are padded with 0 up to a multiple of factor
+def block_reduce(array, factor, reducer="mean"):
+    nrows, ncols = -(-array.shape[0] // factor), -(-array.shape[1] // factor)
+    if array.shape != (nrows * factor, ncols * factor):
+        padded = np.zeros((nrows * factor, ncols * factor), dtype=array.dtype)
+        padded[:array.shape[0], :array.shape[1]] = array
+        array = padded
+    blocks = array.reshape(nrows, factor, ncols, factor)
+    reducer = reducer.lower()
+    if reducer == "mean":
+        return blocks.mean(axis=(1, 3), dtype=np.float64).astype(np.float32)
+    if reducer == "max":
+        return blocks.max(axis=(1, 3))
+    if reducer == "bilinear":
+        middle = slice((factor - 1) // 2, factor // 2 + 1)
+        return blocks[:, middle, :, middle].mean(axis=(1, 3), dtype=np.float64).astype(np.float32)
+    raise ValueError("Unknown reducer " + reducer + ", use mean, max or bilinear")
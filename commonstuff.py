@@ -7,17 +7,25 @@
 # First - common variables that are going to get called from other scripts
 
 
-import os, datetime, time,arcpy, math
+import os, datetime, time, math, atexit, itertools
+import multiprocessing
+try:
+    import queue
+except ImportError:  # Python 2.7 (ArcMap)
+    import Queue as queue
+try:
+    import arcpy
+except ImportError:  # the geometry backend can run the tools without arcpy
+    arcpy = None
 import numpy as np
-import pandas as pd
 import logging
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
 import logging.handlers
+# pandas, smtplib and the email modules are imported in the functions that use them,
+# so scripts that only need writelog don't pay for them at startup
 
 sender = "Forsite Portal <no-reply@forsite.ca>"
+mailhost = "forsite-ca.mail.protection.outlook.com"
+mailport = 25
 receiver = ['crobinson@forsite.ca']
 bcc =  ['crobinson@forsite.ca']
 myinputgdb = r"S:\329\32\03_MappingAnalysisData\02_Data\02_Processed_Data\Work_Data.gdb"
@@ -170,37 +178,19 @@ def getspatialreference():
 
 
 # assistance for adding a field to a feature class
+# (one field at a time - add_fields adds many in one go)
 def addfield(lyr, fld, fldtype, fldlen, scale):
-    if arcpy.Exists(lyr):
-        try:
-            if fldtype != "TEXT":
-                if scale == None:
-                    arcpy.AddField_management(lyr, fld, fldtype)
-                else:
-                    arcpy.AddField_management(lyr, fld, fldtype,"",scale)        
-            else:
-                arcpy.AddField_management(lyr, fld, fldtype,"","",fldlen)
-            writelog(lyr + " exists. Added " + fld)
-            return True
-        except Exception as error:
-            writelog('Exception occurred, ' + str(error))
-            return False
-    else:
-        return True
+    return add_fields(lyr, [(fld, fldtype, fldlen, scale)])
 
 # for writing to a collective log file
 # msg = item you want in the log file (string)
 # verbose  - when True - it will echo the message to the console as well (True/False)
+# writelog only puts the message on a queue, a background thread writes it out (see start_log),
+# so logging inside a loop doesn't stall it
 
 def writelog(msg, verbose=True):
-
-    filename = os.getcwd() + "\\" + logfilename
-    f = open(filename, "a")
-    f.write(time.strftime("%d/%m/%Y %H:%M:%S") + " " + msg + "\n")
-    arcpy.AddMessage(msg)
-    if verbose:
-        print(msg)
-    # f.close()
+    logger = start_log()
+    logger.info(msg, extra={"verbose": verbose})
 
 # a convenient counter to use - in 10% increments
 
@@ -209,6 +199,89 @@ def counter(numlines, currentline):
     if currentline % math.ceil(numlines/10) == 0:
         writelog(str(currentline/math.ceil(numlines/10)*10) + "% done")
 
+# background logger behind writelog
+# one queue per process, drained by a listener thread into one long lived log file handle
+# that is flushed every log_batch_size messages, whenever the queue is empty and on exit
+# worker processes write to their own logfile_<pid>.txt next to logfile.txt
+# Python 2.7 (ArcMap) has no QueueListener, there writelog writes the message itself like it used to
+log_batch_size = 50
+log_state = {"pid": None, "logger": None, "listener": None}
+
+# log file handler that only flushes every batch_size messages, or when the queue has run dry
+# so nothing sits in the buffer while the tool is busy elsewhere
+class BatchFileHandler(logging.FileHandler):
+
+    def __init__(self, filename, log_queue, batch_size):
+        logging.FileHandler.__init__(self, filename, "a", delay=True)
+        self.log_queue = log_queue
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def flush(self):
+        self.pending += 1
+        if self.pending >= self.batch_size or self.log_queue.empty():
+            logging.FileHandler.flush(self)
+            self.pending = 0
+
+# handler that echoes to arcpy and the console, like writelog always did
+class MessageHandler(logging.Handler):
+
+    def emit(self, record):
+        msg = record.getMessage()
+        if arcpy is not None:
+            arcpy.AddMessage(msg)
+        if getattr(record, "verbose", True):
+            print(msg)
+
+def log_file_path():
+    if multiprocessing.current_process().name == "MainProcess":
+        return os.path.join(os.getcwd(), logfilename)
+    name, ext = os.path.splitext(logfilename)
+    return os.path.join(os.getcwd(), name + "_" + str(os.getpid()) + ext)
+
+def start_log():
+    # a forked worker inherits the parent's logger but not its listener thread
+    if log_state["pid"] == os.getpid():
+        return log_state["logger"]
+    log_queue = queue.Queue()
+    file_handler = BatchFileHandler(log_file_path(), log_queue, log_batch_size)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%d/%m/%Y %H:%M:%S"))
+    logger = logging.getLogger("mosaictools." + str(os.getpid()))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if hasattr(logging.handlers, "QueueListener"):
+        listener = logging.handlers.QueueListener(log_queue, file_handler, MessageHandler())
+        listener.start()
+        logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    else:
+        listener = None
+        logger.handlers = [file_handler, MessageHandler()]
+    log_state.update(pid=os.getpid(), logger=logger, listener=listener)
+    return logger
+
+# Function to write out everything that is still queued, closes the log (writelog opens it again)
+def flushlog():
+    if log_state["pid"] != os.getpid():
+        return
+    listener = log_state["listener"]
+    handlers = log_state["logger"].handlers
+    if listener is not None:
+        listener.stop()
+        handlers = listener.handlers
+    for handler in handlers:
+        handler.close()
+    log_state.update(pid=None, logger=None, listener=None)
+
+atexit.register(flushlog)
+
+# Function to point worker processes at python.exe when running inside ArcGIS
+# (there sys.executable is the desktop application, not the interpreter)
+def set_worker_executable():
+    import sys
+    python_exe = os.path.join(sys.exec_prefix, "python.exe")
+    if not os.path.basename(sys.executable).lower().startswith("python") and os.path.exists(python_exe):
+        multiprocessing.set_executable(python_exe)
+
 # assitance for deleting layers
 
 def deletelyr(lyr):
@@ -226,73 +299,297 @@ def deletelyr(lyr):
 
 
 def deletefield(lyr, fld):
-    if arcpy.Exists(lyr):
-        try:
-            arcpy.DeleteField_management(lyr, fld)
-            writelog(lyr + " exists. Deleted " + fld)
-            return True
-        except Exception as e:
-            writelog('Exception occurred, ' + str(e.message))
-            return False
-    else:
-        return True
+    return delete_fields(lyr, [fld])
 
 # assistance for renaming fields
 
 def renamefield(lyr, fld, newfld):
-    if arcpy.Exists(lyr):
-        try:
+    return rename_fields(lyr, {fld: newfld})
+
+# schema cache - the fields of a dataset are listed once per modification time,
+# so checking whether a field is there doesn't go back to the geodatabase every time
+# in-memory datasets have no modification time and are always listed
+schema_cache = {}
+
+# latest modification time of a dataset on disk, None for in-memory data
+# a dataset in a file geodatabase goes by every file of the geodatabase except the lock files, so any
+# write to the geodatabase counts as a change (users of this that rebuild something expensive, like
+# the landscape index, check a content stamp before they do)
+def dataset_modified(catalog_path):
+    path = catalog_path
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return None
+        path = parent
+    if path.lower().endswith(".gdb") and path != catalog_path:
+        times = [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path) if not f.lower().endswith(".lock")]
+        return max(times) if times else None
+    if os.path.isdir(path):
+        return max([os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path) if not f.lower().endswith(".lock")] +
+                   [os.path.getmtime(path)])
+    if path.lower().endswith(".shp"):
+        stem = path[:-4]
+        return max(os.path.getmtime(stem + ext) for ext in (".shp", ".shx", ".dbf", ".prj", ".cpg") if os.path.exists(stem + ext))
+    return os.path.getmtime(path)
+
+# Function to get the fields of a dataset (arcpy Field objects), None when the dataset doesn't exist
+def dataset_fields(lyr):
+    catalog_path = dataset_catalog_path(lyr)
+    if catalog_path is None:
+        return None
+    modified = dataset_modified(catalog_path)
+    cached = schema_cache.get(catalog_path.lower())
+    if modified is not None and cached is not None and cached[0] == modified:
+        return cached[1]
+    # only a miss goes back to the geodatabase
+    if not arcpy.Exists(lyr):
+        return None
+    fields = arcpy.ListFields(lyr)
+    if modified is not None:
+        schema_cache[catalog_path.lower()] = (modified, fields)
+    return fields
+
+# Function to get the catalog path of a dataset, None when it can't be described
+# a path on disk (or inside a geodatabase) is its own catalog path, only layers and views are described
+def dataset_catalog_path(lyr):
+    path = str(lyr)
+    if os.path.exists(path) or any(part.lower().endswith(".gdb") for part in path.replace("\\", "/").split("/")[:-1]):
+        return path
+    try:
+        return arcpy.Describe(lyr).catalogPath
+    except Exception:
+        return None
+
+def forget_schema(lyr):
+    catalog_path = dataset_catalog_path(lyr)
+    if catalog_path is not None:
+        schema_cache.pop(catalog_path.lower(), None)
+
+# Function to add many fields with one schema change, fields already there are skipped
+# fields = list of (name, type, length, scale) like addfield takes; length is for TEXT fields
+# AddFields has no precision or scale (a file geodatabase ignores them anyway), so fields with a
+# scale go through AddField on their own
+def add_fields(lyr, fields):
+    existing = dataset_fields(lyr)
+    if existing is None:
+        return True
+    names = set(f.name.lower() for f in existing)
+    new_fields = [tuple(f) for f in fields if f[0].lower() not in names]
+    if not new_fields:
+        return True
+    try:
+        batched = [f for f in new_fields if f[1] == "TEXT" or f[3] is None]
+        if len(batched) > 1 and hasattr(arcpy.management, "AddFields"):
+            arcpy.management.AddFields(lyr, [[fld, fldtype, "", fldlen if fldtype == "TEXT" else ""] for fld, fldtype, fldlen, scale in batched])
+        else:
+            batched = []
+        for fld, fldtype, fldlen, scale in new_fields:
+            if (fld, fldtype, fldlen, scale) in batched:
+                continue
+            if fldtype != "TEXT":
+                if scale == None:
+                    arcpy.AddField_management(lyr, fld, fldtype)
+                else:
+                    arcpy.AddField_management(lyr, fld, fldtype,"",scale)
+            else:
+                arcpy.AddField_management(lyr, fld, fldtype,"","",fldlen)
+        writelog(lyr + " exists. Added " + ", ".join(f[0] for f in new_fields))
+        return True
+    except Exception as error:
+        writelog('Exception occurred, ' + str(error))
+        return False
+    finally:
+        forget_schema(lyr)
+
+# Function to delete many fields with one schema change, fields that aren't there are skipped
+def delete_fields(lyr, fields):
+    existing = dataset_fields(lyr)
+    if existing is None:
+        return True
+    names = dict((f.name.lower(), f.name) for f in existing)
+    drop = [names[f.lower()] for f in fields if f.lower() in names]
+    if not drop:
+        return True
+    try:
+        arcpy.DeleteField_management(lyr, drop)
+        writelog(lyr + " exists. Deleted " + ", ".join(drop))
+        return True
+    except Exception as e:
+        writelog('Exception occurred, ' + str(e))
+        return False
+    finally:
+        forget_schema(lyr)
+
+# Function to rename many fields, renames = dict of old name -> new name
+# arcpy renames one field per call, so only the renames still to do are run: a field whose
+# old name is gone and whose new name is there has been renamed already
+def rename_fields(lyr, renames):
+    existing = dataset_fields(lyr)
+    if existing is None:
+        return True
+    names = set(f.name.lower() for f in existing)
+    todo = [(fld, newfld) for fld, newfld in renames.items() if fld.lower() in names and fld != newfld]
+    if not todo:
+        return True
+    try:
+        for fld, newfld in todo:
             arcpy.AlterField_management(lyr, fld, newfld)
             writelog(lyr + " exists. Renamed " + fld + " to " + newfld)
-            return True
-        except Exception as error:
-            writelog('Exception occurred, + ', str(error))
-            return False
-    else:
         return True
-
- # help to create a pandas dataframe from a feature class
-
-def feature_class_to_pandas_data_frame(feature_class, field_list):
-    return pd.DataFrame(
-        arcpy.da.FeatureClassToNumPyArray(
-            in_table=feature_class,
-            field_names=field_list,
-            skip_nulls=False,
-            null_value=0
-        )
+    except Exception as error:
+        writelog('Exception occurred, ' + str(error))
+        return False
+    finally:
+        forget_schema(lyr)
+
+# pandas dtype of each arcpy field type - nullable types, so a null stays a null (pd.NA) instead of a 0
+field_dtypes = {
+    "OID": "Int64", "SmallInteger": "Int16", "Integer": "Int32", "BigInteger": "Int64",
+    "Single": "Float32", "Double": "Float64", "String": "string", "GUID": "string", "GlobalID": "string",
+    "Date": "datetime64[ns]", "DateOnly": "datetime64[ns]", "TimestampOffset": "datetime64[ns]",
+}
+# with downcast=True doubles become Float32 (about 7 significant digits) and 64 bit integers Int32 when they fit
+downcast_dtypes = {"Float64": "Float32", "Int64": "Int32"}
+token_dtypes = {"SHAPE@AREA": "Float64", "SHAPE@LENGTH": "Float64", "SHAPE@X": "Float64", "SHAPE@Y": "Float64",
+                "SHAPE@Z": "Float64", "SHAPE@M": "Float64", "OID@": "Int64"}
+
+# numbers the feature layers read_batches makes for a spatial filter
+read_batches_layers = itertools.count()
+
+# reads a feature class or table a batch of rows at a time and yields each batch as a DataFrame
+# only one batch is in memory at once, however big the layer is
+#   field_list - the columns to read (geometry tokens like SHAPE@AREA allowed), every field when left out
+#   where_clause - attribute filter, spatial_filter - a layer or geometry the features have to relate to
+#                  (spatial_relationship, INTERSECT by default)
+#   downcast - smaller dtypes for doubles and 64 bit integers (see downcast_dtypes), off by default
+#              as Float32 rounds areas and coordinates
+# nulls come through as pd.NA / NaT in nullable columns, geometry objects and WKB as object columns
+
+def read_batches(table, field_list=None, where_clause=None, spatial_filter=None, spatial_relationship="INTERSECT",
+                 batch_size=100000, downcast=False):
+    import pandas as pd
+    types = dict((f.name, f.type) for f in arcpy.ListFields(table))
+    if not field_list:
+        field_list = [name for name, ftype in types.items() if ftype not in ("Geometry", "Blob", "Raster")]
+    dtypes = []
+    for field in field_list:
+        dtype = token_dtypes.get(field.upper(), field_dtypes.get(types.get(field), "object"))
+        dtypes.append(downcast_dtypes.get(dtype, dtype) if downcast else dtype)
+
+    source = table
+    if spatial_filter is not None:
+        # the selection is made by the geodatabase, the cursor only sees the selected rows
+        # every generator gets its own layer name, several can be open at once
+        layer_name = "read_batches_" + str(os.getpid()) + "_" + str(next(read_batches_layers))
+        source = arcpy.MakeFeatureLayer_management(table, layer_name, where_clause).getOutput(0)
+        arcpy.SelectLayerByLocation_management(source, spatial_relationship, spatial_filter)
+        where_clause = None
+    try:
+        with arcpy.da.SearchCursor(source, field_list, where_clause) as cursor:
+            cursor_rows = iter(cursor)
+            while True:
+                rows = list(itertools.islice(cursor_rows, batch_size))
+                if not rows:
+                    break
+                columns = zip(*rows)
+                del rows
+                frame = {}
+                for field, dtype, values in zip(field_list, dtypes, columns):
+                    frame[field] = column_series(values, dtype, downcast)
+                yield pd.DataFrame(frame)
+    finally:
+        if source is not table:
+            arcpy.Delete_management(source)
+
+# turns one column of cursor values into a series of dtype, nulls (None) become missing values
+def column_series(values, dtype, downcast=False):
+    import pandas as pd
+    if dtype == "object":
+        return pd.Series(values, dtype=object)
+    if dtype.startswith("datetime"):
+        return pd.Series(pd.to_datetime(values))
+    if dtype == "Int32" and downcast:
+        # only a downcast Int64 can be out of range, keep those columns as Int64
+        series = pd.Series(values, dtype="Int64")
+        if series.isna().all() or (series.min() >= -2 ** 31 and series.max() < 2 ** 31):
+            return series.astype("Int32")
+        return series
+    return pd.Series(values, dtype=dtype)
+
+# whole table in one DataFrame, nulls as missing values - for big layers loop over read_batches instead
+
+def feature_class_to_pandas_data_frame(feature_class, field_list, where_clause=None, downcast=False):
+    import pandas as pd
+    frames = list(read_batches(feature_class, field_list, where_clause, downcast=downcast))
+    if not frames:
+        return pd.DataFrame(dict((f, []) for f in field_list))
+    return pd.concat(frames, ignore_index=True)
+
+# bulk array I/O - read and write whole columns at once instead of looping over cursor rows
+# field_list can hold geometry tokens like SHAPE@AREA, null_value is passed through to arcpy
+# (a single value or a dict of field -> value) and is needed when a column can hold nulls
+
+def read_columns(table, field_list, where_clause=None, null_value=None):
+    if any(f.upper().startswith("SHAPE@") for f in field_list):
+        reader = arcpy.da.FeatureClassToNumPyArray
+    else:
+        reader = arcpy.da.TableToNumPyArray
+    return reader(
+        in_table=table,
+        field_names=field_list,
+        where_clause=where_clause,
+        skip_nulls=False,
+        null_value=null_value
     )
 
+# writes columns back by joining on the key field (the object id by default)
+# columns = dict of new or existing field name -> array in the same order as keys
+# fields that don't exist yet are added with a type that matches the array dtype
+
+def write_columns(table, keys, columns, key_field=None):
+    if key_field is None:
+        key_field = arcpy.Describe(table).OIDFieldName
+    keys = np.asarray(keys)
+    dtype = [("_key", keys.dtype)] + [(f, np.asarray(v).dtype) for f, v in columns.items()]
+    out = np.empty(len(keys), dtype=dtype)
+    out["_key"] = keys
+    for f, v in columns.items():
+        out[f] = v
+    arcpy.da.ExtendTable(table, key_field, out, "_key", append_only=False)
+
+# vectorized transforms to go with read_columns
+
+def clamp(values, lower=None, upper=None):
+    return np.clip(values, lower, upper)
+
+def masked_sum(values, mask):
+    return float(np.asarray(values)[np.asarray(mask, dtype=bool)].sum())
+
+def sum_column(table, field="SHAPE@AREA", where_clause=None):
+    values = read_columns(table, [field], where_clause, null_value=0)[field]
+    return float(values.sum())
+
+# sums values per distinct key in one pass, returns a dict of key -> sum
+def group_sum(keys, values):
+    keys = np.asarray(keys)
+    if keys.size == 0:
+        return {}
+    groups, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=np.asarray(values, dtype=np.float64), minlength=len(groups))
+    return dict(zip(groups.tolist(), sums.tolist()))
+
 def list_fields(fc):
-    flist = arcpy.ListFields(fc)
-    fdic = {}
-    fl = []
-    for f in flist:
-        fdic[f.name] = flist.index(f)
-        fl.append(f.name)
+    fl = [f.name for f in dataset_fields(fc)]
+    fdic = dict((name, i) for i, name in enumerate(fl))
     return fdic, fl
 
+# sends a mail through the background queue in notifications and returns straight away
+# filedict = attachment path -> name shown in the mail
 def email(subject, body, filedict = None):
-    try:
-        smtpobj = smtplib.SMTP(host="forsite-ca.mail.protection.outlook.com", port="25")
-        smtpobj.set_debuglevel(1)
-        msg = MIMEMultipart()
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = ",".join(receiver)
-        msg['Content-type'] = "text/html"
-        msgText = MIMEText('<b>%s</b>' % (body), 'html')
-        msg.attach(msgText)
-        if filedict != None:
-            for x,y in filedict.items():
-                try:
-                    file = MIMEApplication(open(x, 'rb').read())
-                    file.add_header('Content-Disposition','attachment',filename= y)
-                    msg.attach(file)
-                except:
-                    print('no attachment')
-                    pass
-                
-        smtpobj.sendmail(sender,receiver + bcc,msg.as_string())
-    except:
-        print("No email sent")
\ No newline at end of file
+    notification_queue().send(subject, body, filedict)
+
+# the queue behind email, for digests (begin_digest / end_digest) and flushing
+def notification_queue():
+    import notifications
+    return notifications.default_queue()
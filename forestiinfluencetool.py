@@ -1,11 +1,21 @@
-import arcpy, os
-from arcpy import env
-from arcpy.sa import *
+try:
+    import arcpy
+    from arcpy import env
+    from arcpy.sa import *
+except ImportError:  # the Immediate OM functions can still run on the shapely geometry backend
+    arcpy = None
+import os, csv
+import numpy as np
 import commonstuff as cs
+from scratchstore import ScratchStore
+import geometrybackend as gb
+import stagetrace as st
+import resultstore
 
 
 # To allow overwriting the outputs change the overwrite option to true.
-arcpy.env.overwriteOutput = True
+if arcpy is not None:
+    arcpy.env.overwriteOutput = True
 
 # Setting the workspace environment.
 # setting the workspace basically meant for outputs (has to be a gdb) 
@@ -14,13 +24,53 @@ arcpy.env.overwriteOutput = True
 # proposed_blocks = r"C:/projects/mosaic/MosaicForestInfluenceTool_Data/Data/Mosaic_Layers.gdb/Subsetting_RB_Test"
 # cwh_layer = r"C:/projects/mosaic/MosaicForestInfluenceTool_Data/Data/TP14i.gdb/TP14i_2022_Mosaic_LU"
 
-area_dic = {'total_area': 0, 'subset_area': 0}
 subset_of_propoductive_area = {}
-objectid = 0
 
 # Path to the new feature class
 new_fc = "NewFeatureClass"
 
+# stands older than this count as old growth, per BGC zone and subzone
+# a (zone, None) entry covers every subzone of the zone that has no entry of its own
+# can be replaced with a csv (BGC_ZONE, BGC_SUBZONE, MIN_AGE columns) through read_old_growth_ages
+old_growth_ages = {
+    ("CWH", None): 80,
+    ("MH", None): 120,
+}
+
+# Function to read an old growth age table from a csv, a blank subzone covers the whole zone
+def read_old_growth_ages(csv_path):
+    ages = {}
+    with open(csv_path) as csvfile:
+        for row in csv.DictReader(csvfile):
+            subzone = (row.get("BGC_SUBZONE") or "").strip() or None
+            ages[(row["BGC_ZONE"].strip(), subzone)] = float(row["MIN_AGE"])
+    return ages
+
+# Function to look up the old growth age of every row, nan where the zone isn't in the table
+def old_growth_thresholds(zones, subzones, ages=old_growth_ages):
+    zones = np.asarray(zones).astype(str)
+    subzones = np.full(zones.shape, "") if subzones is None else np.asarray(subzones).astype(str)
+    pairs, inverse = np.unique(np.char.add(np.char.add(zones, "|"), subzones), return_inverse=True)
+    lookup = np.full(len(pairs), np.nan)
+    for n, pair in enumerate(pairs.tolist()):
+        zone, subzone = pair.split("|", 1)
+        lookup[n] = ages.get((zone, subzone or None), ages.get((zone, None), np.nan))
+    return lookup[inverse.ravel()]
+
+# Function to get Immediate OM (percent of area that is old growth) for many blocks at once
+# all arguments are arrays with one value per intersect row, blocks=None puts every row in one group
+# returns a dict of block -> percent
+def immediate_om(areas, ages, zones, subzones=None, blocks=None, age_table=old_growth_ages):
+    areas = np.asarray(areas, dtype=np.float64)
+    ages = np.asarray(ages, dtype=np.float64)
+    thresholds = old_growth_thresholds(zones, subzones, age_table)
+    old_growth = ~np.isnan(thresholds) & (ages > np.nan_to_num(thresholds, nan=np.inf))
+    if blocks is None:
+        blocks = np.full(areas.shape, "")
+    total = cs.group_sum(blocks, areas)
+    subset = cs.group_sum(blocks, np.where(old_growth, areas, 0))
+    return dict((block, subset[block] / total[block] * 100 if total[block] else 0.0) for block in total)
+
 # create temporary gbd if one doesn't exist at the location specified
 def create_temp_gdb(temp_gdb_location):
     if not arcpy.Exists(temp_gdb_location):
@@ -29,124 +79,141 @@ def create_temp_gdb(temp_gdb_location):
     else:
         cs.writelog("File geodatabase already exists at: " + temp_gdb_location)
 
-def create_table():
-    # create a table to store the results if it doesn't exist
-    if not arcpy.Exists("Results"):
-        arcpy.CreateTable_management(arcpy.env.workspace, "Results")
-        arcpy.AddField_management("Results", "Block_ID", "TEXT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        arcpy.AddField_management("Results", "Immediate_OM", "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        cs.writelog("Created a new table to store the results")
-    else:
-        cs.writelog("Table already exists")
+# results are kept in results.sqlite next to temp.gdb, one row per block (see resultstore),
+# and copied to the Results table in temp.gdb at the end of a run
+def open_results(temp_gdb_location):
+    return resultstore.ResultStore(os.path.join(temp_gdb_location, resultstore.store_name))
 
-def buffer(proposed_blocks, objectid):
+@st.traced()
+def buffer(proposed_blocks, scratch):
     # Process: Buffer only the selected features and dissolve the output
     # in the event of returning back all the fields in the feature class, this would imply a selection of the entire feature class
 
-    # iterate through the selected features and note the subsetting names
+    # iterate through the selected features and note the subsetting names, they are the block id of the result
     names = ""
     for row in arcpy.da.SearchCursor(proposed_blocks, ['SubSettingName']):
         cs.writelog(row[0])
         names += row[0] + ";"
-    
-    # write the names list to the table
-    with arcpy.da.InsertCursor("Results", ['Block_ID']) as cursor:
-        objectid = cursor.insertRow([names])
 
 
     # buffer the selected features   
-    arcpy.Buffer_analysis(proposed_blocks, "Buffer", "2000 Meters", "FULL", "ROUND", "ALL", "", "PLANAR")
-
-    # union the buffered features with the selection and copy over the original buffer to a new feature class
-    arcpy.Union_analysis([proposed_blocks, "Buffer"], "Union", "ALL", "", "GAPS")
-
-
-
-
-    # Define the condition to select the specific row
-    condition_field = "SubSettingName"
-    condition_value = ""  # Change as per your requirement
-
-    # Get the spatial reference of the existing feature class
-    spatial_ref = arcpy.Describe("Union").spatialReference
-
-    # Create the new feature class with the same schema
-    arcpy.CreateFeatureclass_management(arcpy.env.workspace, new_fc, "POLYGON", "Union", "SAME_AS_TEMPLATE", "SAME_AS_TEMPLATE", spatial_ref)
-
-    # Define the fields to be copied
-    fields = [field.name for field in arcpy.ListFields("Union") if field.type not in ("OID", "Geometry")]
-
-    # Add geometry field
-    fields.append("SHAPE@")
+    gb.get_backend().buffer(proposed_blocks, scratch.path("Buffer"), "2000 Meters", "FULL", "ALL")
 
-    # Use a search cursor to select the specific row from the existing feature class
-    with arcpy.da.SearchCursor("Union", fields) as search_cursor:
-        for row in search_cursor:
-            if row[fields.index(condition_field)] == condition_value:
-                selected_row = row
-                break
+    # the ring is the buffer minus the blocks, straight into the in-memory feature class the intersect reads
+    gb.get_backend().erase(scratch.path("Buffer"), proposed_blocks, scratch.path(new_fc))
 
-    # Use an insert cursor to insert the selected row into the new feature class
-    with arcpy.da.InsertCursor(new_fc, fields) as insert_cursor:
-        insert_cursor.insertRow(selected_row)
+    return names
 
-
-    return objectid
-
-def intersect():
+@st.traced(inputs=())
+def intersect(scratch):
     # get the intersection bewteen the buffer and the cwh layer
-    arcpy.Intersect_analysis([cwh_layer, new_fc], "Intersect", "ALL", "", "INPUT")
+    gb.get_backend().intersect([cwh_layer, scratch.path(new_fc)], scratch.path("Intersect"))
 
     # remove the cwh layer from the intersected features with manifold  
 
-def area(objectid):
+@st.traced(inputs=())
+def area(scratch, age_table=old_growth_ages, landscape_index=None):
     # write the results to a new field in the original selected feature
 
     # arcpy.AddField_management(proposed_blocks, "Immediate_om", "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
     
-    # get total area of the intersected features per block
-    with arcpy.da.SearchCursor("Intersect", ['SHAPE@AREA', 'PROJ_AGE', 'BGC_ZONE']) as cursor:
-        for row in cursor:
-            # sum all the area per block and store it in a dictionary
-            area_dic['total_area'] += row[0]
-            # print(row[2])
-
-            # get the area from the cwh layer where PROJ_AGE is greater than 80 when BGC_ZONE = cwh and PROJ_AGE > 120 when BGC_ZONE = mh
-            if row[2] != None and row[1] > 80 and row[2] == "CWH":
-                area_dic['subset_area'] += row[0]
-            elif row[2] != None and row[1] > 120 and row[2] == "MH":
-                area_dic['subset_area'] += row[0]
-
-
-    immediate_om_value = area_dic['subset_area'] / area_dic['total_area'] * 100
+    # read the intersected features as columns and classify them all at once
+    # (with a landscape index the ring is intersected with the indexed polygons instead of the Intersect output)
+    if landscape_index is not None:
+        ring = gb.get_backend().read_geometries(scratch.path(new_fc))
+        columns = landscape_index.intersect_columns(ring.geometries)
+    else:
+        columns = read_classification_columns(scratch.path("Intersect"))
+    immediate_om_value = immediate_om(columns['SHAPE@AREA'], columns['PROJ_AGE'], columns['BGC_ZONE'],
+                                      columns.get('BGC_SUBZONE'), None, age_table).get("", 0.0)
     cs.writelog("Immediate OM value is: " + str(immediate_om_value) + "%")
-
-
-    # Create an insert cursor
-    with arcpy.da.UpdateCursor("Results", ['OBJECTID', 'Immediate_om']) as cursor:
-        for row in cursor:
-            if row[0] == objectid:
-                row[1] = immediate_om_value
-                cursor.updateRow(row)
-
+    return immediate_om_value
+
+
+# Function to read the columns the old growth classification needs from an intersect output
+# returns a dict of field -> array, BGC_SUBZONE is only there when the layer has it
+def read_classification_columns(intersect_fc, extra_fields=()):
+    backend = gb.get_backend()
+    fields = ['SHAPE@AREA', 'PROJ_AGE', 'BGC_ZONE'] + list(extra_fields)
+    if 'BGC_SUBZONE' in backend.field_names(intersect_fc):
+        fields.append('BGC_SUBZONE')
+    null_values = {'PROJ_AGE': 0}
+    columns = backend.read_columns(intersect_fc, fields, null_value=dict((f, null_values.get(f, '')) for f in fields[1:]))
+    return dict((f, columns[f]) for f in fields)
+
+# Function to build a ring around every proposed block - its own buffer minus all proposed blocks
+@st.traced()
+def block_rings(proposed_blocks, scratch, block_field="SubSettingName", distance="2000 Meters"):
+    backend = gb.get_backend()
+    backend.buffer(proposed_blocks, scratch.path("BlockBuffers"), distance, "FULL", "LIST", block_field)
+    backend.erase(scratch.path("BlockBuffers"), proposed_blocks, scratch.path("BlockRings"))
+    return scratch.path("BlockRings")
+
+# Function to get Immediate OM for every proposed block in one run, returns a dict of block -> percent
+# the cwh layer is narrowed down to the polygons touching the rings through its spatial index,
+# so the work grows with the size of the rings rather than the size of the landscape layer
+# landscape_index - a landscapeindex.LandscapeIndex over the cwh layer to read candidates from instead
+@st.traced()
+def immediate_om_per_block(proposed_blocks, cwh_layer, scratch, block_field="SubSettingName", distance="2000 Meters", age_table=old_growth_ages,
+                           landscape_index=None):
+    backend = gb.get_backend()
+    rings = block_rings(proposed_blocks, scratch, block_field, distance)
+    if landscape_index is not None:
+        ring_layer = backend.read_geometries(rings, [block_field])
+        columns = landscape_index.intersect_columns(ring_layer.geometries, ring_layer.attributes[block_field], block_field)
+    else:
+        candidates = backend.select_candidates(cwh_layer, rings, "cwh_candidates")
+        backend.intersect([candidates, rings], scratch.path("BlockRingIntersect"))
+        columns = read_classification_columns(scratch.path("BlockRingIntersect"), [block_field])
+    return immediate_om(columns['SHAPE@AREA'], columns['PROJ_AGE'], columns['BGC_ZONE'],
+                        columns.get('BGC_SUBZONE'), columns[block_field], age_table)
 
 
 if __name__ == "__main__":
     proposed_blocks = arcpy.GetParameterAsText(0) 
     cwh_layer = arcpy.GetParameterAsText(1)  
     temp_gdb_location = arcpy.GetParameterAsText(2) 
+    age_table_csv = arcpy.GetParameterAsText(3)  # Optional - old growth ages per BGC zone/subzone
+    age_table = read_old_growth_ages(age_table_csv) if age_table_csv else old_growth_ages
+    per_block = arcpy.GetParameterAsText(4).lower() == "true"  # Optional - one ring and Immediate OM per block
+    use_index = arcpy.GetParameterAsText(5).lower() == "true"  # Optional - build/reuse the index sidecar next to the cwh layer
 
     create_temp_gdb(temp_gdb_location)
+    # stage times, counts and memory go to immediate_om_trace.json/.csv next to temp.gdb
+    st.start_run(temp_gdb_location, "immediate_om_trace")
     arcpy.env.workspace = os.path.join(temp_gdb_location, "temp.gdb")
-    create_table()
-
-    objectid = buffer(proposed_blocks, objectid)
-    cs.writelog("Buffered the proposed blocks")
-    cs.writelog("Object ID is: " + str(objectid))
-    intersect()
-    cs.writelog("Intersected the buffered proposed blocks with the cwh layer")
-    area(objectid)
-    cs.writelog("Calculated the area of the intersected features")
+    results = open_results(temp_gdb_location)
+    run_id = results.start_run("immediate_om", {"proposed_blocks": proposed_blocks, "cwh_layer": cwh_layer,
+                                                "age_table": age_table_csv, "per_block": per_block})
+    # Buffer, NewFeatureClass (the ring) and Intersect stay in memory
+    scratch = ScratchStore(temp_gdb_location, "temp.gdb")
+
+    landscape_index = None
+    if use_index:
+        # landscapeindex needs shapely, so it is only imported when the index is used
+        import landscapeindex as li
+        index_fields = [f for f in ['PROJ_AGE', 'BGC_ZONE', 'BGC_SUBZONE'] if f in gb.get_backend().field_names(cwh_layer)]
+        landscape_index = li.open_index(cwh_layer, index_fields)
+
+    if per_block:
+        block_om = immediate_om_per_block(proposed_blocks, cwh_layer, scratch, age_table=age_table, landscape_index=landscape_index)
+        for block_id, immediate_om_value in block_om.items():
+            cs.writelog("Immediate OM value for " + str(block_id) + " is: " + str(immediate_om_value) + "%")
+        results.upsert([{"Block_ID": block_id, "Immediate_OM": value} for block_id, value in block_om.items()], run_id)
+        cs.writelog("Calculated Immediate OM for " + str(len(block_om)) + " blocks")
+    else:
+        block_id = buffer(proposed_blocks, scratch)
+        cs.writelog("Buffered the proposed blocks")
+        if landscape_index is None:
+            intersect(scratch)
+            cs.writelog("Intersected the buffered proposed blocks with the cwh layer")
+        immediate_om_value = area(scratch, age_table, landscape_index)
+        results.upsert([{"Block_ID": block_id, "Immediate_OM": immediate_om_value}], run_id)
+        cs.writelog("Calculated the area of the intersected features")
+    results.finish_run(run_id)
+    results.export(os.path.join(arcpy.env.workspace, "Results"))
+    results.close()
+    st.finish_run()
 
     
 
@@ -0,0 +1,549 @@
+# Pluggable geometry backend for the overlay steps of the tools
+# (erase, clip, buffer and intersect, plus the few dataset helpers they need)
+# and the raster steps of the CHM (write, read, clip to polygons, cells to points, rasterize),
+# with rasters handed around as Grids
+#
+# ArcpyBackend runs one geoprocessing tool per call, the same way the tools always have.
+# ShapelyBackend does the same overlays on arrays of shapely 2 geometries in bulk, with an
+# STRtree prefilter so every feature is only compared with the features it can touch.
+# It needs no geoprocessing license, so the tools can run and be benchmarked on Linux.
+#
+# Datasets are referenced by path either way. The shapely backend keeps its datasets in
+# memory keyed by path - outputs are stored under the output path, inputs can be added
+# with add() or are read from GeoJSON files the first time they are used.
+#
+# The backend is picked with set_backend("arcpy" / "shapely") or the MOSAIC_GEOMETRY_BACKEND
+# environment variable, and defaults to arcpy when arcpy can be imported.
+
+import os, json
+import numpy as np
+import commonstuff as cs
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+try:
+    import shapely
+except ImportError:
+    shapely = None
+
+current_backend = None
+
+# ArcGIS linear units -> metres, for distances like "2000 Meters"
+linear_units = {"meters": 1.0, "meter": 1.0, "kilometers": 1000.0, "kilometer": 1000.0,
+                "feet": 0.3048, "foot": 0.3048}
+
+
+# Function to get the active backend
+def get_backend():
+    global current_backend
+    if current_backend is None:
+        set_backend(os.environ.get("MOSAIC_GEOMETRY_BACKEND", "arcpy" if arcpy is not None else "shapely"))
+    return current_backend
+
+# Function to switch backends - a name or a backend instance
+def set_backend(backend):
+    global current_backend
+    if backend == "arcpy":
+        backend = ArcpyBackend()
+    elif backend == "shapely":
+        backend = ShapelyBackend()
+    elif isinstance(backend, str):
+        raise ValueError("Unknown geometry backend " + backend)
+    current_backend = backend
+    return current_backend
+
+
+class ArcpyBackend(object):
+
+    name = "arcpy"
+
+    # rough size of one in-memory feature and raster pixel sizes, for ScratchStore
+    feature_bytes = 4096
+    pixel_bytes = {"1_BIT": 1, "2_BIT": 1, "4_BIT": 1, "U1": 1, "U2": 1, "U4": 1, "U8": 1, "S8": 1,
+                   "U16": 2, "S16": 2, "U32": 4, "S32": 4, "F32": 4, "F64": 8}
+
+    def __init__(self):
+        if arcpy is None:
+            raise ImportError("The arcpy geometry backend needs arcpy")
+        # ArcGIS Pro calls the in-memory workspace "memory", ArcMap calls it "in_memory"
+        if arcpy.GetInstallInfo().get("ProductName") == "ArcGISPro":
+            self.memory_workspace = "memory"
+        else:
+            self.memory_workspace = "in_memory"
+
+    def erase(self, in_features, erase_features, out_features):
+        arcpy.Erase_analysis(in_features, erase_features, out_features)
+        return out_features
+
+    def clip(self, in_features, clip_features, out_features):
+        arcpy.Clip_analysis(in_features, clip_features, out_features)
+        return out_features
+
+    # dissolve - NONE, ALL, or LIST to dissolve by dissolve_field
+    def buffer(self, in_features, out_features, distance, line_side="FULL", dissolve="NONE", dissolve_field=None):
+        arcpy.Buffer_analysis(in_features, out_features, distance, line_side, "ROUND", dissolve, dissolve_field, "PLANAR")
+        return out_features
+
+    def intersect(self, in_features, out_features):
+        arcpy.Intersect_analysis(in_features, out_features, "ALL", "", "INPUT")
+        return out_features
+
+    # Function to narrow a large dataset down to the features that touch query_features
+    # returns a layer with them selected - the selection goes through the dataset's spatial index
+    def select_candidates(self, dataset, query_features, layer_name="candidates"):
+        layer = arcpy.MakeFeatureLayer_management(dataset, layer_name).getOutput(0)
+        arcpy.SelectLayerByLocation_management(layer, "INTERSECT", query_features)
+        return layer
+
+    def exists(self, dataset):
+        return bool(dataset) and arcpy.Exists(dataset)
+
+    def count(self, dataset):
+        return int(arcpy.GetCount_management(dataset).getOutput(0))
+
+    def sum_area(self, dataset):
+        return cs.sum_column(dataset, "SHAPE@AREA")
+
+    # columns as arrays, by name - geometry tokens like SHAPE@AREA are allowed
+    def read_columns(self, dataset, fields, null_value=None):
+        return cs.read_columns(dataset, fields, null_value=null_value)
+
+    def field_names(self, dataset):
+        return [f.name for f in arcpy.ListFields(dataset)]
+
+    # geometries (as shapely) and attribute columns of a dataset, nulls stay None
+    def read_geometries(self, dataset, fields=()):
+        geometries, rows = [], []
+        with arcpy.da.SearchCursor(dataset, ["SHAPE@WKB"] + list(fields)) as cursor:
+            for row in cursor:
+                geometries.append(bytes(row[0]))
+                rows.append(row[1:])
+        columns = list(zip(*rows)) if rows else [[] for field in fields]
+        return Layer(shapely.from_wkb(geometries), dict((field, np.array(column, dtype=object)) for field, column in zip(fields, columns)))
+
+    # xmin, ymin, xmax, ymax of the (selected) features
+    def bounds(self, dataset):
+        extents = [row[0].extent for row in arcpy.da.SearchCursor(dataset, ["SHAPE@"])]
+        return (min(e.XMin for e in extents), min(e.YMin for e in extents),
+                max(e.XMax for e in extents), max(e.YMax for e in extents))
+
+    # area of features inside every zone, per distinct zone_field value
+    def tabulate_area(self, zones, zone_field, features):
+        table = self.memory_workspace + "\\tabulate_area"
+        arcpy.TabulateIntersection_analysis(zones, zone_field, features, table)
+        try:
+            columns = cs.read_columns(table, [zone_field, "AREA"], null_value={zone_field: "", "AREA": 0})
+        finally:
+            arcpy.Delete_management(table)
+        return cs.group_sum(columns[zone_field], columns["AREA"])
+
+    def catalog_path(self, dataset):
+        return arcpy.Describe(dataset).catalogPath
+
+    # latest modification time of the dataset on disk (of its geodatabase for a file geodatabase), None for in-memory data
+    def modified(self, dataset):
+        return cs.dataset_modified(self.catalog_path(dataset))
+
+    def delete(self, dataset):
+        if arcpy.Exists(dataset):
+            arcpy.Delete_management(dataset)
+
+    def is_raster(self, dataset):
+        return arcpy.Describe(dataset).dataType in ("RasterDataset", "RasterBand")
+
+    # Function to copy a feature class or raster, e.g. from the in-memory workspace to a geodatabase
+    def copy(self, in_dataset, out_dataset):
+        if self.is_raster(in_dataset):
+            arcpy.CopyRaster_management(in_dataset, out_dataset)
+        else:
+            arcpy.CopyFeatures_management(in_dataset, out_dataset)
+        return out_dataset
+
+    def create_workspace(self, folder, name):
+        path = os.path.join(folder, name)
+        if not arcpy.Exists(path):
+            arcpy.CreateFileGDB_management(folder, name)
+        return path
+
+    # rasters - read_raster gives a Grid (nodata as 0), write_raster saves one
+    def read_raster(self, dataset):
+        raster = arcpy.Raster(dataset)
+        array = arcpy.RasterToNumPyArray(raster, nodata_to_value=0)
+        return Grid(array, (raster.extent.XMin, raster.extent.YMax), raster.meanCellWidth, raster.spatialReference)
+
+    # top left corner, cell size, rows and columns of a raster, without reading its cells
+    def raster_properties(self, dataset):
+        raster = arcpy.Raster(dataset)
+        return (raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth, raster.height, raster.width)
+
+    def write_raster(self, dataset, grid):
+        left, top = grid.corner
+        lower_left = arcpy.Point(left, top - grid.array.shape[0] * grid.cell_size)
+        arcpy.NumPyArrayToRaster(grid.array, lower_left, grid.cell_size, grid.cell_size, 0).save(dataset)
+        if grid.spatial_reference is not None:
+            arcpy.DefineProjection_management(dataset, grid.spatial_reference)
+        return dataset
+
+    # Function to set the cells outside clip_features to nodata, the extent stays the same
+    def clip_raster(self, raster, clip_features, out_raster):
+        arcpy.Clip_management(raster, "", out_raster, clip_features, "", "ClippingGeometry", "MAINTAIN_EXTENT")
+        return out_raster
+
+    # Function to make a point at every cell centre, with the cell value in grid_code
+    def raster_to_points(self, raster, out_features):
+        arcpy.RasterToPoint_conversion(raster, out_features, "VALUE")
+        return out_features
+
+    # Function to find the cells of a grid (top left corner, size, cell size) whose centres are inside features
+    # the features are rasterized to out_raster lined up with snap_raster, returns a bool array
+    def rasterize(self, features, out_raster, corner, nrows, ncols, cell_size, snap_raster=None):
+        left, top = corner
+        bottom = top - nrows * cell_size
+        old_snap, old_extent = arcpy.env.snapRaster, arcpy.env.extent
+        arcpy.env.snapRaster = snap_raster
+        arcpy.env.extent = arcpy.Extent(left, bottom, left + ncols * cell_size, top)
+        try:
+            oid_field = arcpy.Describe(features).OIDFieldName
+            arcpy.PolygonToRaster_conversion(features, oid_field, out_raster, "CELL_CENTER", "", cell_size)
+        finally:
+            arcpy.env.snapRaster, arcpy.env.extent = old_snap, old_extent
+        return arcpy.RasterToNumPyArray(out_raster, arcpy.Point(left, bottom), ncols, nrows, nodata_to_value=0) > 0
+
+    # Function to write columns (arrays in the row order read_columns gives), adding the fields that aren't there
+    def write_columns(self, dataset, columns):
+        oid_field = arcpy.Describe(dataset).OIDFieldName
+        cs.write_columns(dataset, cs.read_columns(dataset, [oid_field])[oid_field], columns, oid_field)
+
+    def size_of(self, dataset):
+        if arcpy.Describe(dataset).dataType in ("RasterDataset", "RasterBand"):
+            raster = arcpy.Raster(dataset)
+            return raster.width * raster.height * raster.bandCount * self.pixel_bytes.get(raster.pixelType, 4)
+        return self.count(dataset) * self.feature_bytes
+
+
+# Features of one dataset for the shapely backend
+# geometries - object array of shapely geometries, attributes - dict of field -> array
+class Layer(object):
+
+    def __init__(self, geometries, attributes=None):
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.attributes = dict((k, np.asarray(v)) for k, v in (attributes or {}).items())
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def take(self, index, geometries=None):
+        return Layer(self.geometries[index] if geometries is None else geometries,
+                     dict((k, v[index]) for k, v in self.attributes.items()))
+
+
+# Single band raster - what read_raster gives on either backend, and how the shapely backend keeps rasters
+# array - row 0 is the top, nodata as 0; corner - (left, top); cell_size - width of the square cells
+class Grid(object):
+
+    def __init__(self, array, corner, cell_size, spatial_reference=None):
+        self.array = array
+        self.corner = tuple(corner)
+        self.cell_size = cell_size
+        self.spatial_reference = spatial_reference
+
+    # Function to get the x and y of every cell centre, as two arrays shaped like the grid
+    def cell_centres(self):
+        left, top = self.corner
+        nrows, ncols = self.array.shape
+        return np.meshgrid(left + (np.arange(ncols) + 0.5) * self.cell_size, top - (np.arange(nrows) + 0.5) * self.cell_size)
+
+
+class ShapelyBackend(object):
+
+    name = "shapely"
+    memory_workspace = "memory"
+    quad_segs = 16  # segments per quarter circle, ArcGIS densifies its true curves about as finely
+
+    def __init__(self):
+        if shapely is None or int(shapely.__version__.split(".")[0]) < 2:
+            raise ImportError("The shapely geometry backend needs shapely 2")
+        self.datasets = {}
+        self.versions = {}
+        self.version = 0
+        self.trees = {}  # dataset -> (version, STRtree)
+
+    # Function to register an in-memory dataset under a path
+    def add(self, dataset, layer):
+        self.version += 1
+        self.datasets[dataset] = layer
+        self.versions[dataset] = self.version
+        return dataset
+
+    def read(self, dataset):
+        if dataset not in self.datasets:
+            self.add(dataset, read_npz(dataset) if str(dataset).endswith(".npz") else read_geojson(dataset))
+        return self.datasets[dataset]
+
+    # Function to get the STRtree of a dataset, built once and kept until the dataset changes
+    def spatial_index(self, dataset):
+        layer = self.read(dataset)
+        version, tree = self.trees.get(dataset, (None, None))
+        if version != self.versions[dataset]:
+            tree = shapely.STRtree(layer.geometries)
+            self.trees[dataset] = (self.versions[dataset], tree)
+        return tree
+
+    # intersect() already queries the cached index of its first input, nothing to narrow down here
+    def select_candidates(self, dataset, query_features, layer_name="candidates"):
+        return dataset
+
+    def erase(self, in_features, erase_features, out_features):
+        layer = self.read(in_features)
+        hits, others = candidate_unions(layer.geometries, self.read(erase_features).geometries)
+        geometries = layer.geometries.copy()
+        geometries[hits] = shapely.difference(geometries[hits], others)
+        keep = ~shapely.is_empty(geometries)
+        return self.add(out_features, layer.take(keep, geometries[keep]))
+
+    def clip(self, in_features, clip_features, out_features):
+        layer = self.read(in_features)
+        hits, others = candidate_unions(layer.geometries, self.read(clip_features).geometries)
+        geometries = shapely.intersection(layer.geometries[hits], others)
+        keep = ~shapely.is_empty(geometries)
+        return self.add(out_features, layer.take(hits[keep], geometries[keep]))
+
+    # distance - a number, a linear unit string like "2000 Meters", or a field name
+    def buffer(self, in_features, out_features, distance, line_side="FULL", dissolve="NONE", dissolve_field=None):
+        layer = self.read(in_features)
+        if isinstance(distance, str) and distance in layer.attributes:
+            distance = layer.attributes[distance].astype(np.float64)
+        else:
+            distance = parse_distance(distance)
+        geometries = shapely.buffer(layer.geometries, distance, quad_segs=self.quad_segs)
+        if line_side == "OUTSIDE_ONLY":
+            polygons = shapely.get_dimensions(layer.geometries) == 2
+            geometries[polygons] = shapely.difference(geometries[polygons], layer.geometries[polygons])
+        keep = ~shapely.is_empty(geometries)
+        if dissolve == "ALL":
+            return self.add(out_features, Layer([shapely.union_all(geometries[keep])]))
+        if dissolve == "LIST":
+            values = layer.attributes[dissolve_field][keep]
+            groups, inverse = np.unique(values, return_inverse=True)
+            dissolved = [shapely.union_all(geometries[keep][inverse.ravel() == n]) for n in range(len(groups))]
+            return self.add(out_features, Layer(dissolved, {dissolve_field: groups}))
+        return self.add(out_features, layer.take(keep, geometries[keep]))
+
+    # pairwise intersection of two inputs, keeping the attributes of both
+    # (a field that is in both gets a _1 suffix on the second one, like Intersect_analysis)
+    # the first input is looked up through its cached spatial index, so put the large landscape layer first
+    def intersect(self, in_features, out_features):
+        if len(in_features) != 2:
+            raise ValueError("The shapely backend intersects exactly two inputs")
+        first, second = self.read(in_features[0]), self.read(in_features[1])
+        j, i = self.spatial_index(in_features[0]).query(second.geometries, predicate="intersects")
+        order = np.lexsort((j, i))
+        i, j = i[order], j[order]
+        geometries = shapely.intersection(first.geometries[i], second.geometries[j])
+        keep = shapely.get_dimensions(geometries) == min(first_dimension(first), first_dimension(second))
+        keep &= ~shapely.is_empty(geometries)
+        attributes = dict((k, v[i[keep]]) for k, v in first.attributes.items())
+        for k, v in second.attributes.items():
+            attributes[k + "_1" if k in attributes else k] = v[j[keep]]
+        return self.add(out_features, Layer(geometries[keep], attributes))
+
+    def exists(self, dataset):
+        return bool(dataset) and (dataset in self.datasets or os.path.isfile(str(dataset)))
+
+    def count(self, dataset):
+        return len(self.read(dataset))
+
+    def sum_area(self, dataset):
+        return float(shapely.area(self.read(dataset).geometries).sum())
+
+    # null_value - a single value or a dict of field -> value to put in place of None
+    def read_columns(self, dataset, fields, null_value=None):
+        layer = self.read(dataset)
+        columns = {}
+        for field in fields:
+            if field.upper() == "SHAPE@AREA":
+                columns[field] = shapely.area(layer.geometries)
+                continue
+            values = layer.attributes[field]
+            fill = null_value.get(field) if isinstance(null_value, dict) else null_value
+            if fill is not None and values.dtype == object:
+                values = np.array([fill if v is None else v for v in values.tolist()])
+            columns[field] = values
+        return columns
+
+    def field_names(self, dataset):
+        return list(self.read(dataset).attributes)
+
+    def read_geometries(self, dataset, fields=()):
+        layer = self.read(dataset)
+        return Layer(layer.geometries, dict((field, layer.attributes[field]) for field in fields))
+
+    def bounds(self, dataset):
+        return tuple(shapely.total_bounds(self.read(dataset).geometries))
+
+    def tabulate_area(self, zones, zone_field, features):
+        zone_layer = self.read(zones)
+        hits, unions = candidate_unions(zone_layer.geometries, self.read(features).geometries)
+        areas = shapely.area(shapely.intersection(zone_layer.geometries[hits], unions))
+        return cs.group_sum(zone_layer.attributes[zone_field][hits], areas)
+
+    def catalog_path(self, dataset):
+        return dataset
+
+    # files go by their modification time; in-memory datasets are replaced, never edited,
+    # so a version bumped on every add is enough for them
+    def modified(self, dataset):
+        if os.path.isfile(str(dataset)):
+            return os.path.getmtime(dataset)
+        self.read(dataset)
+        return self.versions[dataset]
+
+    def delete(self, dataset):
+        self.datasets.pop(dataset, None)
+        self.versions.pop(dataset, None)
+        self.trees.pop(dataset, None)
+        if str(dataset).endswith(".npz") and os.path.isfile(dataset):
+            os.remove(dataset)
+
+    def is_raster(self, dataset):
+        return self.exists(dataset) and isinstance(self.read(dataset), Grid)
+
+    # Function to copy a dataset, a .npz path is written to disk (see write_npz) so it outlives the process
+    def copy(self, in_dataset, out_dataset):
+        data = self.read(in_dataset)
+        if str(out_dataset).endswith(".npz"):
+            write_npz(data, out_dataset)
+        if isinstance(data, Grid):
+            return self.add(out_dataset, Grid(data.array.copy(), data.corner, data.cell_size, data.spatial_reference))
+        return self.add(out_dataset, data.take(np.arange(len(data))))
+
+    def read_raster(self, dataset):
+        return self.read(dataset)
+
+    def raster_properties(self, dataset):
+        grid = self.read(dataset)
+        return (grid.corner[0], grid.corner[1], grid.cell_size) + grid.array.shape
+
+    def write_raster(self, dataset, grid):
+        return self.add(dataset, grid)
+
+    # cell centres outside the clip features go to 0 (nodata)
+    def clip_raster(self, raster, clip_features, out_raster):
+        grid = self.read(raster)
+        x, y = grid.cell_centres()
+        inside = shapely.contains_xy(shapely.union_all(self.read(clip_features).geometries), x, y)
+        return self.add(out_raster, Grid(np.where(inside, grid.array, 0).astype(grid.array.dtype), grid.corner, grid.cell_size,
+                                         grid.spatial_reference))
+
+    # nodata (0) cells get no point
+    def raster_to_points(self, raster, out_features):
+        grid = self.read(raster)
+        rows, cols = np.nonzero(grid.array)
+        left, top = grid.corner
+        points = shapely.points(left + (cols + 0.5) * grid.cell_size, top - (rows + 0.5) * grid.cell_size)
+        return self.add(out_features, Layer(points, {"grid_code": grid.array[rows, cols]}))
+
+    def rasterize(self, features, out_raster, corner, nrows, ncols, cell_size, snap_raster=None):
+        mask_grid = Grid(np.zeros((nrows, ncols), dtype=np.uint8), corner, cell_size)
+        x, y = mask_grid.cell_centres()
+        union = shapely.union_all(self.read(features).geometries)
+        shapely.prepare(union)
+        mask = shapely.contains_xy(union, x, y)
+        mask_grid.array[mask] = 1
+        self.add(out_raster, mask_grid)
+        return mask
+
+    def write_columns(self, dataset, columns):
+        layer = self.read(dataset)
+        attributes = dict(layer.attributes)
+        attributes.update((k, np.asarray(v)) for k, v in columns.items())
+        return self.add(dataset, Layer(layer.geometries, attributes))
+
+    def create_workspace(self, folder, name):
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def size_of(self, dataset):
+        layer = self.read(dataset)
+        if isinstance(layer, Grid):
+            return layer.array.nbytes
+        return (int(shapely.get_num_coordinates(layer.geometries).sum()) * 16 +
+                sum(v.nbytes for v in layer.attributes.values()))
+
+
+# Function to find, for every geometry, the union of the other geometries it touches
+# returns the indices of the geometries with at least one candidate and the unions for them
+def candidate_unions(geometries, others):
+    if len(geometries) == 0 or len(others) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object)
+    tree = shapely.STRtree(others)
+    i, j = tree.query(geometries, predicate="intersects")
+    order = np.argsort(i, kind="stable")
+    i, j = i[order], j[order]
+    hits, starts = np.unique(i, return_index=True)
+    unions = np.empty(len(hits), dtype=object)
+    if len(hits) == 0:
+        return hits, unions
+    for n, group in enumerate(np.split(j, starts[1:])):
+        unions[n] = others[group[0]] if len(group) == 1 else shapely.union_all(others[group])
+    return hits, unions
+
+def first_dimension(layer):
+    return int(shapely.get_dimensions(layer.geometries[0])) if len(layer) else 2
+
+# Function to turn "2000 Meters" style distances into map units
+def parse_distance(distance):
+    if isinstance(distance, str):
+        parts = distance.split()
+        value = float(parts[0])
+        if len(parts) > 1:
+            value *= linear_units.get(parts[1].lower(), 1.0)
+        return value
+    return distance
+
+# Function to save a Layer as WKB plus one array per attribute in a .npz file (a Grid as its array, corner and cell size)
+def write_npz(layer, path):
+    if isinstance(layer, Grid):
+        np.savez(path, grid=layer.array, corner=np.array(layer.corner), cell_size=np.array(layer.cell_size))
+        return path
+    wkb = shapely.to_wkb(layer.geometries)
+    offsets = np.concatenate([[0], np.cumsum([len(w) for w in wkb])]).astype(np.int64)
+    arrays = dict(("attr_" + k, plain_array(v)) for k, v in layer.attributes.items())
+    np.savez(path, wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8), offsets=offsets, **arrays)
+    return path
+
+# Function to turn an object column (with None in it) into a float or text array that np.savez can store
+def plain_array(values):
+    if values.dtype != object:
+        return values
+    present = [v for v in values.tolist() if v is not None]
+    if all(isinstance(v, (int, float)) for v in present):
+        return np.array([np.nan if v is None else v for v in values.tolist()], dtype=np.float64)
+    return np.array(["" if v is None else str(v) for v in values.tolist()])
+
+def read_npz(path):
+    with np.load(path) as data:
+        if "grid" in data.files:
+            return Grid(data["grid"], data["corner"].tolist(), float(data["cell_size"]))
+        wkb, offsets = data["wkb"], data["offsets"]
+        geometries = shapely.from_wkb([wkb[offsets[n]:offsets[n + 1]].tobytes() for n in range(len(offsets) - 1)])
+        return Layer(geometries, dict((k[5:], data[k]) for k in data.files if k.startswith("attr_")))
+
+# Function to read a GeoJSON FeatureCollection into a Layer
+def read_geojson(path):
+    with open(path) as f:
+        collection = json.load(f)
+    features = collection.get("features", [])
+    geometries = [shapely.from_geojson(json.dumps(feature["geometry"])) for feature in features]
+    fields = []
+    for feature in features:
+        for k in (feature.get("properties") or {}):
+            if k not in fields:
+                fields.append(k)
+    attributes = dict((k, [(feature.get("properties") or {}).get(k) for feature in features]) for k in fields)
+    return Layer(geometries, attributes)
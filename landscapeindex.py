@@ -0,0 +1,225 @@
+# Persistent grid index for the landscape VRI/CWH layer used by forestiinfluencetool
+# built once into a sidecar folder next to the data and reused by every later run
+#
+# The sidecar (<dataset>.mosaicidx) holds
+#   meta.json          source, its modification time, grid origin/cell size, fields
+#   bounds.npy         xmin, ymin, xmax, ymax per polygon
+#   wkb.bin            all geometries as WKB, back to back, offsets.npy says where each starts
+#   cell_start.npy     for every grid cell, where its polygon ids start in cell_ids.npy
+#   cell_ids.npy       polygon ids per grid cell (a polygon is listed in every cell its box touches)
+#   attr_<field>.npy   one array per attribute field
+# Everything is opened memory-mapped, so a query only pages in the grid cells, boxes and
+# geometries it touches - the run time depends on the size of the ring, not of the layer.
+# The sidecar is rebuilt when the source dataset has changed. The modification time stored in
+# meta.json is checked first; a feature class in a file geodatabase goes by the whole geodatabase,
+# so when that time has moved the index also compares a content stamp (feature count, areas and
+# the indexed attributes, see source_stamp) and only rebuilds when the stamp differs as well.
+
+import os, json, shutil, hashlib
+import numpy as np
+import shapely
+import commonstuff as cs
+import geometrybackend as gb
+
+index_suffix = ".mosaicidx"
+index_version = 1
+features_per_cell = 16  # aim for about this many polygons per grid cell
+
+
+# Function to work out where the sidecar of a dataset goes
+# feature classes in a geodatabase get theirs beside the .gdb folder, not inside it
+def index_path(dataset):
+    dataset = os.path.normpath(str(dataset))
+    parent, name = os.path.split(dataset)
+    if parent.lower().endswith(".gdb"):
+        parent, gdb = os.path.split(parent)
+        name = gdb + "." + name
+    return os.path.join(parent, name + index_suffix)
+
+# Function to open the index of a dataset, building it first if it is missing or out of date
+def open_index(dataset, fields, cell_size=None):
+    path = index_path(dataset)
+    modified = gb.get_backend().modified(dataset)
+    meta_file = os.path.join(path, "meta.json")
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("version") == index_version and all(field in meta["fields"] for field in fields):
+            if meta.get("source_modified") == modified:
+                return LandscapeIndex(path)
+            if meta.get("source_stamp") == source_stamp(dataset, meta["fields"]):
+                # something else in the geodatabase changed, not this dataset
+                meta["source_modified"] = modified
+                write_meta(path, meta)
+                return LandscapeIndex(path)
+        cs.writelog("Landscape index at " + path + " is out of date, rebuilding")
+    build_index(dataset, fields, path, cell_size)
+    return LandscapeIndex(path)
+
+# Function to build the sidecar index of a dataset
+# nulls become 0 in numeric fields and "" in text fields
+def build_index(dataset, fields, path=None, cell_size=None):
+    backend = gb.get_backend()
+    path = path or index_path(dataset)
+    layer = backend.read_geometries(dataset, fields)
+    geometries = layer.geometries
+    bounds = shapely.bounds(geometries)
+    count = len(geometries)
+
+    # grid over the full extent of the layer
+    xmin, ymin = bounds[:, 0].min(), bounds[:, 1].min()
+    xmax, ymax = bounds[:, 2].max(), bounds[:, 3].max()
+    if cell_size is None:
+        cell_size = max(np.sqrt((xmax - xmin) * (ymax - ymin) * features_per_cell / max(count, 1)), 1.0)
+    ncols = int(np.floor((xmax - xmin) / cell_size)) + 1
+    nrows = int(np.floor((ymax - ymin) / cell_size)) + 1
+
+    # every polygon goes into each cell its bounding box touches
+    c0 = ((bounds[:, 0] - xmin) // cell_size).astype(np.int64)
+    c1 = ((bounds[:, 2] - xmin) // cell_size).astype(np.int64)
+    r0 = ((bounds[:, 1] - ymin) // cell_size).astype(np.int64)
+    r1 = ((bounds[:, 3] - ymin) // cell_size).astype(np.int64)
+    widths, heights = c1 - c0 + 1, r1 - r0 + 1
+    per_feature = widths * heights
+    ids = np.repeat(np.arange(count, dtype=np.int64), per_feature)
+    step = np.arange(ids.size, dtype=np.int64) - np.repeat(np.cumsum(per_feature) - per_feature, per_feature)
+    cells = (r0[ids] + step // widths[ids]) * ncols + c0[ids] + step % widths[ids]
+    order = np.argsort(cells, kind="stable")
+    cell_ids = ids[order]
+    cell_start = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=ncols * nrows))]).astype(np.int64)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.concatenate([[0], np.cumsum([len(w) for w in wkb])]).astype(np.int64)
+    with open(os.path.join(path, "wkb.bin"), "wb") as f:
+        for w in wkb:
+            f.write(w)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "bounds.npy"), bounds)
+    np.save(os.path.join(path, "cell_start.npy"), cell_start)
+    np.save(os.path.join(path, "cell_ids.npy"), cell_ids)
+    for field in fields:
+        values = layer.attributes[field]
+        if values.dtype == object:
+            values = fill_nulls(values)
+        np.save(os.path.join(path, "attr_" + field + ".npy"), values)
+
+    meta = {
+        "version": index_version,
+        "source": str(dataset),
+        "source_modified": backend.modified(dataset),
+        "source_stamp": source_stamp(dataset, fields),
+        "count": count,
+        "fields": list(fields),
+        "origin": [float(xmin), float(ymin)],
+        "cell_size": float(cell_size),
+        "ncols": ncols,
+        "nrows": nrows
+    }
+    # meta.json goes last, a half written index never looks valid
+    write_meta(path, meta)
+    cs.writelog("Built landscape index for " + str(count) + " polygons at " + path)
+    return path
+
+# Function to write meta.json in one step, readers never see half of it
+def write_meta(path, meta):
+    temp = os.path.join(path, "meta.json." + str(os.getpid()) + ".tmp")
+    with open(temp, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp, os.path.join(path, "meta.json"))
+
+# Function to work out a content stamp of the source - a hash of the feature count, the feature
+# areas and the indexed attribute columns. Geometries aren't decoded on the arcpy backend, so it
+# costs a small part of a rebuild.
+def source_stamp(dataset, fields):
+    backend = gb.get_backend()
+    if backend.name == "shapely":
+        columns = backend.read_columns(dataset, ["SHAPE@AREA"] + list(fields))
+        areas = columns["SHAPE@AREA"]
+        values = [columns[field].tolist() for field in fields]
+    else:
+        # a cursor rather than read_columns, so nulls need no fill value
+        import arcpy
+        rows = list(arcpy.da.SearchCursor(dataset, ["SHAPE@AREA"] + list(fields)))
+        areas = [row[0] for row in rows]
+        values = [[row[i + 1] for row in rows] for i in range(len(fields))]
+    digest = hashlib.sha1()
+    digest.update(str(len(areas)).encode("utf-8"))
+    digest.update(np.round(np.asarray(areas, dtype=np.float64), 3).tobytes())
+    for field, column in zip(fields, values):
+        digest.update(field.encode("utf-8"))
+        digest.update(repr(column).encode("utf-8"))
+    return digest.hexdigest()
+
+# Function to swap None for 0 or "" in an object column so it can be saved as a plain array
+def fill_nulls(values):
+    present = [v for v in values.tolist() if v is not None]
+    fill = "" if present and isinstance(present[0], str) else 0
+    return np.array([fill if v is None else v for v in values.tolist()])
+
+
+class LandscapeIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.cell_size = self.meta["cell_size"]
+        self.origin = self.meta["origin"]
+        self.ncols, self.nrows = self.meta["ncols"], self.meta["nrows"]
+        self.bounds = np.load(os.path.join(path, "bounds.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.cell_start = np.load(os.path.join(path, "cell_start.npy"), mmap_mode="r")
+        self.cell_ids = np.load(os.path.join(path, "cell_ids.npy"), mmap_mode="r")
+        self.wkb = np.memmap(os.path.join(path, "wkb.bin"), dtype=np.uint8, mode="r") if self.offsets[-1] else np.zeros(0, np.uint8)
+        self.attributes = dict((field, np.load(os.path.join(path, "attr_" + field + ".npy"), mmap_mode="r"))
+                               for field in self.meta["fields"])
+
+    # Function to get the ids of the polygons whose box overlaps a box
+    def query_bounds(self, xmin, ymin, xmax, ymax):
+        x0, y0 = self.origin
+        c0 = max(int((xmin - x0) // self.cell_size), 0)
+        c1 = min(int((xmax - x0) // self.cell_size), self.ncols - 1)
+        r0 = max(int((ymin - y0) // self.cell_size), 0)
+        r1 = min(int((ymax - y0) // self.cell_size), self.nrows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.zeros(0, dtype=np.int64)
+        pieces = []
+        for r in range(r0, r1 + 1):
+            # cells of one grid row are next to each other in cell_ids
+            pieces.append(self.cell_ids[self.cell_start[r * self.ncols + c0]:self.cell_start[r * self.ncols + c1 + 1]])
+        ids = np.unique(np.concatenate(pieces))
+        box = self.bounds[ids]
+        overlap = (box[:, 0] <= xmax) & (box[:, 2] >= xmin) & (box[:, 1] <= ymax) & (box[:, 3] >= ymin)
+        return ids[overlap]
+
+    # Function to decode the geometries of some polygon ids
+    def geometries(self, ids):
+        return shapely.from_wkb([self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes() for i in ids])
+
+    # Function to get the polygons that intersect a geometry, as a Layer with their attributes
+    def candidates(self, geometry):
+        ids = self.query_bounds(*shapely.bounds(geometry))
+        geometries = self.geometries(ids)
+        hit = shapely.intersects(geometries, geometry)
+        ids = ids[hit]
+        return gb.Layer(geometries[hit], dict((field, values[ids]) for field, values in self.attributes.items()))
+
+    # Function to intersect query polygons (e.g. the Immediate OM rings) with the indexed layer
+    # returns columns like read_classification_columns: SHAPE@AREA plus the indexed fields, and
+    # the query's value for every piece under value_field when values are given
+    def intersect_columns(self, geometries, values=None, value_field="SubSettingName"):
+        columns = dict((field, []) for field in ["SHAPE@AREA"] + self.meta["fields"])
+        if values is not None:
+            columns[value_field] = []
+        for n, geometry in enumerate(geometries):
+            found = self.candidates(geometry)
+            pieces = shapely.area(shapely.intersection(found.geometries, geometry))
+            columns["SHAPE@AREA"].append(pieces)
+            for field in self.meta["fields"]:
+                columns[field].append(found.attributes[field])
+            if values is not None:
+                columns[value_field].append(np.full(len(pieces), values[n]))
+        return dict((field, np.concatenate(parts) if parts else np.zeros(0)) for field, parts in columns.items())
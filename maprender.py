@@ -0,0 +1,127 @@
+# Headless map image for the forest influence report
+# draws the net harvestable area, the forest influence and the block outline straight to a PNG
+# from shapely geometries and numpy arrays - no map document, no desktop session, so it runs in
+# batch workers. Polygons are filled by testing pixel centres (shapely.contains_xy), outlines are
+# the edge pixels of the filled block, and the PNG is written with zlib, so nothing beyond numpy
+# and shapely is needed.
+#
+# style keys (see default_style): colours as (r, g, b) or (r, g, b, alpha 0-255)
+#   background, harvestable, influence, block_fill, block_outline, outline_width (pixels)
+
+import zlib, struct
+import numpy as np
+import shapely
+
+default_style = {
+    "background": (255, 255, 255),
+    "block_fill": (235, 235, 225),
+    "harvestable": (245, 222, 179),
+    "influence": (34, 139, 34, 170),
+    "block_outline": (178, 34, 34),
+    "outline_width": 2,
+}
+
+
+# Function to draw a block map and save it as a PNG
+# block, harvestable, influence - shapely geometries (or arrays of them), influence can be None
+# influence_mask - boolean array to draw instead of influence polygons (the raster engine's output),
+#                  with its top left corner mask_origin (xmin, ymax) and mask_cell_size
+# width - image width in pixels, the height follows the shape of the block unless given
+# margin - space around the block as a share of its size
+def render_block_map(output_path, block, harvestable=None, influence=None, influence_mask=None, mask_origin=None,
+                     mask_cell_size=None, width=800, height=None, margin=0.08, style=None):
+    style = dict(default_style, **(style or {}))
+    block = union(block)
+    xmin, ymin, xmax, ymax = shapely.bounds(block)
+    pad = max(xmax - xmin, ymax - ymin) * margin
+    xmin, ymin, xmax, ymax = xmin - pad, ymin - pad, xmax + pad, ymax + pad
+    pixel = (xmax - xmin) / float(width)
+    if height is None:
+        height = max(int(round((ymax - ymin) / pixel)), 1)
+    else:
+        # keep pixels square, centre the block vertically
+        ymid = (ymin + ymax) / 2.0
+        ymin, ymax = ymid - height * pixel / 2.0, ymid + height * pixel / 2.0
+    # pixel centres
+    xs = xmin + (np.arange(width) + 0.5) * pixel
+    ys = ymax - (np.arange(height) + 0.5) * pixel
+
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[:] = style["background"][:3]
+    block_mask = polygon_mask(block, xs, ys)
+    paint(image, block_mask, style["block_fill"])
+    if harvestable is not None:
+        paint(image, polygon_mask(union(harvestable), xs, ys), style["harvestable"])
+    if influence_mask is not None:
+        paint(image, sample_mask(influence_mask, mask_origin, mask_cell_size, xs, ys), style["influence"])
+    elif influence is not None:
+        paint(image, polygon_mask(union(influence), xs, ys), style["influence"])
+    paint(image, outline(block_mask, style["outline_width"]), style["block_outline"])
+    write_png(output_path, np.clip(image, 0, 255).astype(np.uint8))
+    return output_path
+
+def union(geometries):
+    if isinstance(geometries, shapely.Geometry):
+        return geometries
+    geometries = np.asarray(geometries, dtype=object)
+    return shapely.union_all(geometries) if len(geometries) else shapely.GeometryCollection()
+
+# Function to find the pixels whose centre is inside a polygon
+def polygon_mask(geometry, xs, ys):
+    if geometry.is_empty:
+        return np.zeros((len(ys), len(xs)), dtype=bool)
+    # only test the pixels inside the geometry's bounding box
+    gxmin, gymin, gxmax, gymax = geometry.bounds
+    cols = np.nonzero((xs >= gxmin) & (xs <= gxmax))[0]
+    rows = np.nonzero((ys >= gymin) & (ys <= gymax))[0]
+    mask = np.zeros((len(ys), len(xs)), dtype=bool)
+    if len(cols) and len(rows):
+        shapely.prepare(geometry)
+        gx, gy = np.meshgrid(xs[cols], ys[rows])
+        mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = shapely.contains_xy(geometry, gx, gy)
+    return mask
+
+# Function to look up a raster mask at the pixel centres (nearest cell)
+def sample_mask(mask, origin, cell_size, xs, ys):
+    mask = np.asarray(mask, dtype=bool)
+    cols = np.floor((xs - origin[0]) / cell_size).astype(np.int64)
+    rows = np.floor((origin[1] - ys) / cell_size).astype(np.int64)
+    inside_cols = (cols >= 0) & (cols < mask.shape[1])
+    inside_rows = (rows >= 0) & (rows < mask.shape[0])
+    out = np.zeros((len(ys), len(xs)), dtype=bool)
+    out[np.ix_(inside_rows, inside_cols)] = mask[np.ix_(rows[inside_rows], cols[inside_cols])]
+    return out
+
+# Function to get the edge pixels of a mask, width pixels wide
+def outline(mask, width=1):
+    inner = mask.copy()
+    for n in range(max(int(width), 1)):
+        shrunk = inner.copy()
+        shrunk[1:, :] &= inner[:-1, :]
+        shrunk[:-1, :] &= inner[1:, :]
+        shrunk[:, 1:] &= inner[:, :-1]
+        shrunk[:, :-1] &= inner[:, 1:]
+        inner = shrunk
+    return mask & ~inner
+
+# Function to colour the pixels of a mask, blending when the colour has an alpha
+def paint(image, mask, colour):
+    alpha = colour[3] / 255.0 if len(colour) > 3 else 1.0
+    image[mask] = image[mask] * (1 - alpha) + np.asarray(colour[:3], dtype=np.float32) * alpha
+
+# Function to write an RGB (or RGBA) uint8 array as a PNG
+def write_png(path, pixels):
+    height, width, channels = pixels.shape
+    colour_type = {3: 2, 4: 6}[channels]
+    # every row starts with filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), pixels.reshape(height, width * channels)], axis=1)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colour_type, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+    return path
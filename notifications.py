@@ -0,0 +1,209 @@
+# Background mail queue behind commonstuff.email
+# send() only puts the message on a queue and returns; one sender thread keeps a single SMTP
+# connection open and works through the queue, so the tools never wait on mail.
+#   - messages that fail are retried retries times, retry_delay seconds (doubling) later, then given up
+#     with a line in the log; a message waiting for its retry doesn't hold up the rest of the queue
+#   - attachments are read in chunks while the message is sent, never loaded whole
+#   - begin_digest() / end_digest() collect everything sent in between into one message,
+#     so a batch sends one mail instead of one per block
+# host and port can point at a local stand-in server for testing, e.g.
+#   python -m aiosmtpd -n -l localhost:8025   and   NotificationQueue(host="localhost", port=8025)
+
+import os, time, uuid, base64, heapq, threading, queue, smtplib, mimetypes, atexit
+from email.utils import formatdate, make_msgid
+from email.header import Header
+import commonstuff as cs
+
+chunk_size = 57 * 1024  # bytes of attachment read at a time (a multiple of 57 gives whole base64 lines)
+send_size = 64 * 1024   # bytes handed to the socket at a time
+
+
+class NotificationQueue(object):
+
+    def __init__(self, host=None, port=None, sender=None, receivers=None, bcc=None, retries=3, retry_delay=5.0,
+                 idle_timeout=60.0, debuglevel=0):
+        self.host = host or cs.mailhost
+        self.port = int(port or cs.mailport)
+        self.sender = sender or cs.sender
+        self.receivers = list(receivers if receivers is not None else cs.receiver)
+        self.bcc = list(bcc if bcc is not None else cs.bcc)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout  # close the connection after this long without mail
+        self.debuglevel = debuglevel
+        self.messages = queue.Queue()
+        self.digest = None
+        self.lock = threading.Lock()
+        self.smtp = None
+        self.sent = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.worker, name="notifications", daemon=True)
+        self.thread.start()
+
+    # Function to queue a message - filedict is path -> attachment name, like commonstuff.email
+    def send(self, subject, body, filedict=None):
+        with self.lock:
+            if self.digest is not None:
+                self.digest["parts"].append((subject, body))
+                self.digest["files"].update(filedict or {})
+                return
+        self.messages.put({"subject": subject, "body": body, "files": dict(filedict or {}), "attempt": 0, "due": 0})
+
+    # Function to start collecting messages into one digest
+    def begin_digest(self, subject):
+        with self.lock:
+            self.digest = {"subject": subject, "parts": [], "files": {}}
+
+    # Function to send the collected messages as one, with intro at the top (nothing is sent when empty)
+    def end_digest(self, intro="", filedict=None):
+        with self.lock:
+            digest, self.digest = self.digest, None
+        if digest is None or not (digest["parts"] or intro):
+            return
+        lines = [intro] if intro else []
+        lines += ["<b>" + subject + "</b><br>" + body for subject, body in digest["parts"]]
+        digest["files"].update(filedict or {})
+        self.send(digest["subject"], "<br><br>".join(lines), digest["files"])
+
+    # Function to wait until everything queued is sent (or given up), returns False on timeout
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.messages.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # messages waiting for a retry are kept in a heap by due time, the queue is read in between;
+    # a message stays an unfinished task of the queue until it is sent or given up, so flush() waits for retries
+    def worker(self):
+        waiting = []  # (due, number, message)
+        number = 0
+        while True:
+            if waiting and waiting[0][0] <= time.time():
+                message = heapq.heappop(waiting)[2]
+            else:
+                timeout = self.idle_timeout if not waiting else max(waiting[0][0] - time.time(), 0)
+                try:
+                    message = self.messages.get(timeout=timeout)
+                except queue.Empty:
+                    if not waiting:
+                        self.disconnect()
+                    continue
+            try:
+                self.deliver(message)
+                self.sent += 1
+            except Exception as e:
+                self.disconnect()
+                message["attempt"] += 1
+                if message["attempt"] <= self.retries:
+                    message["due"] = time.time() + self.retry_delay * 2 ** (message["attempt"] - 1)
+                    number += 1
+                    heapq.heappush(waiting, (message["due"], number, message))
+                    continue
+                self.failed += 1
+                cs.writelog("No email sent (" + message["subject"] + "): " + str(e))
+            self.messages.task_done()
+
+    def connect(self):
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self.disconnect()
+        self.smtp = smtplib.SMTP(self.host, self.port, timeout=60)
+        self.smtp.set_debuglevel(self.debuglevel)
+        # mail() doesn't greet the server itself, unlike sendmail()
+        self.smtp.ehlo_or_helo_if_needed()
+        return self.smtp
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    # Function to send one message, streaming the MIME text to the server a line at a time
+    def deliver(self, message):
+        smtp = self.connect()
+        recipients = self.receivers + self.bcc
+        code, reply = smtp.mail(self.sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, reply, self.sender)
+        for recipient in recipients:
+            code, reply = smtp.rcpt(recipient)
+            if code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused({recipient: (code, reply)})
+        smtp.putcmd("data")
+        code, reply = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, reply)
+        buffer = bytearray()
+        for line in mime_lines(self.sender, self.receivers, message["subject"], message["body"], message["files"]):
+            # a line starting with a dot gets a second one, see RFC 5321 4.5.2
+            buffer += (b"." + line if line.startswith(b".") else line) + b"\r\n"
+            if len(buffer) >= send_size:
+                smtp.send(bytes(buffer))
+                buffer = bytearray()
+        smtp.send(bytes(buffer) + b".\r\n")
+        code, reply = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+
+    def close(self, timeout=60):
+        self.flush(timeout)
+        self.disconnect()
+
+
+# Function to produce the lines of a multipart message, attachments are base64 encoded chunk by chunk
+# an attachment that can't be read is left out, like commonstuff.email always did
+def mime_lines(sender, receivers, subject, body, files):
+    boundary = "==" + uuid.uuid4().hex
+    for header in ["From: " + sender, "To: " + ",".join(receivers), "Subject: " + Header(subject, "utf-8").encode(),
+                   "Date: " + formatdate(localtime=True), "Message-ID: " + make_msgid(), "MIME-Version: 1.0",
+                   'Content-Type: multipart/mixed; boundary="' + boundary + '"', ""]:
+        yield header.encode("utf-8")
+    yield ("--" + boundary).encode("ascii")
+    yield b'Content-Type: text/html; charset="utf-8"'
+    yield b"Content-Transfer-Encoding: base64"
+    yield b""
+    encoded = base64.encodebytes(("<b>" + body + "</b>").encode("utf-8"))
+    for line in encoded.splitlines():
+        yield line
+    for path, name in files.items():
+        try:
+            f = open(path, "rb")
+        except OSError:
+            cs.writelog("No attachment " + str(path))
+            continue
+        with f:
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            yield ("--" + boundary).encode("ascii")
+            yield ("Content-Type: " + content_type).encode("ascii")
+            yield b"Content-Transfer-Encoding: base64"
+            yield ('Content-Disposition: attachment; filename="' + os.path.basename(name).replace('"', "") + '"').encode("utf-8")
+            yield b""
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                for line in base64.encodebytes(chunk).splitlines():
+                    yield line
+    yield ("--" + boundary + "--").encode("ascii")
+
+
+# queue used by commonstuff.email, started on first use
+shared_queue = {"queue": None}
+
+# the tool waits for the queue once, at exit, so mail queued at the end still goes out
+def default_queue():
+    if shared_queue["queue"] is None:
+        shared_queue["queue"] = NotificationQueue()
+        atexit.register(shared_queue["queue"].close)
+    return shared_queue["queue"]
@@ -0,0 +1,155 @@
+# Results of the tools per block, in a local SQLite database
+# one row per block id (the primary key, so finding a block is an index lookup however many runs
+# there have been), written with upserts - running a block again replaces its row instead of adding
+# another. Every run is recorded in the runs table (tool, start and end time, parameters, status) and
+# each result row keeps the id of the run that last wrote it.
+# Metric columns are added the first time they show up, so the forest influence and Immediate OM
+# tools can share one database. export() writes the rows to a geodatabase table for ArcGIS.
+#
+#   store = ResultStore(os.path.join(folder, "results.sqlite"))
+#   run_id = store.start_run("immediate_om", {"cwh_layer": cwh_layer})
+#   store.upsert([{"Block_ID": "B1", "Immediate_OM": 12.5}], run_id)
+#   store.finish_run(run_id)
+#   store.export(os.path.join(gdb, "Results"))
+
+import os, re, json, time, sqlite3
+import numpy as np
+import commonstuff as cs
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+key_field = "Block_ID"
+store_name = "results.sqlite"
+
+
+class ResultStore(object):
+
+    def __init__(self, path, table="results"):
+        self.path = path
+        self.table = table
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, tool TEXT, "
+                            "started REAL, finished REAL, status TEXT, parameters TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS " + quote(table) + " (" + quote(key_field) + " TEXT PRIMARY KEY, "
+                            "Run_ID INTEGER, Updated REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS " + quote(table + "_run") + " ON " + quote(table) + " (Run_ID)")
+        self.columns = self.column_types()
+
+    def column_types(self):
+        return dict((row[1], row[2]) for row in self.db.execute("PRAGMA table_info(" + quote(self.table) + ")"))
+
+    # Function to record the start of a run, returns its id
+    def start_run(self, tool, parameters=None):
+        with self.db:
+            cursor = self.db.execute("INSERT INTO runs (tool, started, status, parameters) VALUES (?, ?, ?, ?)",
+                                     (tool, time.time(), "running", json.dumps(parameters or {}, default=str)))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id, status="OK"):
+        with self.db:
+            self.db.execute("UPDATE runs SET finished = ?, status = ? WHERE run_id = ?", (time.time(), status, run_id))
+
+    # Function to insert or replace the rows of many blocks in one transaction
+    # rows = dicts with a Block_ID and any metric columns, columns missing from a row keep their stored value
+    def upsert(self, rows, run_id=None):
+        rows = [dict((field_name(k), v) for k, v in row.items()) for row in rows]
+        if not rows:
+            return 0
+        self.add_columns(rows)
+        # a column that is only ever null has no type yet, it is left out until a value shows up
+        rows = [dict((k, v) for k, v in row.items() if k in self.columns) for row in rows]
+        now = time.time()
+        # rows with the same columns go in with one statement
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(k for k in row if k != key_field)), []).append(row)
+        with self.db:
+            for fields, group in groups.items():
+                names = [key_field, "Run_ID", "Updated"] + list(fields)
+                sql = ("INSERT INTO " + quote(self.table) + " (" + ", ".join(quote(n) for n in names) + ") VALUES (" +
+                       ", ".join("?" * len(names)) + ") ON CONFLICT(" + quote(key_field) + ") DO UPDATE SET " +
+                       ", ".join(quote(n) + " = excluded." + quote(n) for n in names[1:]))
+                self.db.executemany(sql, [[str(row[key_field]), run_id, now] + [plain_value(row[f]) for f in fields] for row in group])
+        return len(rows)
+
+    def add_columns(self, rows):
+        for row in rows:
+            for name, value in row.items():
+                if name not in self.columns and value is not None:
+                    column_type = sql_type(value)
+                    with self.db:
+                        self.db.execute("ALTER TABLE " + quote(self.table) + " ADD COLUMN " + quote(name) + " " + column_type)
+                    self.columns[name] = column_type
+
+    # Function to get the row of one block as a dict, None when the block has no results
+    def get(self, block_id):
+        cursor = self.db.execute("SELECT * FROM " + quote(self.table) + " WHERE " + quote(key_field) + " = ?", (str(block_id),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([d[0] for d in cursor.description], row))
+
+    # Function to get every row (or the rows written by one run) as dicts, in block id order
+    def rows(self, run_id=None):
+        sql = "SELECT * FROM " + quote(self.table)
+        cursor = self.db.execute(sql + " WHERE Run_ID = ? ORDER BY 1" if run_id is not None else sql + " ORDER BY 1",
+                                 () if run_id is None else (run_id,))
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    # Function to write the rows to a geodatabase table (replacing it), nulls in number columns become nan / 0
+    def export(self, table_path, run_id=None):
+        rows = self.rows(run_id)
+        dtype = []
+        for name, column_type in self.columns.items():
+            if column_type == "REAL":
+                dtype.append((name, "<f8"))
+            elif column_type == "INTEGER":
+                dtype.append((name, "<i4"))
+            else:
+                width = max([len(str(row[name])) for row in rows if row[name] is not None] + [1])
+                dtype.append((name, "<U" + str(width)))
+        out = np.zeros(len(rows), dtype=dtype)
+        for i, row in enumerate(rows):
+            for name, column_type in self.columns.items():
+                value = row[name]
+                if value is None:
+                    value = np.nan if column_type == "REAL" else (0 if column_type == "INTEGER" else "")
+                out[name][i] = value
+        cs.deletelyr(table_path)
+        arcpy.da.NumPyArrayToTable(out, table_path)
+        cs.writelog("Exported " + str(len(rows)) + " results to " + table_path)
+        return table_path
+
+    def close(self):
+        self.db.close()
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# Function to turn a report key like "Harvestable area" into a column name (Harvestable_area)
+def field_name(key):
+    return re.sub(r"[^A-Za-z0-9_]", "_", str(key)).strip("_") or "value"
+
+def sql_type(value):
+    if isinstance(value, (bool, int, np.integer)):
+        return "INTEGER"
+    if isinstance(value, (float, np.floating)):
+        return "REAL"
+    return "TEXT"
+
+def plain_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value)
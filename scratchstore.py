@@ -0,0 +1,72 @@
+# Scratch workspace for pipeline intermediates
+# intermediates live in the in-memory workspace by default and never touch the disk
+# names listed in keep (or all of them with keep="ALL") go to the scratch geodatabase
+# instead, so they can be looked at after a run for debugging
+# memory is bounded by max_memory_mb: once the in-memory intermediates grow past it,
+# new intermediates spill to the scratch geodatabase
+# the geodatabase is only created the first time something has to go to disk
+# datasets are created, measured and deleted through the active geometry backend
+
+import os
+import commonstuff as cs
+import geometrybackend as gb
+
+
+class ScratchStore(object):
+
+    def __init__(self, workspace, gdb_name, keep=None, max_memory_mb=1024, in_memory=True):
+        self.workspace = workspace
+        self.gdb_name = gdb_name
+        self.gdb_path = os.path.join(workspace, gdb_name)
+        if keep == "ALL":
+            in_memory = False
+        self.keep = set(keep or []) if keep != "ALL" else set()
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.in_memory = in_memory
+        self.memory_items = {}  # name -> in-memory path
+        self.disk_items = {}    # name -> geodatabase path
+        self.sizes = {}         # in-memory path -> estimated bytes
+
+    def __str__(self):
+        return self.gdb_path
+
+    # Function to get the path an intermediate should be written to (and read back from)
+    def path(self, name):
+        if name in self.memory_items:
+            return self.memory_items[name]
+        if name in self.disk_items:
+            return self.disk_items[name]
+        if self.in_memory and name not in self.keep:
+            if self.memory_used() < self.max_memory:
+                self.memory_items[name] = gb.get_backend().memory_workspace + "\\" + name
+                return self.memory_items[name]
+            cs.writelog("Scratch memory limit reached, writing " + name + " to " + self.gdb_path)
+        self.create_gdb()
+        self.disk_items[name] = os.path.join(self.gdb_path, name)
+        return self.disk_items[name]
+
+    def create_gdb(self):
+        return gb.get_backend().create_workspace(self.workspace, self.gdb_name)
+
+    # Function to get the memory held by the in-memory intermediates, estimated from the datasets
+    # themselves (not from the process, whose memory also holds the CHM tile cache and the like)
+    def memory_used(self):
+        backend = gb.get_backend()
+        total = 0
+        for item in self.memory_items.values():
+            if item not in self.sizes and backend.exists(item):
+                self.sizes[item] = backend.size_of(item)
+            total += self.sizes.get(item, 0)
+        return total
+
+    # Function to drop one in-memory intermediate once it is no longer needed
+    def release(self, name):
+        item = self.memory_items.pop(name, None)
+        if item is not None:
+            self.sizes.pop(item, None)
+            gb.get_backend().delete(item)
+
+    # Function to drop all in-memory intermediates (disk ones are left for debugging)
+    def clear(self):
+        for name in list(self.memory_items):
+            self.release(name)
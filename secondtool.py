@@ -1,6 +1,7 @@
 import arcpy
 import os
 import csv
+import commonstuff as cs
 
 # Set workspace
 arcpy.env.workspace = "C:/projects/mosaic/MosaicForestInfluenceTool_Data/Data"
@@ -66,11 +67,9 @@ if arcpy.Exists(chm):
     arcpy.RasterToPoint_conversion(generalized_chm, chm_points, "VALUE")
 
     # Step 11.5: Add a new field called 'Height' to the CHM points
-    arcpy.AddField_management(chm_points, 'Height', 'DOUBLE')
-    with arcpy.da.UpdateCursor(chm_points, ['grid_code', 'Height']) as cursor:
-        for row in cursor:
-            row[1] = max(row[0], 0)  # Round negative values to 0
-            cursor.updateRow(row)
+    oid_field = arcpy.Describe(chm_points).OIDFieldName
+    values = cs.read_columns(chm_points, [oid_field, 'grid_code'], null_value=0)
+    cs.write_columns(chm_points, values[oid_field], {'Height': cs.clamp(values['grid_code'].astype('float64'), 0)}, oid_field)  # Round negative values to 0
 
     # Step 11: Buffer all of the extracted points by 1x the height attribute
     chm_point_buffers = os.path.join(gdb_path, "chm_point_buffers")
@@ -92,10 +91,10 @@ if arcpy.Exists(chm):
         arcpy.Append_management(buffered_single_trees, clipped_tree_height_buffers, "NO_TEST")
 
     # Step 15: Calculate the net harvestable areas and forest influence area
-    net_harvestable_area_size = sum([r[0] for r in arcpy.da.SearchCursor(net_harvestable_area, ["SHAPE@AREA"])])
-    forest_influence_area_size = sum([r[0] for r in arcpy.da.SearchCursor(clipped_tree_height_buffers, ["SHAPE@AREA"])])
-    retention_area_size = sum([r[0] for r in arcpy.da.SearchCursor(retention_areas, ["SHAPE@AREA"])])
-    non_merch_area_size = sum([r[0] for r in arcpy.da.SearchCursor(non_merch_areas, ["SHAPE@AREA"])])
+    net_harvestable_area_size = cs.sum_column(net_harvestable_area, "SHAPE@AREA")
+    forest_influence_area_size = cs.sum_column(clipped_tree_height_buffers, "SHAPE@AREA")
+    retention_area_size = cs.sum_column(retention_areas, "SHAPE@AREA")
+    non_merch_area_size = cs.sum_column(non_merch_areas, "SHAPE@AREA")
 
 
     # Step 16: Load and display the forest influence layer in the open MXD document
@@ -1,20 +1,30 @@
-import arcpy
-import arcpy.management
-import os
+try:
+    import arcpy
+    import arcpy.management
+except ImportError:  # the overlay steps can still run on the shapely geometry backend
+    arcpy = None
+import os, re
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 import commonstuff as cs
+import influenceraster as ir
+import tiledinfluence as ti
+import chmreader
+import stagetrace as st
+import stagecache
+import summaryreport
+from scratchstore import ScratchStore
+import geometrybackend as gb
 
 # from fpdf import FPDF
 
-# Function to set up workspace and geodatabase
-def setup_workspace(workspace, gdb_name):
+# Function to set up workspace and the scratch store for intermediates
+# intermediates stay in memory unless they are named in keep (or keep="ALL"),
+# those are written to the geodatabase for debugging
+def setup_workspace(workspace, gdb_name, keep=None, max_memory_mb=1024):
     arcpy.env.workspace = workspace
     arcpy.env.overwriteOutput = True
-    gdb_path = os.path.join(workspace, gdb_name)
-    if not arcpy.Exists(gdb_path):
-        arcpy.CreateFileGDB_management(workspace, gdb_name)
-    return gdb_path
+    return ScratchStore(workspace, gdb_name, keep, max_memory_mb)
 
 # Function to load input data
 def load_input_data(cutblock_path, retention_areas_path, non_merch_areas_path, tree_layer_path, chm_path, adjacent_cutblocks_path):
@@ -28,132 +38,251 @@ def load_input_data(cutblock_path, retention_areas_path, non_merch_areas_path, t
     }
 
 # Function to determine net harvestable area
-def determine_net_harvestable_area(cutblock, non_merch_areas, retention_areas, gdb_path):
-    net_harvestable_area = os.path.join(gdb_path, "net_harvestable_area")
-    temp_net_harvestable_area = os.path.join(gdb_path, "temp_net_harvestable_area")
-    arcpy.Erase_analysis(cutblock, non_merch_areas, temp_net_harvestable_area)
-    arcpy.Erase_analysis(temp_net_harvestable_area, retention_areas, net_harvestable_area)
+@st.traced()
+def determine_net_harvestable_area(cutblock, non_merch_areas, retention_areas, scratch):
+    net_harvestable_area = scratch.path("net_harvestable_area")
+    temp_net_harvestable_area = scratch.path("temp_net_harvestable_area")
+    backend = gb.get_backend()
+    backend.erase(cutblock, non_merch_areas, temp_net_harvestable_area)
+    backend.erase(temp_net_harvestable_area, retention_areas, net_harvestable_area)
     return net_harvestable_area
 
 # Function to clip optional tree layer to the cutblock boundary
-def clip_tree_layer(tree_layer, cutblock, gdb_path):
-    if arcpy.Exists(tree_layer):
-        clipped_tree_layer = os.path.join(gdb_path, "clipped_tree_layer")
-        arcpy.Clip_analysis(tree_layer, cutblock, clipped_tree_layer)
+@st.traced()
+def clip_tree_layer(tree_layer, cutblock, scratch):
+    backend = gb.get_backend()
+    if backend.exists(tree_layer):
+        clipped_tree_layer = scratch.path("clipped_tree_layer")
+        backend.clip(tree_layer, cutblock, clipped_tree_layer)
         return clipped_tree_layer
     return None
 
+# one windowed reader per CHM, they all share chmreader.shared_cache
+# (catalog path, modification time) -> reader, a CHM that changed on disk gets a new reader
+chm_readers = {}
+
+# Function to get the windowed reader of a CHM, readers of an older version of it are dropped
+def chm_reader(chm):
+    if isinstance(chm, str):
+        backend = gb.get_backend()
+        catalog_path = backend.catalog_path(chm)
+        key = (catalog_path, backend.modified(chm))
+    else:
+        # a source object like chmreader.ArraySource, already in memory
+        catalog_path, key = chm, (chm, None)
+    if key not in chm_readers:
+        for old_key in [k for k in chm_readers if k[0] == catalog_path]:
+            del chm_readers[old_key]
+        chm_readers[key] = chmreader.WindowedRasterReader(chm)
+    return chm_readers[key]
+
+# Function to read the CHM under a block plus the halo into a small raster
+# only the tiles under the window are decoded (and kept in the tile cache for the next
+# block), instead of clipping from the full CHM every time
+# with cell_size the window is aggregated onto that grid in numpy on the way (see
+# chmreader.block_reduce for the mean / max / bilinear reducers)
+def read_chm_window(chm, cutblock, scratch, halo=100, cell_size=None, reducer="bilinear"):
+    reader = chm_reader(chm)
+    xmin, ymin, xmax, ymax = gb.get_backend().bounds(cutblock)
+    xmin, ymin, xmax, ymax = xmin - halo, ymin - halo, xmax + halo, ymax + halo
+    if cell_size:
+        factor = max(int(round(cell_size / reader.cell_size)), 1)
+        window, (left, top) = reader.read_resampled(xmin, ymin, xmax, ymax, factor, reducer)
+    else:
+        factor = 1
+        window, (left, top) = reader.read_window(xmin, ymin, xmax, ymax)
+    chm_window = scratch.path("chm_window")
+    return gb.get_backend().write_raster(chm_window, gb.Grid(window, (left, top), reader.source.cell_width * factor,
+                                                              reader.source.spatial_reference))
+
+# Function to check for the CHM - a raster path, or a chmreader source like the synthetic CHM
+def chm_exists(chm):
+    return bool(chm) and (not isinstance(chm, str) or gb.get_backend().exists(chm))
+
+# PointToRaster cell assignment of the tree layer for each resample_method
+tree_cell_assignment = {"max": "MAXIMUM", "mean": "MEAN", "bilinear": "MOST_FREQUENT"}
+
 # Function to process CHM
-def process_chm_or_trees(chm, cutblock, adjacent_cutblocks,net_harvestable_area, gdb_path, tree_layer=None):
-    
-    if arcpy.Exists(tree_layer):
+# the CHM (or the tree layer) is generalized to cell_size (metres) with resample_method - mean, max or bilinear
+# the CHM branch runs on either geometry backend, the tree layer branch needs arcpy
+@st.traced(inputs=(1,))
+def process_chm_or_trees(chm, cutblock, adjacent_cutblocks,net_harvestable_area, scratch, tree_layer=None, cell_size=5, resample_method="bilinear"):
+    backend = gb.get_backend()
+    if backend.exists(tree_layer):
         cs.writelog("Tree layer exists")
 
-        tree_layer_raster = os.path.join(gdb_path, "tree_layer_raster")
-        arcpy.PointToRaster_conversion(tree_layer, "RASTERVALU", tree_layer_raster, cellsize=5)
-
-        extended_cutblock = os.path.join(gdb_path, "extended_cutblock")
+        extended_cutblock = scratch.path("extended_cutblock")
         arcpy.Buffer_analysis(cutblock, extended_cutblock, "100 Meters", "OUTSIDE_ONLY", "ROUND", "ALL", None, "PLANAR")
-        
-        clipped_chm = os.path.join(gdb_path, "clipped_chm")
-        arcpy.Clip_management(tree_layer_raster, "", clipped_chm, extended_cutblock, "", "ClippingGeometry", "MAINTAIN_EXTENT")
-        
-        # clipped_trees = os.path.join(gdb_path, "clipped_trees")
-        # arcpy.Clip_management(tree_layer_raster, "", clipped_trees, cutblock, "", "ClippingGeometry", "MAINTAIN_EXTENT")
 
+        if arcpy.Exists(adjacent_cutblocks):
+            # the adjacent cutblocks come out of the ring before the trees are clipped to it
+            temp_extended_cutblock = scratch.path("temp_extended_cutblock")
+            arcpy.Erase_analysis(extended_cutblock, adjacent_cutblocks, temp_extended_cutblock)
+            extended_cutblock = temp_extended_cutblock
 
-        # arcpy.Append_management(clipped_trees, clipped_chm, "NO_TEST")
-
+        # trees go straight onto the cell_size grid, each cell gets the tallest (max), the mean (mean)
+        # or the most common (bilinear, what the old rasterize then resample gave) height of its trees
+        tree_layer_raster = scratch.path("tree_layer_raster")
+        arcpy.PointToRaster_conversion(tree_layer, "RASTERVALU", tree_layer_raster, tree_cell_assignment[resample_method.lower()],
+                                       cellsize=cell_size)
 
-        if arcpy.Exists(adjacent_cutblocks):
-            temp_final_clipped_chm = os.path.join(gdb_path, "temp_final_clipped_chm")
-            arcpy.Erase_analysis(clipped_chm, adjacent_cutblocks, temp_final_clipped_chm)
-            clipped_chm = temp_final_clipped_chm
-            generalized_chm = os.path.join(gdb_path, "generalized_chm")
-            arcpy.Resample_management(clipped_chm, generalized_chm, "5", "BILINEAR")
-            return generalized_chm
-        
-        generalized_chm = os.path.join(gdb_path, "generalized_chm")
-        arcpy.Resample_management(clipped_chm, generalized_chm, "5", "BILINEAR")
+        generalized_chm = scratch.path("generalized_chm")
+        arcpy.Clip_management(tree_layer_raster, "", generalized_chm, extended_cutblock, "", "ClippingGeometry", "MAINTAIN_EXTENT")
 
         return generalized_chm
     
-    elif arcpy.Exists(chm):
-        buffer4m = os.path.join(gdb_path, "buffer4m")
-        extended_cutblock = os.path.join(gdb_path, "extended_cutblock")
-        arcpy.Buffer_analysis(cutblock, buffer4m, "4 Meters")
-        arcpy.Buffer_analysis(buffer4m, extended_cutblock, "96 Meters", "OUTSIDE_ONLY", "ROUND", "ALL", None, "PLANAR")
-
-        if arcpy.Exists(adjacent_cutblocks):
-            # reverse the current selection of cutblock
-            arcpy.SelectLayerByAttribute_management(cutblock, "SWITCH_SELECTION")
-            # clip the extended cutblock with the adjacent cutblocks
-            temp_extended_cutblock = os.path.join(gdb_path, "temp_extended_cutblock")
-            arcpy.Erase_analysis(extended_cutblock, cutblock, temp_extended_cutblock)
+    elif chm_exists(chm):
+        buffer4m = scratch.path("buffer4m")
+        extended_cutblock = scratch.path("extended_cutblock")
+        backend.buffer(cutblock, buffer4m, "4 Meters")
+        backend.buffer(buffer4m, extended_cutblock, "96 Meters", "OUTSIDE_ONLY", "ALL")
+
+        if backend.exists(adjacent_cutblocks):
+            temp_extended_cutblock = scratch.path("temp_extended_cutblock")
+            if backend.name == "arcpy":
+                # reverse the current selection of cutblock
+                arcpy.SelectLayerByAttribute_management(cutblock, "SWITCH_SELECTION")
+                # clip the extended cutblock with the adjacent cutblocks
+                backend.erase(extended_cutblock, cutblock, temp_extended_cutblock)
+                # reverse the selection back
+                arcpy.SelectLayerByAttribute_management(cutblock, "SWITCH_SELECTION")
+            else:
+                # no layer selections on the shapely backend, the adjacent cutblocks are erased as they are
+                backend.erase(extended_cutblock, adjacent_cutblocks, temp_extended_cutblock)
             extended_cutblock = temp_extended_cutblock
-            # reverse the selection back
-            arcpy.SelectLayerByAttribute_management(cutblock, "SWITCH_SELECTION")
 
         
-        clipped_chm = os.path.join(gdb_path, "clipped_chm")
-        arcpy.Clip_management(chm, "", clipped_chm, extended_cutblock, "", "ClippingGeometry", "MAINTAIN_EXTENT")
+        # window already generalized in numpy, no Resample_management round trip
+        chm_window = read_chm_window(chm, cutblock, scratch, cell_size=cell_size, reducer=resample_method)
         
         # if arcpy.Exists(adjacent_cutblocks):
-        #     temp_final_clipped_chm = os.path.join(gdb_path, "temp_final_clipped_chm")
+        #     temp_final_clipped_chm = scratch.path("temp_final_clipped_chm")
         #     arcpy.Clip_management(clipped_chm, "", temp_final_clipped_chm, adjacent_cutblocks, "", "ClippingGeometry", "MAINTAIN_EXTENT")            
         #     clipped_chm = temp_final_clipped_chm
         
-        generalized_chm = os.path.join(gdb_path, "generalized_chm")
-        arcpy.Resample_management(clipped_chm, generalized_chm, "5", "BILINEAR")
+        generalized_chm = scratch.path("generalized_chm")
+        backend.clip_raster(chm_window, extended_cutblock, generalized_chm)
         
         return generalized_chm
     return None
 
 # Function to convert CHM to points and process heights
-def convert_chm_to_points(generalized_chm, gdb_path):
-    chm_points = os.path.join(gdb_path, "chm_points")
-    arcpy.RasterToPoint_conversion(generalized_chm, chm_points, "VALUE")
+@st.traced()
+def convert_chm_to_points(generalized_chm, scratch):
+    backend = gb.get_backend()
+    chm_points = backend.raster_to_points(generalized_chm, scratch.path("chm_points"))
     
-    arcpy.AddField_management(chm_points, 'Height', 'DOUBLE')
-    with arcpy.da.UpdateCursor(chm_points, ['grid_code', 'Height']) as cursor:
-        for row in cursor:
-            row[1] = max(row[0], 0)  # Round negative values to 0
-            cursor.updateRow(row)
+    # Height field = grid_code with negative values rounded to 0, written in one pass
+    values = backend.read_columns(chm_points, ['grid_code'], null_value=0)
+    backend.write_columns(chm_points, {'Height': cs.clamp(values['grid_code'].astype('float64'), 0)})
     
     return chm_points
 
 # Function to buffer points and merge into tree height buffers
-def buffer_and_merge_points(chm_points, gdb_path):
-    tree_height_buffers = os.path.join(gdb_path, "tree_height_buffers")
-    arcpy.Buffer_analysis(chm_points, tree_height_buffers, "Height", "FULL", "ROUND", "ALL", None, "PLANAR")
+@st.traced()
+def buffer_and_merge_points(chm_points, scratch):
+    tree_height_buffers = scratch.path("tree_height_buffers")
+    gb.get_backend().buffer(chm_points, tree_height_buffers, "Height", "FULL", "ALL")
     
     return tree_height_buffers
 
 # Function to clip tree height buffers to net harvestable area
-def clip_tree_height_buffers(tree_height_buffers, net_harvestable_area, gdb_path):
-    clipped_tree_height_buffers = os.path.join(gdb_path, "clipped_tree_height_buffers")
-    arcpy.Clip_analysis(tree_height_buffers, net_harvestable_area, clipped_tree_height_buffers)
+@st.traced()
+def clip_tree_height_buffers(tree_height_buffers, net_harvestable_area, scratch):
+    clipped_tree_height_buffers = scratch.path("clipped_tree_height_buffers")
+    gb.get_backend().clip(tree_height_buffers, net_harvestable_area, clipped_tree_height_buffers)
     return clipped_tree_height_buffers
 
+# Function to compute the forest influence straight from the generalized CHM raster
+# alternative to convert_chm_to_points / buffer_and_merge_points / clip_tree_height_buffers,
+# see influenceraster for how the mask is built and how close it is to the polygon answer
+# (subdivide=5 - 1 m pixels on the 5 m CHM - keeps it within 0.8%, subdivide=1 can be several % off)
+@st.traced()
+def calculate_forest_influence_raster(generalized_chm, net_harvestable_area, scratch, subdivide=5):
+    backend = gb.get_backend()
+    chm = backend.read_raster(generalized_chm)
+    pixel_size = chm.cell_size / float(subdivide)
+    nrows, ncols = chm.array.shape[0] * subdivide, chm.array.shape[1] * subdivide
+
+    # rasterize the net harvestable area onto the output grid
+    harvest_mask = backend.rasterize(net_harvestable_area, scratch.path("net_harvestable_area_raster"), chm.corner, nrows, ncols,
+                                     pixel_size, snap_raster=generalized_chm)
+
+    forest_influence_area_size, influence = ir.forest_influence_area(chm.array, chm.cell_size, harvest_mask, subdivide)
+
+    # keep the mask as a raster so it can go on the map like the buffers do
+    forest_influence_raster = backend.write_raster(scratch.path("forest_influence_raster"),
+                                                   gb.Grid(influence.astype("uint8"), chm.corner, pixel_size, chm.spatial_reference))
+    return forest_influence_raster, forest_influence_area_size
+
+# Function to compute the forest influence of many blocks at once from the CHM, in tiles (see tiledinfluence)
+# - for whole operating areas, where one block at a time through calculate_forest_influence_raster would
+# read the same CHM over and over; processes above 1 spreads the tiles over a process pool
+# net_harvestable_area holds the harvestable area of every block, block_field tells them apart; the CHM
+# sources are the ring around cutblocks (around the net harvestable area when left out), as in process_chm_or_trees
+# subdivide - output pixels per generalized cell along each axis, as in calculate_forest_influence_raster
+# returns a dict of block id -> {"harvestable": area, "influence": area}
+@st.traced(inputs=(1,))
+def calculate_forest_influence_tiled(chm, net_harvestable_area, block_field="SubSettingName", cell_size=5, resample_method="bilinear",
+                                     processes=1, tile_size=256, cutblocks=None, subdivide=5):
+    reader = chm_reader(chm)
+    factor = max(int(round(cell_size / reader.cell_size)), 1)
+    labels = ti.PolygonLabels.from_dataset(net_harvestable_area, block_field)
+    sources = ti.SourceRing.from_dataset(cutblocks or net_harvestable_area)
+    if processes and processes > 1:
+        return ti.parallel_tiled_influence(reader, labels, tile_size, factor, resample_method, subdivide, processes=processes,
+                                           sources=sources)
+    return ti.tiled_influence(reader, labels, tile_size, factor, resample_method, subdivide, sources=sources)
+
 # Function to buffer and add single trees
-def buffer_and_add_single_trees(cutblock, single_trees, clipped_tree_height_buffers, gdb_path):
+@st.traced(inputs=(1,))
+def buffer_and_add_single_trees(cutblock, single_trees, clipped_tree_height_buffers, scratch):
     if arcpy.Exists(single_trees):
         # clip single trees to the cutblock
-        clipped_single_trees = os.path.join(gdb_path, "clipped_single_trees")
+        clipped_single_trees = scratch.path("clipped_single_trees")
         arcpy.Clip_analysis(single_trees, cutblock, clipped_single_trees)
-        buffered_single_trees = os.path.join(gdb_path, "buffered_single_trees")
-        unioned_trees = os.path.join(gdb_path, "unioned_trees")
+        buffered_single_trees = scratch.path("buffered_single_trees")
+        unioned_trees = scratch.path("unioned_trees")
         arcpy.Buffer_analysis(clipped_single_trees, buffered_single_trees, "RASTERVALU", "OUTSIDE_ONLY", "ROUND", "ALL", None, "PLANAR")
         arcpy.Union_analysis([buffered_single_trees, clipped_tree_height_buffers], unioned_trees)
         # arcpy.Append_management(buffered_single_trees, clipped_tree_height_buffers, "NO_TEST")
 
-# Function to calculate areas
-def calculate_areas(net_harvestable_area, clipped_tree_height_buffers, retention_areas, non_merch_areas):
-    net_harvestable_area_size = sum([r[0] for r in arcpy.da.SearchCursor(net_harvestable_area, ["SHAPE@AREA"])])
-    forest_influence_area_size = sum([r[0] for r in arcpy.da.SearchCursor(clipped_tree_height_buffers, ["SHAPE@AREA"])])
-    retention_area_size = sum([r[0] for r in arcpy.da.SearchCursor(retention_areas, ["SHAPE@AREA"])])
-    non_merch_area_size = sum([r[0] for r in arcpy.da.SearchCursor(non_merch_areas, ["SHAPE@AREA"])])
-    return net_harvestable_area_size, forest_influence_area_size, retention_area_size, non_merch_area_size
+# cached retention / non merch area per block, see static_layer_totals
+static_area_cache = {}
+
+# Function to get the area of a static layer (retention, non merch) inside every block
+# worked out once for all blocks of the cutblock dataset (not just the selected one) and
+# cached until either dataset changes, so a batch doesn't re-read the layer for every block
+def static_layer_totals(cutblocks, block_field, layer):
+    backend = gb.get_backend()
+    if not backend.exists(layer):
+        return {}
+    cutblocks = backend.catalog_path(cutblocks)
+    key = (cutblocks, block_field, backend.catalog_path(layer), backend.modified(cutblocks), backend.modified(layer))
+    if key not in static_area_cache:
+        static_area_cache[key] = backend.tabulate_area(cutblocks, block_field, layer)
+    return static_area_cache[key]
+
+# Function to calculate the areas of one block
+# retention and non merch only count inside the block, static_areas can hand in totals
+# that were already worked out for the whole batch ({"retention": .., "non_merch": ..});
+# without them only the selected block is tabulated, not every block of the cutblock dataset
+# gross, harvestable and influence are one sum_area each, over datasets that only hold this block
+@st.traced(inputs=())
+def calculate_areas(cutblock, block_id, net_harvestable_area, clipped_tree_height_buffers, retention_areas, non_merch_areas,
+                    block_field="SubSettingName", static_areas=None):
+    backend = gb.get_backend()
+    if static_areas is None:
+        static_areas = {}
+        for name, layer in (("retention", retention_areas), ("non_merch", non_merch_areas)):
+            static_areas[name] = backend.tabulate_area(cutblock, block_field, layer).get(block_id, 0) if backend.exists(layer) else 0
+    return {
+        "gross": backend.sum_area(cutblock),
+        "retention": static_areas["retention"],
+        "non_merch": static_areas["non_merch"],
+        "harvestable": backend.sum_area(net_harvestable_area),
+        "influence": backend.sum_area(clipped_tree_height_buffers) if clipped_tree_height_buffers else 0
+    }
 
 def create_output_image(clipped_tree_height_buffers, output_image_path):
     # Step 17: Load and display the forest influence layer in the open MXD document
@@ -170,15 +299,33 @@ def create_output_image(clipped_tree_height_buffers, output_image_path):
     arcpy.mapping.ExportToPNG(mxd, output_image_path)
     return output_image_path
 
+# Function to draw the block map without a map document (see maprender), so it also runs in batch workers
+# influence - the clipped tree height buffers, or the forest influence raster of the raster engine
+@st.traced(inputs=())
+def create_headless_image(cutblock, net_harvestable_area, influence, output_image_path, width=800, style=None):
+    import maprender  # needs shapely, the map document route doesn't
+    backend = gb.get_backend()
+    block = backend.read_geometries(cutblock).geometries
+    harvestable = backend.read_geometries(net_harvestable_area).geometries
+    if influence and backend.exists(influence) and backend.is_raster(influence):
+        raster = backend.read_raster(influence)
+        return maprender.render_block_map(output_image_path, block, harvestable, influence_mask=raster.array > 0,
+                                          mask_origin=raster.corner, mask_cell_size=raster.cell_size, width=width, style=style)
+    influence = backend.read_geometries(influence).geometries if influence and backend.exists(influence) else None
+    return maprender.render_block_map(output_image_path, block, harvestable, influence, width=width, style=style)
+
 # Function to generate report dictionary
-def generate_report_dict(block_id, net_harvestable_area_size, forest_influence_area_size, retention_area_size, non_merch_area_size, single_trees, output_image):
+# gross_area defaults to harvestable + retention + non merch when the block area isn't known
+def generate_report_dict(block_id, net_harvestable_area_size, forest_influence_area_size, retention_area_size, non_merch_area_size, single_trees, output_image, gross_area_size=None):
+    if gross_area_size is None:
+        gross_area_size = net_harvestable_area_size + retention_area_size + non_merch_area_size
     report = {
         "Block ID": block_id,
-        "Block gross area": net_harvestable_area_size + retention_area_size + non_merch_area_size,
+        "Block gross area": gross_area_size,
         "Retention area": retention_area_size,
         "Non merch/non forest area": non_merch_area_size,
         "Harvestable area": net_harvestable_area_size,
-        "Number of single trees": arcpy.GetCount_management(single_trees).getOutput(0) if arcpy.Exists(single_trees) else 0,
+        "Number of single trees": gb.get_backend().count(single_trees) if gb.get_backend().exists(single_trees) else 0,
         "Area of Forest Influence": forest_influence_area_size,
         "Percent harvestable area covered by Forest Influence": (forest_influence_area_size / net_harvestable_area_size) * 100,
         "Forest Influence Threshold Message": "Forest influence is greater than 50%" if (forest_influence_area_size / net_harvestable_area_size) * 100 > 50 else "Forest influence is less than 50%",
@@ -187,6 +334,8 @@ def generate_report_dict(block_id, net_harvestable_area_size, forest_influence_a
     return report
 
 # Function to generate PDF report using ReportLab
+# the map goes in as the downsampled report image (made once per map), at its own shape
+@st.traced(inputs=())
 def generate_pdf_report_reportlab(report, output_path):
     c = canvas.Canvas(output_path, pagesize=letter)
     width, height = letter
@@ -198,16 +347,107 @@ def generate_pdf_report_reportlab(report, output_path):
     y_position = height - 80
     for key, value in report.items():
         if key == "Map Image":
+            if not value:
+                continue
             c.drawString(100, y_position, "{key}:".format(key=key))
             y_position -= 20
-            c.drawImage(value, 100, y_position - 200, width=400, height=200)
-            y_position -= 220
+            c.drawImage(summaryreport.report_image(value) or value, 100, y_position - 300, width=400, height=300,
+                        preserveAspectRatio=True, anchor="n")
+            y_position -= 320
         else:
             c.drawString(100, y_position, "{key}: {value}".format(key=key, value=value))
             y_position -= 20
 
     c.save()
 
+# Function to run all steps for one block and return its report dictionary
+# cutblock is a layer with the block selected (adjacent blocks are found by switching the selection),
+# render_map=False skips the map image, map_renderer picks HEADLESS (maprender) or MXD (the open map document,
+# needs an ArcMap session)
+# keep_intermediates - intermediate names to write to the geodatabase for debugging ("ALL" for every one)
+# clear_scratch=True drops the in-memory intermediates once the report is written
+# stage_cache - a stagecache.StageCache to reuse net harvestable area, generalized CHM, CHM points
+# and tree height buffers from earlier runs on the same inputs
+def process_block(cutblock, retention_areas, non_merch_areas, tree_layer, chm, adjacent_cutblocks, workspace, gdb_name,
+                  single_trees_path, block_id, output_image_path, output_pdf_path, influence_engine="POLYGON", render_map=True,
+                  keep_intermediates=None, clear_scratch=False, static_areas=None, stage_cache=None, map_renderer="HEADLESS"):
+    cache = stage_cache or stagecache.no_cache
+
+    # Setup workspace and geodatabase
+    scratch = setup_workspace(workspace, gdb_name, keep_intermediates)
+    cs.writelog("Workspace set up, intermediates on disk go to: " + str(scratch))
+    st.set_block(block_id)
+
+    # Determine net harvestable area
+    net_harvestable_area = cache.run(determine_net_harvestable_area, "net_harvestable_area", cutblock, non_merch_areas, retention_areas, scratch)
+    cs.writelog("Net harvestable area determined")
+
+    # Clip tree layer
+    clipped_tree_layer = clip_tree_layer(tree_layer, cutblock, scratch)
+    cs.writelog("Tree layer clipped")
+
+    # Process CHM
+    generalized_chm = cache.run(process_chm_or_trees, "generalized_chm", chm, cutblock, adjacent_cutblocks, net_harvestable_area, scratch, tree_layer)
+    stats = chmreader.shared_cache.stats()
+    cs.writelog("CHM processed (tile cache: {hits} hits, {misses} misses, {tiles} tiles, {mb:.0f} MB)".format(**stats))
+
+    raster_engine = influence_engine.upper() == "RASTER"
+    if raster_engine:
+        # Influence mask straight from the CHM array - no points, buffers or dissolve
+        # (the single tree union is only drawn on the map by the polygon engine, it does not feed the areas)
+        clipped_tree_height_buffers, raster_influence_area_size = calculate_forest_influence_raster(generalized_chm, net_harvestable_area, scratch)
+        cs.writelog("Forest influence computed from the CHM raster")
+    else:
+        # Convert CHM to points and process heights
+        chm_points = cache.run(convert_chm_to_points, "chm_points", generalized_chm, scratch)
+        cs.writelog("CHM converted to points and heights processed")
+
+        # Buffer and merge points
+        tree_height_buffers = cache.run(buffer_and_merge_points, "tree_height_buffers", chm_points, scratch)
+        cs.writelog("Points buffered and merged")
+
+        # Clip tree height buffers
+        clipped_tree_height_buffers = clip_tree_height_buffers(tree_height_buffers, net_harvestable_area, scratch)
+        cs.writelog("Tree height buffers clipped")
+
+        # Buffer and add single trees
+        buffer_and_add_single_trees(cutblock, single_trees_path, clipped_tree_height_buffers, scratch)
+        cs.writelog("Single trees buffered and added")
+
+    # Calculate areas
+    areas = calculate_areas(cutblock, block_id, net_harvestable_area, None if raster_engine else clipped_tree_height_buffers,
+                            retention_areas, non_merch_areas, static_areas=static_areas)
+    net_harvestable_area_size, retention_area_size, non_merch_area_size = areas["harvestable"], areas["retention"], areas["non_merch"]
+    forest_influence_area_size = raster_influence_area_size if raster_engine else areas["influence"]
+    cs.writelog("Areas calculated")
+
+    # Create the output image
+    output_image = None
+    if render_map and map_renderer.upper() == "MXD":
+        output_image = create_output_image(clipped_tree_height_buffers, output_image_path)
+        cs.writelog("Output image created")
+    elif render_map:
+        output_image = create_headless_image(cutblock, net_harvestable_area, clipped_tree_height_buffers, output_image_path)
+        cs.writelog("Output image created")
+
+    # Generate report dictionary
+    report = generate_report_dict(block_id, net_harvestable_area_size, forest_influence_area_size, retention_area_size, non_merch_area_size, single_trees_path, output_image, areas["gross"])
+
+
+    # Generate PDF report
+    generate_pdf_report_reportlab(report, output_pdf_path)
+    print("PDF report generated at:", output_pdf_path)
+
+    if stage_cache is not None:
+        cs.writelog("Stage cache: {hits} hits, {misses} misses".format(**stage_cache.stats()))
+    if clear_scratch:
+        scratch.clear()
+    return report
+
+# Function to make a block id safe to use in a file or folder name
+def block_file_name(block_id):
+    return re.sub(r"[^A-Za-z0-9_\-]", "_", str(block_id)) or "block"
+
 # Main function to run all steps
 def main():
     # Define paths
@@ -235,14 +475,13 @@ def main():
     gdb_name = "temp1.gdb"
 
     single_trees_path = arcpy.GetParameterAsText(7)  # Optional
+    influence_engine = arcpy.GetParameterAsText(8) or "POLYGON"  # Optional - POLYGON or RASTER
+    keep_intermediates = arcpy.GetParameterAsText(9)  # Optional - intermediates to write to disk, ; separated or ALL
+    keep_intermediates = keep_intermediates if keep_intermediates in ("", "ALL") else keep_intermediates.split(";")
+    stage_cache_folder = arcpy.GetParameterAsText(10)  # Optional - folder to cache stage outputs in between runs
+    stage_cache = stagecache.StageCache(stage_cache_folder) if stage_cache_folder else None
+    map_renderer = arcpy.GetParameterAsText(11) or "HEADLESS"  # Optional - HEADLESS or MXD
     block_id = "your_block_id"
-    output_image_path = "C:/projects/mosaic/MosaicForestInfluenceTool_Data/Data/forest_influence_map.png"
-    output_pdf_path = "C:/projects/mosaic/MosaicForestInfluenceTool_Data/Data/report.pdf"
-
-
-    # Setup workspace and geodatabase
-    gdb_path = setup_workspace(workspace, gdb_name)
-    cs.writelog("Workspace and geodatabase set up at:", gdb_path)
 
     # Get block id with search cursor
     with arcpy.da.SearchCursor(cutblock, ["SubSettingName"]) as cursor:
@@ -250,50 +489,20 @@ def main():
             block_id = row[0]
             break
 
-        
-    # Determine net harvestable area
-    net_harvestable_area = determine_net_harvestable_area(cutblock, non_merch_areas, retention_areas, gdb_path)
-    cs.writelog("Net harvestable area determined")
-
-    # Clip tree layer
-    clipped_tree_layer = clip_tree_layer(tree_layer, cutblock, gdb_path)
-    cs.writelog("Tree layer clipped")
-
-    # Process CHM
-    generalized_chm = process_chm_or_trees(chm, cutblock, adjacent_cutblocks, net_harvestable_area, gdb_path, tree_layer)
-    cs.writelog("CHM processed")
-
-    # Convert CHM to points and process heights
-    chm_points = convert_chm_to_points(generalized_chm, gdb_path)
-    cs.writelog("CHM converted to points and heights processed")
-
-    # Buffer and merge points
-    tree_height_buffers = buffer_and_merge_points(chm_points, gdb_path)
-    cs.writelog("Points buffered and merged")
-
-    # Clip tree height buffers
-    clipped_tree_height_buffers = clip_tree_height_buffers(tree_height_buffers, net_harvestable_area, gdb_path)
-    cs.writelog("Tree height buffers clipped")
-
-    # Buffer and add single trees
-    buffer_and_add_single_trees(cutblock, single_trees_path, clipped_tree_height_buffers, gdb_path)
-    cs.writelog("Single trees buffered and added")
-
-    # Calculate areas
-    net_harvestable_area_size, forest_influence_area_size, retention_area_size, non_merch_area_size = calculate_areas(net_harvestable_area, clipped_tree_height_buffers, retention_areas, non_merch_areas)
-    cs.writelog("Areas calculated")
-
-    # Create the output image
-    output_image = create_output_image(clipped_tree_height_buffers, output_image_path)
-    cs.writelog("Output image created")
-
-    # Generate report dictionary
-    report = generate_report_dict(block_id, net_harvestable_area_size, forest_influence_area_size, retention_area_size, non_merch_area_size, single_trees_path, output_image)
-
-
-    # Generate PDF report
-    generate_pdf_report_reportlab(report, output_pdf_path)
-    print("PDF report generated at:", output_pdf_path)
+    # map and report are named after the block, so a run doesn't overwrite the last block's report
+    output_image_path = os.path.join(workspace, "forest_influence_map_" + block_file_name(block_id) + ".png")
+    output_pdf_path = os.path.join(workspace, "report_" + block_file_name(block_id) + ".pdf")
+
+    # stage times, counts and memory go to forest_influence_trace.json/.csv in the workspace
+    st.start_run(workspace, "forest_influence_trace")
+    try:
+        process_block(cutblock, retention_areas, non_merch_areas, tree_layer, chm, adjacent_cutblocks, workspace, gdb_name,
+                      single_trees_path, block_id, output_image_path, output_pdf_path, influence_engine,
+                      keep_intermediates=keep_intermediates, stage_cache=stage_cache, map_renderer=map_renderer)
+    finally:
+        st.finish_run()
+    if stage_cache is not None:
+        stage_cache.evict()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,233 @@
+# Cache of pipeline stage outputs, keyed by what went into them
+# a stage run through StageCache.run gets a key from its name, the fingerprints of its input
+# datasets and its other arguments. When a dataset for that key is in the cache folder it is
+# copied into the scratch workspace instead of running the stage again.
+#
+# Fingerprints
+#   input datasets   hash of the geometries (WKB) and attributes of the (selected) features;
+#                    a layer with a selection also takes in its whole dataset (the unselected
+#                    blocks matter for the adjacent cutblock erase). Whole datasets on disk are
+#                    hashed once per modification time and process (see dataset_fingerprints), so a
+#                    batch worker or the worker daemon hashes them for its first block only.
+#   rasters          catalog path, modification time, extent, cell size and size
+#   stage outputs    the key of the stage that made them, so a chain of stages costs one hash
+#                    of the inputs, not a hash of every intermediate
+#   anything else    its repr (numbers, engine names, "" for a missing optional layer)
+#
+# Entries are <folder>/stage_cache.gdb/<stage>_<key> (or <folder>/<stage>_<key>.npz for the
+# shapely backend), each with a <stage>_<key>.json next to the cache holding its size, last use
+# and the gdb it is in. evict() drops entries older than max_age_days, then the least recently
+# used ones until the cache fits in max_mb.
+#
+# Batch workers - creating tables in one file gdb from several processes at once runs into schema
+# locks, so a StageCache made with worker=True writes its new entries into a gdb of its own
+# (stage_cache_<pid>.gdb) and every process reads entries from whichever gdb the json names. The
+# parent calls prepare() before starting the workers, so they never race to create the folder or
+# the shared gdb. An entry's json is written last (and replaced in one step), so a process only
+# sees an entry once it is complete; .npz entries are written to a temporary file and renamed.
+# evict() also deletes worker gdbs no entry points to any more.
+
+import os, json, time, hashlib
+import commonstuff as cs
+import geometrybackend as gb
+from scratchstore import ScratchStore
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+cache_gdb_name = "stage_cache.gdb"
+worker_gdb_prefix = "stage_cache_"
+
+# catalog path -> (modified, hash) of datasets on disk, for every StageCache in the process
+dataset_fingerprints = {}
+
+
+class StageCache(object):
+
+    # worker - one of several processes writing to the folder at the same time, see above
+    def __init__(self, folder, max_mb=2048, max_age_days=30, worker=False):
+        self.folder = folder
+        self.gdb_name = worker_gdb_prefix + str(os.getpid()) + ".gdb" if worker else cache_gdb_name
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_age_days * 86400
+        self.produced = {}      # scratch path -> (key, backend modified value) of stage outputs
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    # Function to create the folder and the shared gdb, once in the parent before batch workers start
+    def prepare(self):
+        backend = gb.get_backend()
+        if backend.name != "shapely":
+            backend.create_workspace(self.folder, cache_gdb_name)
+        return self
+
+    # Function to run function(*args) as a cached stage whose output goes to scratch.path(output_name)
+    # the ScratchStore argument is left out of the key, keyword arguments are part of it
+    def run(self, function, output_name, *args, **kwargs):
+        backend = gb.get_backend()
+        parts = [function.__name__] + [self.fingerprint(a) for a in args if not isinstance(a, ScratchStore)]
+        parts += [k + "=" + self.fingerprint(v) for k, v in sorted(kwargs.items())]
+        key = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:20]
+        name = output_name + "_" + key
+        entry = self.entry_path(name)
+        scratch = [a for a in args if isinstance(a, ScratchStore)][0]
+        if os.path.exists(self.meta_path(name)) and backend.exists(entry):
+            self.hits += 1
+            output = backend.copy(entry, scratch.path(output_name))
+            self.touch(name)
+            cs.writelog("Stage cache hit for " + output_name)
+        else:
+            self.misses += 1
+            output = function(*args, **kwargs)
+            if output is None or not backend.exists(output):
+                return output
+            self.store(output, name)
+        self.produced[output] = (key, backend.modified(output))
+        return output
+
+    # Function to work out the fingerprint of one stage argument
+    def fingerprint(self, item):
+        backend = gb.get_backend()
+        if not isinstance(item, str) or not item or not backend.exists(item):
+            return repr(item)
+        if item in self.produced and self.produced[item][1] == backend.modified(item):
+            return "stage:" + self.produced[item][0]
+        if backend.is_raster(item):
+            return self.raster_fingerprint(item)
+        catalog_path = backend.catalog_path(item)
+        if catalog_path != item:
+            # a layer - its selection, plus the dataset under it
+            return self.content_hash(item) + ":" + self.fingerprint(catalog_path)
+        modified = backend.modified(item)
+        if modified is None:
+            return self.content_hash(item)
+        cached = dataset_fingerprints.get(item)
+        if cached is None or cached[0] != modified:
+            cached = dataset_fingerprints[item] = (modified, self.content_hash(item))
+        return cached[1]
+
+    # Function to hash the geometries and attributes of a dataset
+    def content_hash(self, dataset):
+        backend = gb.get_backend()
+        fields = [f for f in backend.field_names(dataset) if f.upper() not in ("OBJECTID", "FID", "SHAPE", "SHAPE_LENGTH", "SHAPE_AREA")]
+        if backend.name == "shapely":
+            import shapely
+            layer = backend.read_geometries(dataset, fields)
+            geometries = shapely.to_wkb(layer.geometries)
+            columns = [layer.attributes[field].tolist() for field in fields]
+        else:
+            # WKB straight from the cursor, so the arcpy backend doesn't need shapely here
+            rows = [(bytes(row[0]),) + tuple(row[1:]) for row in arcpy.da.SearchCursor(dataset, ["SHAPE@WKB"] + fields)]
+            geometries = [row[0] for row in rows]
+            columns = [[row[i + 1] for row in rows] for i in range(len(fields))]
+        digest = hashlib.sha1()
+        for wkb in geometries:
+            digest.update(wkb)
+        for field, column in zip(fields, columns):
+            digest.update(field.encode("utf-8"))
+            digest.update(repr(column).encode("utf-8"))
+        return digest.hexdigest()
+
+    def raster_fingerprint(self, raster_path):
+        backend = gb.get_backend()
+        return repr((backend.catalog_path(raster_path), backend.modified(raster_path)) + backend.raster_properties(raster_path))
+
+    # Function to get where an entry is, the gdb comes from its json (entries written before there were
+    # worker gdbs are in the shared one)
+    def entry_path(self, name, meta=None):
+        if gb.get_backend().name == "shapely":
+            return os.path.join(self.folder, name + ".npz")
+        if meta is None:
+            meta = self.read_meta(name)
+        return os.path.join(self.folder, meta.get("gdb", cache_gdb_name), name)
+
+    # Function to copy a stage output into the cache, the entry only counts once its json is there
+    def store(self, output, name):
+        backend = gb.get_backend()
+        gdb_name = None
+        if backend.name == "shapely":
+            temp = os.path.join(self.folder, name + "_" + str(os.getpid()) + ".npz")
+            gb.write_npz(backend.read(output), temp)
+            os.replace(temp, self.entry_path(name))
+        else:
+            gdb_name = self.gdb_name
+            backend.create_workspace(self.folder, gdb_name)
+            backend.copy(output, os.path.join(self.folder, gdb_name, name))
+        self.touch(name, backend.size_of(output), gdb_name)
+
+    def meta_path(self, name):
+        return os.path.join(self.folder, name + ".json")
+
+    def read_meta(self, name):
+        meta_file = self.meta_path(name)
+        if not os.path.exists(meta_file):
+            return {}
+        with open(meta_file) as f:
+            return json.load(f)
+
+    # Function to record an entry's last use (and its size and gdb when it is new)
+    # written to a temporary file and swapped in, so other processes never read half a json
+    def touch(self, name, size=None, gdb_name=None):
+        meta = self.read_meta(name)
+        meta["last_used"] = time.time()
+        meta.setdefault("created", meta["last_used"])
+        if size is not None:
+            meta["bytes"] = int(size)
+        if gdb_name is not None:
+            meta["gdb"] = gdb_name
+        temp = self.meta_path(name) + "." + str(os.getpid()) + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp, self.meta_path(name))
+
+    # Function to drop old entries, then the least recently used ones until the cache fits
+    def evict(self):
+        backend = gb.get_backend()
+        entries = []
+        for file_name in os.listdir(self.folder):
+            if file_name.endswith(".json"):
+                meta = self.read_meta(file_name[:-5])
+                entries.append((meta.get("last_used", 0), meta.get("bytes", 0), file_name[:-5], meta.get("gdb", cache_gdb_name)))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        now = time.time()
+        removed = 0
+        for last_used, size, name, gdb_name in entries:
+            if now - last_used <= self.max_age and total <= self.max_bytes:
+                break
+            backend.delete(self.entry_path(name, {"gdb": gdb_name}))
+            os.remove(self.meta_path(name))
+            total -= size
+            removed += 1
+        # worker gdbs without entries, left alone for an hour in case a worker is still writing to one
+        in_use = set(entry[3] for entry in entries[removed:])
+        for file_name in os.listdir(self.folder):
+            path = os.path.join(self.folder, file_name)
+            if (file_name.startswith(worker_gdb_prefix) and file_name.endswith(".gdb") and file_name not in in_use
+                    and now - os.path.getmtime(path) > 3600):
+                backend.delete(path)
+        if removed:
+            cs.writelog("Stage cache: removed " + str(removed) + " entries, " + str(total // 1048576) + " MB left")
+        return removed
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# stands in for a StageCache when caching is off, runs every stage
+class NoCache(object):
+
+    def run(self, function, output_name, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    def evict(self):
+        return 0
+
+    def stats(self):
+        return {"hits": 0, "misses": 0}
+
+no_cache = NoCache()
@@ -0,0 +1,152 @@
+# Per stage timing and memory for the pipelines
+# wrap a pipeline function with @traced() or a piece of code with "with stage(name):" and every
+# call records its wall time, cpu time, peak memory, input/output feature (or cell) counts and
+# the block it ran for. start_run / finish_run write the records of a run to <name>.json and
+# <name>.csv so the stages can be compared.
+#
+# Outside a run the stages only take the clock (no counts, no memory tracking), so the
+# decorators can stay on the functions at no real cost.
+# Peak memory is what python/numpy allocated during the stage (tracemalloc), the resident size
+# of the process at the end of the stage is recorded as well when psutil is available. A nested
+# stage resets the tracemalloc peak, so the peak of every open stage is kept in run_state["peaks"]
+# and the outer stage gets the larger of its own and the nested one's.
+
+import os, time, json, csv, functools, tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import commonstuff as cs
+import geometrybackend as gb
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+record_fields = ["run", "block_id", "stage", "start", "wall_s", "cpu_s", "peak_mb", "rss_mb", "input_count", "output_count", "error"]
+
+run_state = {"name": None, "folder": None, "block_id": None, "memory": False, "records": [], "peaks": []}
+
+
+# Function to start recording stages, the records go to <folder>/<name>.json and .csv on finish_run
+# memory=True tracks peak allocations, which slows python code down a little
+def start_run(folder, name="trace", memory=True):
+    run_state.update(name=name, folder=folder, block_id=None, memory=memory, records=[], peaks=[])
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+# Function to set the block the following stages run for
+def set_block(block_id):
+    run_state["block_id"] = block_id
+
+def active():
+    return run_state["name"] is not None
+
+# Function to stop recording, write the records out and return them
+def finish_run():
+    records = run_state["records"]
+    if active():
+        write_records(records, os.path.join(run_state["folder"], run_state["name"]))
+        cs.writelog(summary(records))
+    if run_state["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    run_state.update(name=None, folder=None, block_id=None, memory=False, records=[], peaks=[])
+    return records
+
+# Function to write records to <path>.json and <path>.csv
+def write_records(records, path):
+    with open(path + ".json", "w") as f:
+        json.dump(records, f, indent=2)
+    with open(path + ".csv", "w", newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, record_fields)
+        writer.writeheader()
+        writer.writerows(records)
+    return path
+
+# Function to sum the wall time per stage, slowest first, as a line for the log
+def summary(records):
+    totals = {}
+    for record in records:
+        totals[record["stage"]] = totals.get(record["stage"], 0) + record["wall_s"]
+    ordered = sorted(totals.items(), key=lambda item: -item[1])
+    return "Stage times: " + ", ".join("{0} {1:.2f}s".format(name, seconds) for name, seconds in ordered)
+
+# Function to count the features (or raster cells, or array cells) of a pipeline value
+# tuples are counted by their first item (e.g. a raster and its area), None when it can't be counted
+def count_of(item):
+    if isinstance(item, tuple):
+        item = item[0] if item else None
+    if item is None:
+        return None
+    if isinstance(item, np.ndarray):
+        return int(item.size)
+    try:
+        backend = gb.get_backend()
+        if not backend.exists(item):
+            return None
+        if arcpy is not None and arcpy.Describe(item).dataType in ("RasterDataset", "RasterBand"):
+            raster = arcpy.Raster(item)
+            return int(raster.width * raster.height)
+        return backend.count(item)
+    except Exception:
+        return None
+
+
+# Context manager around one stage, yields the record so the caller can set input_count /
+# output_count itself (output(value) counts a result for it)
+class Stage(dict):
+
+    def output(self, value):
+        if active():
+            self["output_count"] = count_of(value)
+        return value
+
+@contextmanager
+def stage(name, block_id=None, inputs=()):
+    record = Stage(run=run_state["name"], block_id=block_id if block_id is not None else run_state["block_id"], stage=name,
+                   start=time.strftime("%Y-%m-%d %H:%M:%S"), input_count=None, output_count=None, error=None)
+    tracking = active()
+    peaks = run_state["peaks"]
+    memory = tracking and run_state["memory"] and tracemalloc.is_tracing()
+    if tracking:
+        counts = [count_of(item) for item in inputs]
+        record["input_count"] = sum(c for c in counts if c is not None) if any(c is not None for c in counts) else None
+    if memory:
+        # the outer stage's peak so far, before this stage resets it
+        if peaks:
+            peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        peaks.append(0)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = str(e)
+        raise
+    finally:
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        record["peak_mb"] = None
+        if memory:
+            peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)
+            record["peak_mb"] = peak / 1048576.0
+        record["rss_mb"] = psutil.Process(os.getpid()).memory_info().rss / 1048576.0 if tracking and psutil is not None else None
+        if tracking:
+            run_state["records"].append(dict(record))
+
+# Decorator version of stage, named after the function unless a name is given
+# inputs - positions of the arguments whose features should be counted as the stage input
+def traced(name=None, inputs=(0,)):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__, inputs=[args[i] for i in inputs if i < len(args)] if active() else ()) as record:
+                return record.output(function(*args, **kwargs))
+        return wrapper
+    return decorate
@@ -0,0 +1,111 @@
+# Report images and the combined batch summary pdf
+# report_image makes a small jpeg of a block's map once and keeps it next to the map, so the block
+# pdf and the summary embed the same few hundred KB instead of the full size PNG every time
+# write_summary_pdf puts every block of a batch in one document: a totals table, a table with a
+# row per block, then a page per block with its numbers and map
+
+import os
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak
+import commonstuff as cs
+
+report_image_size = 900  # longest side of the report image in pixels
+
+# report key -> column heading and number format for the summary tables
+summary_columns = [
+    ("Block ID", "Block", "{0}"),
+    ("Block gross area", "Gross (m2)", "{0:,.0f}"),
+    ("Retention area", "Retention (m2)", "{0:,.0f}"),
+    ("Non merch/non forest area", "Non merch (m2)", "{0:,.0f}"),
+    ("Harvestable area", "Harvestable (m2)", "{0:,.0f}"),
+    ("Area of Forest Influence", "Influence (m2)", "{0:,.0f}"),
+    ("Percent harvestable area covered by Forest Influence", "Influence %", "{0:.1f}"),
+    ("Status", "Status", "{0}"),
+]
+total_keys = ["Block gross area", "Retention area", "Non merch/non forest area", "Harvestable area", "Area of Forest Influence"]
+
+
+# Function to get the downsampled jpeg of a map image, made once and reused while the map is unchanged
+def report_image(image_path, max_size=report_image_size, quality=80):
+    if not image_path or not os.path.exists(image_path):
+        return None
+    cached = os.path.splitext(image_path)[0] + "_report.jpg"
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(image_path):
+        return cached
+    from PIL import Image as PILImage
+    with PILImage.open(image_path) as picture:
+        picture = picture.convert("RGB")
+        picture.thumbnail((max_size, max_size))
+        picture.save(cached, "JPEG", quality=quality, optimize=True)
+    return cached
+
+def format_value(value, pattern):
+    if value is None or value == "":
+        return ""
+    try:
+        return pattern.format(value)
+    except (ValueError, TypeError):
+        return str(value)
+
+# Function to add up the areas of the blocks that ran, the percent is of the total harvestable area
+def summary_totals(reports):
+    done = [r for r in reports if r.get("Status", "OK") == "OK"]
+    totals = dict((key, sum(float(r.get(key) or 0) for r in done)) for key in total_keys)
+    harvestable = totals["Harvestable area"]
+    totals["Percent harvestable area covered by Forest Influence"] = totals["Area of Forest Influence"] / harvestable * 100 if harvestable else 0.0
+    totals["Blocks"] = len(reports)
+    totals["Failed"] = len(reports) - len(done)
+    return totals
+
+# Function to write the combined summary pdf of a batch
+def write_summary_pdf(reports, output_path, title="Forest Influence Summary", block_pages=True):
+    styles = getSampleStyleSheet()
+    table_style = TableStyle([
+        ("FONT", (0, 0), (-1, -1), "Helvetica", 8),
+        ("FONT", (0, 0), (-1, 0), "Helvetica-Bold", 8),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("ALIGN", (1, 1), (-2, -1), "RIGHT"),
+    ])
+    story = [Paragraph(title, styles["Title"])]
+
+    totals = summary_totals(reports)
+    story.append(Paragraph(str(totals["Blocks"]) + " blocks, " + str(totals["Failed"]) + " failed", styles["Normal"]))
+    story.append(Spacer(1, 0.2 * inch))
+    total_rows = [["Total", "Value"]] + [[heading, format_value(totals[key], pattern)] for key, heading, pattern in summary_columns
+                                         if key in totals]
+    story.append(Table(total_rows, hAlign="LEFT", style=table_style))
+    story.append(Spacer(1, 0.3 * inch))
+
+    # one row per block, the table breaks across pages and repeats its heading
+    rows = [[heading for key, heading, pattern in summary_columns]]
+    for report in reports:
+        rows.append([format_value(report.get(key), pattern)[:40] for key, heading, pattern in summary_columns])
+    story.append(Table(rows, repeatRows=1, hAlign="LEFT", style=table_style))
+
+    if block_pages:
+        for report in reports:
+            story.append(PageBreak())
+            story.append(Paragraph("Block " + str(report.get("Block ID")), styles["Heading1"]))
+            for key, value in report.items():
+                if key in ("Map Image", "Trace", "Block ID"):
+                    continue
+                story.append(Paragraph(key + ": " + str(value), styles["Normal"]))
+            image = report_image(report.get("Map Image"))
+            if image:
+                story.append(Spacer(1, 0.2 * inch))
+                story.append(fitted_image(image, 6.5 * inch, 6 * inch))
+
+    SimpleDocTemplate(output_path, pagesize=letter, title=title).build(story)
+    cs.writelog("Summary report written to " + output_path)
+    return output_path
+
+# Function to make a flowable of an image scaled to fit a box, keeping its shape
+def fitted_image(path, max_width, max_height):
+    from reportlab.lib.utils import ImageReader
+    width, height = ImageReader(path).getSize()
+    scale = min(max_width / float(width), max_height / float(height))
+    return Image(path, width=width * scale, height=height * scale)
@@ -0,0 +1,199 @@
+# Synthetic test data for the forest influence and Immediate OM tools
+# builds a made up landscape of any size - from one cutblock to thousands - with everything
+# the tools read:
+#   cutblocks         polygons with SubSettingName, laid out on a grid with forest between them
+#   retention         small patches left standing inside some blocks
+#   non_merch         patches of non merchantable ground that overlap the block edges
+#   single_trees      points inside the blocks with their height in RASTERVALU
+#   vri               a polygon mesh over the whole area plus the 2 km Immediate OM buffer,
+#                     with PROJ_AGE, BGC_ZONE and BGC_SUBZONE
+#   chm               1 m canopy height array (0 inside the blocks apart from the single trees)
+# The same seed always gives the same landscape, so timings from different runs compare.
+#
+# register() loads a landscape into the shapely geometry backend; write_geojson() / write_chm()
+# save it as GeoJSON and .npy files, and to_geodatabase() converts those for arcpy.
+
+import os, json, math
+import numpy as np
+import shapely
+import commonstuff as cs
+import geometrybackend as gb
+import chmreader
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+block_field = "SubSettingName"
+layer_names = ["cutblocks", "retention", "non_merch", "single_trees", "vri"]
+zones = [("CWH", "vm1"), ("CWH", "vm2"), ("CWH", "xm1"), ("MH", "mm1"), ("IDF", "dk1")]
+
+
+# Function to make a landscape of n_blocks cutblocks
+# block_size - rough width of a block (m), gap - forest between neighbouring blocks (m)
+# vri_size - width of the VRI polygons (m), chm_cell_size - CHM resolution (m), chm=False skips the CHM
+# returns a dict of layer name -> geometrybackend.Layer, plus "chm" -> chmreader.ArraySource
+def generate_landscape(n_blocks, seed=0, block_size=200.0, gap=120.0, vri_size=250.0, margin=2000.0,
+                       chm_cell_size=1.0, chm=True, origin=(500000.0, 5500000.0)):
+    rng = np.random.default_rng(seed)
+    per_row = int(math.ceil(math.sqrt(n_blocks)))
+    spacing = block_size + gap
+    x0, y0 = origin
+    layers = {}
+
+    # blocks - jittered polygons, one per grid position
+    rows, cols = np.divmod(np.arange(n_blocks), per_row)
+    centres = np.column_stack([x0 + margin + (cols + 0.5) * spacing, y0 + margin + (rows + 0.5) * spacing])
+    blocks = np.array([jittered_polygon(rng, cx, cy, block_size / 2.0) for cx, cy in centres], dtype=object)
+    names = np.array(["B" + str(n + 1).zfill(5) for n in range(n_blocks)])
+    layers["cutblocks"] = gb.Layer(blocks, {block_field: names})
+
+    # retention - a patch or two inside about half the blocks
+    retention = []
+    for block, (cx, cy) in zip(blocks, centres):
+        for n in range(rng.integers(0, 3)):
+            x, y = cx + rng.uniform(-0.3, 0.3) * block_size, cy + rng.uniform(-0.3, 0.3) * block_size
+            retention.append(shapely.intersection(shapely.Point(x, y).buffer(rng.uniform(8, 25)), block))
+    layers["retention"] = gb.Layer(retention)
+
+    # non merch - patches sitting across the block edge
+    non_merch = []
+    for cx, cy in centres:
+        if rng.random() < 0.6:
+            angle = rng.uniform(0, 2 * np.pi)
+            x, y = cx + math.cos(angle) * block_size / 2.0, cy + math.sin(angle) * block_size / 2.0
+            non_merch.append(jittered_polygon(rng, x, y, rng.uniform(15, 40)))
+    layers["non_merch"] = gb.Layer(non_merch)
+
+    # single trees - points scattered inside the blocks
+    points, heights = [], []
+    for block, (cx, cy) in zip(blocks, centres):
+        xy = np.column_stack([cx + rng.uniform(-0.5, 0.5, 12) * block_size, cy + rng.uniform(-0.5, 0.5, 12) * block_size])
+        inside = shapely.contains_xy(block, xy[:, 0], xy[:, 1])
+        points.extend(shapely.points(xy[inside]))
+        heights.extend(rng.uniform(15, 45, int(inside.sum())))
+    layers["single_trees"] = gb.Layer(points, {"RASTERVALU": np.array(heights, dtype=np.float64)})
+
+    # vri - a jittered mesh over the blocks and the Immediate OM buffer around them
+    width = height = per_row * spacing + 2 * margin
+    layers["vri"] = vri_mesh(rng, x0, y0, width, height, vri_size)
+
+    if chm:
+        layers["chm"] = make_chm(rng, layers, x0, y0, width, height, chm_cell_size)
+    return layers
+
+# Function to make a roughly round polygon of radius r with wobbly edges
+def jittered_polygon(rng, cx, cy, r, vertices=12):
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+    radii = r * rng.uniform(0.75, 1.15, vertices)
+    return shapely.Polygon(np.column_stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)])).buffer(0)
+
+# Function to make the VRI mesh - grid squares with their shared corners moved about
+def vri_mesh(rng, x0, y0, width, height, size):
+    ncols, nrows = int(math.ceil(width / size)), int(math.ceil(height / size))
+    gx = x0 + np.arange(ncols + 1) * size
+    gy = y0 + np.arange(nrows + 1) * size
+    xx, yy = np.meshgrid(gx, gy)
+    xx[1:-1, 1:-1] += rng.uniform(-0.3, 0.3, (nrows - 1, ncols - 1)) * size
+    yy[1:-1, 1:-1] += rng.uniform(-0.3, 0.3, (nrows - 1, ncols - 1)) * size
+    rings = np.stack([
+        np.stack([xx[:-1, :-1], yy[:-1, :-1]], -1), np.stack([xx[:-1, 1:], yy[:-1, 1:]], -1),
+        np.stack([xx[1:, 1:], yy[1:, 1:]], -1), np.stack([xx[1:, :-1], yy[1:, :-1]], -1)], axis=2).reshape(-1, 4, 2)
+    polygons = shapely.polygons(rings)
+    count = len(polygons)
+    zone = rng.integers(0, len(zones), count)
+    return gb.Layer(polygons, {
+        "PROJ_AGE": rng.gamma(3.0, 35.0, count).round(),
+        "BGC_ZONE": np.array([zones[z][0] for z in zone]),
+        "BGC_SUBZONE": np.array([zones[z][1] for z in zone])
+    })
+
+# Function to make the CHM - smooth forest heights, cleared inside the blocks, with the single trees left standing
+def make_chm(rng, layers, x0, y0, width, height, cell_size):
+    nrows, ncols = int(math.ceil(height / cell_size)), int(math.ceil(width / cell_size))
+    coarse = rng.uniform(5, 45, (nrows // 50 + 2, ncols // 50 + 2)).astype(np.float32)
+    rows = np.minimum((np.arange(nrows) * cell_size / 50.0).astype(int), coarse.shape[0] - 1)
+    cols = np.minimum((np.arange(ncols) * cell_size / 50.0).astype(int), coarse.shape[1] - 1)
+    chm = np.empty((nrows, ncols), dtype=np.float32)
+    for r in range(0, nrows, 1024):
+        # strips keep the noise array small on big landscapes
+        strip = coarse[rows[r:r + 1024]][:, cols] + rng.normal(0, 2, (min(1024, nrows - r), ncols)).astype(np.float32)
+        chm[r:r + 1024] = np.clip(strip, 0, None)
+    ymax = y0 + nrows * cell_size
+    for block in layers["cutblocks"].geometries:
+        xmin, ymin, xmax, ymax_b = shapely.bounds(block)
+        c0, c1 = int((xmin - x0) // cell_size), int(math.ceil((xmax - x0) / cell_size))
+        r0, r1 = int((ymax - ymax_b) // cell_size), int(math.ceil((ymax - ymin) / cell_size))
+        cx = x0 + (np.arange(c0, c1) + 0.5) * cell_size
+        cy = ymax - (np.arange(r0, r1) + 0.5) * cell_size
+        gx, gy = np.meshgrid(cx, cy)
+        chm[r0:r1, c0:c1][shapely.contains_xy(block, gx, gy)] = 0
+    trees = layers["single_trees"]
+    xy = shapely.get_coordinates(trees.geometries)
+    if len(xy):
+        tree_rows = ((ymax - xy[:, 1]) // cell_size).astype(int)
+        tree_cols = ((xy[:, 0] - x0) // cell_size).astype(int)
+        chm[tree_rows, tree_cols] = trees.attributes["RASTERVALU"]
+    return chmreader.ArraySource(chm, x0, ymax, cell_size, key="synthetic_chm")
+
+# Function to load a landscape into the shapely backend as <prefix><layer name> datasets
+# returns a dict of layer name -> dataset path
+def register(layers, prefix="memory\\synthetic_"):
+    backend = gb.get_backend()
+    paths = {}
+    for name in layer_names:
+        paths[name] = backend.add(prefix + name, layers[name])
+    return paths
+
+# Function to save the vector layers as <folder>/<layer>.geojson, which the shapely backend reads directly
+def write_geojson(layers, folder, names=layer_names):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    paths = {}
+    for name in names:
+        layer = layers[name]
+        features = []
+        for n, geometry in enumerate(layer.geometries):
+            properties = dict((field, values[n].item() if hasattr(values[n], "item") else values[n])
+                              for field, values in layer.attributes.items())
+            features.append({"type": "Feature", "geometry": json.loads(shapely.to_geojson(geometry)), "properties": properties})
+        paths[name] = os.path.join(folder, name + ".geojson")
+        with open(paths[name], "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+    cs.writelog("Synthetic layers written to " + folder)
+    return paths
+
+# Function to save the CHM as <folder>/chm.npy with its corner and cell size in chm.json
+def write_chm(layers, folder):
+    source = layers["chm"]
+    np.save(os.path.join(folder, "chm.npy"), source.array)
+    with open(os.path.join(folder, "chm.json"), "w") as f:
+        json.dump({"xmin": source.xmin, "ymax": source.ymax, "cell_size": source.cell_width}, f)
+    return os.path.join(folder, "chm.npy")
+
+# Function to open a saved CHM memory-mapped, as an ArraySource for chmreader
+def read_chm(folder):
+    with open(os.path.join(folder, "chm.json")) as f:
+        meta = json.load(f)
+    array = np.load(os.path.join(folder, "chm.npy"), mmap_mode="r")
+    return chmreader.ArraySource(array, meta["xmin"], meta["ymax"], meta["cell_size"], key=os.path.join(folder, "chm.npy"))
+
+# Function to convert the saved GeoJSON and CHM into a file geodatabase for the arcpy tools
+# the coordinates are treated as NAD83 / BC Albers (cs.getspatialreference())
+def to_geodatabase(folder, gdb_name="synthetic.gdb"):
+    gdb = os.path.join(folder, gdb_name)
+    if not arcpy.Exists(gdb):
+        arcpy.CreateFileGDB_management(folder, gdb_name)
+    spatial_reference = arcpy.SpatialReference(cs.getspatialreference())
+    for name in layer_names:
+        out = os.path.join(gdb, name)
+        arcpy.JSONToFeatures_conversion(os.path.join(folder, name + ".geojson"), out, "POINT" if name == "single_trees" else "POLYGON")
+        arcpy.DefineProjection_management(out, spatial_reference)
+    source = read_chm(folder)
+    lower_left = arcpy.Point(source.xmin, source.ymax - source.nrows * source.cell_height)
+    chm = os.path.join(gdb, "StandHeight1m")
+    arcpy.NumPyArrayToRaster(np.asarray(source.array), lower_left, source.cell_width, source.cell_height).save(chm)
+    arcpy.DefineProjection_management(chm, spatial_reference)
+    cs.writelog("Synthetic geodatabase written to " + gdb)
+    return gdb
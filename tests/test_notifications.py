@@ -0,0 +1,108 @@
+# Sends mail through notifications.NotificationQueue to a stand-in SMTP server on localhost
+# the server is strict the way real ones are (no MAIL before HELO/EHLO) and keeps what it receives
+
+import os, sys, time, email, threading, unittest, socketserver, tempfile
+from email.header import decode_header, make_header
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import notifications
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        greeted = False
+        self.reply("220 stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b" ")[0].upper()
+            if command in (b"EHLO", b"HELO"):
+                greeted = True
+                self.reply("250 stand-in")
+            elif command == b"MAIL":
+                self.reply("250 OK" if greeted else "503 Error: send HELO first")
+            elif command in (b"RCPT", b"NOOP", b"RSET"):
+                self.reply("250 OK")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if data_line in (b".\r\n", b""):
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                message = b"".join(lines)
+                subject = [l for l in lines if l.startswith(b"Subject:")]
+                if subject and b"reject" in subject[0]:
+                    self.reply("554 Rejected")
+                else:
+                    self.server.received.append((time.time(), message))
+                    self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("500 Unknown command")
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("localhost", 0), StandInHandler)
+        self.received = []
+
+
+class NotificationQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_queue(self, **kwargs):
+        return notifications.NotificationQueue(host="localhost", port=self.server.server_address[1], sender="tool@example.com",
+                                               receivers=["someone@example.com"], bcc=[], **kwargs)
+
+    def test_message_with_attachment_arrives_intact(self):
+        content = os.urandom(300 * 1024) + b"\r\n.line starting with a dot\r\n"
+        with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as f:
+            f.write(content)
+        try:
+            mail = self.make_queue()
+            mail.send("Block B1", "OK", {f.name: "results.bin"})
+            self.assertTrue(mail.flush(30))
+            mail.close()
+        finally:
+            os.remove(f.name)
+        self.assertEqual((mail.sent, mail.failed), (1, 0))
+        message = email.message_from_bytes(self.server.received[0][1])
+        self.assertEqual(str(make_header(decode_header(message["Subject"]))), "Block B1")
+        attachments = [part for part in message.walk() if part.get_filename() == "results.bin"]
+        self.assertEqual(attachments[0].get_payload(decode=True), content)
+
+    def test_retry_does_not_hold_up_the_queue(self):
+        mail = self.make_queue(retries=1, retry_delay=3.0)
+        started = time.time()
+        mail.send("reject", "turned away by the server")
+        mail.send("good one", "OK")
+        self.assertTrue(mail.flush(30))
+        mail.close()
+        self.assertEqual((mail.sent, mail.failed), (1, 1))
+        # the good message went out straight away, not after the bad one's retry delay
+        self.assertLess(self.server.received[0][0] - started, 2.0)
+        # and flush waited for the retry
+        self.assertGreaterEqual(time.time() - started, 3.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,423 @@
+# Tiled forest influence for whole operating areas
+# the raster engine (influenceraster) needs the CHM of a block in memory; over hundreds of km2
+# at 1 m that doesn't fit. Here the generalized CHM grid is cut into tiles, every tile is read
+# with a halo around it, its influence mask is built, and only the tile's own (core) pixels are
+# counted, against a label grid that holds the block number of every harvestable pixel.
+#
+# Exact stitching - a cell influences pixels up to its height away, so with a halo of at least
+# the tallest tree plus one height band (see halo_cells) every source that can reach a core pixel
+# is in the tile, and influence_mask gives the core pixels the same answer it gives on the whole
+# raster. Every output pixel is the core of exactly one tile, so summing the per tile counts per
+# label counts each pixel once - no seams, no double counting.
+#
+# Memory is one tile plus its halo (CHM, mask and labels), whatever the size of the area; tiles
+# without a harvestable pixel are skipped before their CHM is read.
+#
+# Labels come from polygons (PolygonLabels, pixel centres tested with shapely) or from a label
+# raster on the output grid (RasterLabels, e.g. made with build_label_raster). shapely is only
+# imported by the polygon classes.
+#
+# Sources - like the per block tool (secondtoolrefactored.process_chm_or_trees) only CHM cells in the
+# ring 4 m to 100 m outside the cutblocks are sources (SourceRing); cells inside any block, within
+# 4 m of one or beyond 100 m of every block are 0. The per block tool uses the ring of its own block
+# minus the adjacent cutblocks, so the two only differ where blocks are less than 4 m apart (a cell
+# 4 m from one block but closer to another is a source for the first block only there).
+
+import math
+import numpy as np
+import commonstuff as cs
+import chmreader
+import influenceraster as ir
+import stagetrace as st
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+
+# Function to work out the halo (in generalized cells) a tile needs for the tallest tree
+def halo_cells(max_height, cell_size, band_width=1.0):
+    return int(math.ceil((max_height + band_width) / float(cell_size))) + 1
+
+# distances (map units) of the source ring around the cutblocks, see process_chm_or_trees
+ring_inner = 4.0
+ring_outer = 100.0
+
+# Function to find the tallest value in a raster, one strip of tiles at a time
+# bounds - (xmin, ymin, xmax, ymax) to look in, the whole raster when left out (its statistics
+# are used when it has them)
+def raster_max(reader, bounds=None):
+    source = reader.source
+    if bounds is None:
+        if getattr(source, "maximum", None) is not None:
+            return float(source.maximum)
+        row0, row1, col0, col1 = 0, source.nrows, 0, source.ncols
+    else:
+        row0, row1, col0, col1 = reader.cell_range(*bounds)
+        row0, row1 = max(row0, 0), min(row1, source.nrows)
+        col0, col1 = max(col0, 0), min(col1, source.ncols)
+    tallest = 0.0
+    for row in range(row0, row1, reader.tile_size):
+        strip = reader.read_cells(row, min(row + reader.tile_size, row1), col0, col1)
+        if strip.size:
+            tallest = max(tallest, float(strip.max()))
+    return tallest
+
+# Function to find the tallest CHM source that can reach the labelled area
+# with a source ring only the cells in its bounds are sources (the rest are 0 in read_sources),
+# without one any cell can be a source
+def source_max(reader, sources):
+    return raster_max(reader, sources.bounds if sources is not None else None)
+
+# Function to compute forest influence per block across a whole CHM, one tile at a time
+# reader - chmreader.WindowedRasterReader over the CHM
+# labels - PolygonLabels or RasterLabels, its block ids are the keys of the result
+# tile_size - tile width in generalized cells, factor - CHM cells per generalized cell (5 takes a 1 m CHM
+#             to 5 m, with reducer, see chmreader.block_reduce), subdivide / band_width - see influenceraster
+#             (subdivide=5, 1 m pixels on a 5 m grid, keeps the area within 0.8% of the polygon answer)
+# max_height - tallest tree, read from the CHM under the source ring when left out
+# sources - SourceRing of the cutblocks, every CHM cell is a source when left out
+# returns a dict of block id -> {"harvestable": area, "influence": area} (map units squared)
+@st.traced(inputs=())
+def tiled_influence(reader, labels, tile_size=1024, factor=1, reducer="bilinear", subdivide=5, band_width=1.0, max_height=None,
+                    sources=None):
+    source = reader.source
+    cell_size = source.cell_width * factor
+    pixel_size = cell_size / float(subdivide)
+    if max_height is None:
+        max_height = source_max(reader, sources)
+    halo = halo_cells(max_height, cell_size, band_width)
+
+    # generalized grid lines up with the raster origin, tiles only cover the labelled area
+    grid_rows, grid_cols = -(-source.nrows // factor), -(-source.ncols // factor)
+    xmin, ymin, xmax, ymax = labels.bounds
+    row0 = max(int(math.floor((source.ymax - ymax) / cell_size)), 0)
+    row1 = min(int(math.ceil((source.ymax - ymin) / cell_size)), grid_rows)
+    col0 = max(int(math.floor((xmin - source.xmin) / cell_size)), 0)
+    col1 = min(int(math.ceil((xmax - source.xmin) / cell_size)), grid_cols)
+
+    tiles = [(r, c) for r in range(row0, row1, tile_size) for c in range(col0, col1, tile_size)]
+    harvestable = np.zeros(len(labels.block_ids) + 1)
+    influence = np.zeros(len(labels.block_ids) + 1)
+    skipped = 0
+    cs.writelog("Tiled influence: " + str(len(tiles)) + " tiles of " + str(tile_size) + " cells, halo " + str(halo) + " cells")
+    for n, (r, c) in enumerate(tiles):
+        rows, cols = min(tile_size, row1 - r), min(tile_size, col1 - c)
+        left, top = source.xmin + c * cell_size, source.ymax - r * cell_size
+        tile_labels = labels.read(left, top, rows * subdivide, cols * subdivide, pixel_size)
+        if not tile_labels.any():
+            skipped += 1
+            continue
+        chm = read_sources(reader, sources, r - halo, r + rows + halo, c - halo, c + cols + halo, factor, reducer)
+        tile_harvestable, tile_influence = count_tile(chm, tile_labels, halo, cell_size, subdivide, band_width, len(harvestable))
+        harvestable += tile_harvestable
+        influence += tile_influence
+        cs.counter(len(tiles), n + 1)
+    cs.writelog("Tiled influence: " + str(skipped) + " tiles had no harvestable area")
+    return block_totals(labels.block_ids, harvestable, influence, pixel_size)
+
+# Function to read a range of generalized cells, cells off the raster are 0
+def read_generalized(reader, row0, row1, col0, col1, factor=1, reducer="bilinear"):
+    fine = reader.read_cells(row0 * factor, row1 * factor, col0 * factor, col1 * factor)
+    return chmreader.block_reduce(fine, factor, reducer) if factor > 1 else fine
+
+# Function to read a range of generalized cells with only the source cells kept, the others are 0
+def read_sources(reader, sources, row0, row1, col0, col1, factor=1, reducer="bilinear"):
+    chm = read_generalized(reader, row0, row1, col0, col1, factor, reducer)
+    if sources is None:
+        return chm
+    source = reader.source
+    cell_size = source.cell_width * factor
+    keep = sources.read(source.xmin + col0 * cell_size, source.ymax - row0 * cell_size, row1 - row0, col1 - col0, cell_size)
+    return np.where(keep, chm, 0).astype(chm.dtype)
+
+# Function to count the harvestable and influenced pixels of one tile per label
+# chm - the tile plus halo cells on every side, tile_labels - labels of the tile's core pixels
+def count_tile(chm, tile_labels, halo, cell_size, subdivide, band_width, nlabels):
+    mask = ir.influence_mask(chm, cell_size, subdivide, band_width)
+    rows, cols = tile_labels.shape
+    core = mask[halo * subdivide:halo * subdivide + rows, halo * subdivide:halo * subdivide + cols]
+    return np.bincount(tile_labels.ravel(), minlength=nlabels), np.bincount(tile_labels[core], minlength=nlabels)
+
+def block_totals(block_ids, harvestable, influence, pixel_size):
+    pixel_area = pixel_size ** 2
+    return dict((block_id, {"harvestable": float(harvestable[i + 1] * pixel_area), "influence": float(influence[i + 1] * pixel_area)})
+                for i, block_id in enumerate(block_ids))
+
+
+# Parallel tiles - the exception, tiled_influence is the default
+# parallel_tiled_influence puts the generalized CHM of the labelled area (plus the halo) and the label
+# grid in multiprocessing.shared_memory once; the workers attach to them by name and slice their tiles
+# out without copying, and only the per tile counts come back through the pool. Unlike tiled_influence
+# the shared grids cover the whole labelled area: the CHM at the generalized cell size (4 bytes a cell,
+# e.g. 300 km2 at 5 m is 48 MB) and the labels at the output pixel size, so subdivide times subdivide
+# as many cells (1.2 GB for the same area at subdivide=5). Only the CHM under tiles with harvestable
+# area is read, the rest of the grid is left at 0 and never touched. Use it when there are cores to
+# spare and the labelled area at the output pixel size fits in memory comfortably.
+
+# shared arrays of a worker, set by attach_shared
+shared_state = {}
+
+# Function to make an array in a new shared memory block, returns (block, array)
+def shared_array(shape, dtype):
+    from multiprocessing import shared_memory
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+# Function run once in every worker - attaches the shared CHM and labels
+def attach_shared(chm_name, chm_shape, labels_name, labels_shape, halo, cell_size, subdivide, band_width, nlabels):
+    from multiprocessing import shared_memory
+    blocks = [shared_memory.SharedMemory(name=chm_name), shared_memory.SharedMemory(name=labels_name)]
+    shared_state.update(blocks=blocks, halo=halo, cell_size=cell_size, subdivide=subdivide, band_width=band_width, nlabels=nlabels,
+                        chm=np.ndarray(chm_shape, dtype=np.float32, buffer=blocks[0].buf),
+                        labels=np.ndarray(labels_shape, dtype=np.int32, buffer=blocks[1].buf))
+
+# Function run in a worker for one tile - r, c, rows, cols in cells of the labelled area
+def count_shared_tile(task):
+    r, c, rows, cols = task
+    state = shared_state
+    halo, subdivide = state["halo"], state["subdivide"]
+    chm = state["chm"][r:r + rows + 2 * halo, c:c + cols + 2 * halo]
+    tile_labels = state["labels"][r * subdivide:(r + rows) * subdivide, c * subdivide:(c + cols) * subdivide]
+    return count_tile(chm, tile_labels, halo, state["cell_size"], subdivide, state["band_width"], state["nlabels"])
+
+# Function to compute forest influence per block with the tiles spread over a process pool
+# same arguments and result as tiled_influence, plus processes (the number of cores by default);
+# tile_size is smaller by default so every worker gets several tiles
+@st.traced(inputs=())
+def parallel_tiled_influence(reader, labels, tile_size=256, factor=1, reducer="bilinear", subdivide=5, band_width=1.0,
+                             max_height=None, processes=None, sources=None):
+    import multiprocessing
+    source = reader.source
+    cell_size = source.cell_width * factor
+    pixel_size = cell_size / float(subdivide)
+    if max_height is None:
+        max_height = source_max(reader, sources)
+    halo = halo_cells(max_height, cell_size, band_width)
+    grid_rows, grid_cols = -(-source.nrows // factor), -(-source.ncols // factor)
+    xmin, ymin, xmax, ymax = labels.bounds
+    row0 = max(int(math.floor((source.ymax - ymax) / cell_size)), 0)
+    row1 = min(int(math.ceil((source.ymax - ymin) / cell_size)), grid_rows)
+    col0 = max(int(math.floor((xmin - source.xmin) / cell_size)), 0)
+    col1 = min(int(math.ceil((xmax - source.xmin) / cell_size)), grid_cols)
+    rows, cols = max(row1 - row0, 0), max(col1 - col0, 0)
+    nlabels = len(labels.block_ids) + 1
+
+    chm_block, chm = shared_array((rows + 2 * halo, cols + 2 * halo), np.float32)
+    labels_block, label_grid = shared_array((rows * subdivide, cols * subdivide), np.int32)
+    try:
+        tiles = []
+        for r in range(0, rows, tile_size):
+            for c in range(0, cols, tile_size):
+                tile_rows, tile_cols = min(tile_size, rows - r), min(tile_size, cols - c)
+                tile_labels = labels.read(source.xmin + (col0 + c) * cell_size, source.ymax - (row0 + r) * cell_size,
+                                          tile_rows * subdivide, tile_cols * subdivide, pixel_size)
+                label_grid[r * subdivide:(r + tile_rows) * subdivide, c * subdivide:(c + tile_cols) * subdivide] = tile_labels
+                if tile_labels.any():
+                    tiles.append((r, c, tile_rows, tile_cols))
+        # the CHM of the tiles with harvestable area plus their halos, one tile at a time
+        for r, c, tile_rows, tile_cols in tiles:
+            chm[r:r + tile_rows + 2 * halo, c:c + tile_cols + 2 * halo] = read_sources(
+                reader, sources, row0 + r - halo, row0 + r + tile_rows + halo, col0 + c - halo, col0 + c + tile_cols + halo, factor, reducer)
+        cs.writelog("Parallel tiled influence: " + str(len(tiles)) + " tiles with harvestable area, halo " + str(halo) + " cells")
+
+        harvestable, influence = np.zeros(nlabels), np.zeros(nlabels)
+        if tiles:
+            cs.set_worker_executable()
+            pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(tiles)), attach_shared,
+                                        (chm_block.name, chm.shape, labels_block.name, label_grid.shape, halo, cell_size,
+                                         subdivide, band_width, nlabels))
+            try:
+                for n, (tile_harvestable, tile_influence) in enumerate(pool.imap_unordered(count_shared_tile, tiles)):
+                    harvestable += tile_harvestable
+                    influence += tile_influence
+                    cs.counter(len(tiles), n + 1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        del chm, label_grid
+        for block in (chm_block, labels_block):
+            block.close()
+            block.unlink()
+    return block_totals(labels.block_ids, harvestable, influence, pixel_size)
+
+
+# block labels from polygons - label of a pixel is 1 + the index of the polygon its centre is in
+class PolygonLabels(object):
+
+    # geometries - shapely polygons (the net harvestable area of each block), block_ids - one per polygon
+    # polygons with the same block id count as one block
+    def __init__(self, geometries, block_ids):
+        import shapely
+        geometries = np.asarray(geometries, dtype=object)
+        block_ids = [str(b) for b in block_ids]
+        self.block_ids = list(dict.fromkeys(block_ids))
+        number = dict((block_id, i + 1) for i, block_id in enumerate(self.block_ids))
+        self.numbers = np.array([number[b] for b in block_ids], dtype=np.int32)
+        self.geometries = geometries
+        self.tree = shapely.STRtree(geometries)
+        self.bounds = tuple(shapely.total_bounds(geometries))
+
+    # Function to label the pixels of a tile, top left corner (left, top)
+    def read(self, left, top, nrows, ncols, pixel_size):
+        import shapely
+        out = np.zeros((nrows, ncols), dtype=np.int32)
+        box = shapely.box(left, top - nrows * pixel_size, left + ncols * pixel_size, top)
+        xs = left + (np.arange(ncols) + 0.5) * pixel_size
+        ys = top - (np.arange(nrows) + 0.5) * pixel_size
+        for i in self.tree.query(box, predicate="intersects"):
+            geometry = self.geometries[i]
+            gxmin, gymin, gxmax, gymax = geometry.bounds
+            cols = np.nonzero((xs >= gxmin) & (xs <= gxmax))[0]
+            rows = np.nonzero((ys >= gymin) & (ys <= gymax))[0]
+            if not len(cols) or not len(rows):
+                continue
+            shapely.prepare(geometry)
+            gx, gy = np.meshgrid(xs[cols], ys[rows])
+            inside = shapely.contains_xy(geometry, gx, gy)
+            window = out[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+            window[inside] = self.numbers[i]
+        return out
+
+    @classmethod
+    def from_dataset(cls, dataset, block_field):
+        import geometrybackend as gb
+        layer = gb.get_backend().read_geometries(dataset, [block_field])
+        return cls(layer.geometries, layer.attributes[block_field])
+
+
+# source cells of the CHM - the ring ring_inner to ring_outer outside the cutblocks, cells inside a
+# block are never sources (the adjacent cutblocks of the per block tool are erased the same way)
+class SourceRing(object):
+
+    def __init__(self, geometries, inner=ring_inner, outer=ring_outer):
+        import shapely
+        geometries = np.asarray(geometries, dtype=object)
+        numbers = np.arange(len(geometries))
+        self.outer = PolygonLabels(shapely.buffer(geometries, outer), numbers)
+        self.inner = PolygonLabels(shapely.buffer(geometries, inner), numbers)
+        self.bounds = self.outer.bounds
+
+    # Function to get the source cells of a range of cells, top left corner (left, top), True for a source
+    def read(self, left, top, nrows, ncols, cell_size):
+        return ((self.outer.read(left, top, nrows, ncols, cell_size) > 0) &
+                (self.inner.read(left, top, nrows, ncols, cell_size) == 0))
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        import geometrybackend as gb
+        return cls(gb.get_backend().read_geometries(dataset).geometries)
+
+
+# block labels from a raster on the output grid (pixel size, lined up with the generalized grid - see build_label_raster)
+# cell values are block numbers, 0 or nodata outside the blocks; block_ids maps value -> block id
+class RasterLabels(object):
+
+    def __init__(self, label_reader, block_ids):
+        self.reader = label_reader
+        source = label_reader.source
+        values = sorted(block_ids)
+        self.block_ids = [block_ids[v] for v in values]
+        # raster values -> 1..n, in a lookup table indexed by value
+        self.lookup = np.zeros(int(max(values)) + 1 if values else 1, dtype=np.int32)
+        for i, value in enumerate(values):
+            self.lookup[int(value)] = i + 1
+        self.bounds = (source.xmin, source.ymax - source.nrows * source.cell_height,
+                       source.xmin + source.ncols * source.cell_width, source.ymax)
+
+    # tile corners are on the label grid, so the corner is rounded to the nearest cell rather than
+    # floored - floating point error in (left - xmin) / cell size would otherwise move it a cell
+    def read(self, left, top, nrows, ncols, pixel_size):
+        source = self.reader.source
+        row0 = int(round((source.ymax - top) / source.cell_height))
+        col0 = int(round((left - source.xmin) / source.cell_width))
+        values = self.reader.read_cells(row0, row0 + nrows, col0, col0 + ncols).astype(np.int64)
+        values[(values < 0) | (values >= len(self.lookup))] = 0
+        return self.lookup[values]
+
+
+# Function to rasterize the net harvestable area onto the output grid of a CHM, once for a whole area
+# the output grid is the generalized grid (factor CHM cells, lined up with the CHM origin) cut into
+# subdivide x subdivide pixels; the raster extent is snapped outwards to generalized cells, so its
+# pixels line up with the tiles whatever the CHM cell size
+# returns the label raster and a dict of raster value -> block id
+def build_label_raster(net_harvestable_area, block_field, reader, out_raster, factor=1, subdivide=5):
+    source = reader.source
+    cell_size = source.cell_width * factor
+    extent = arcpy.Describe(net_harvestable_area).extent
+    col0 = int(math.floor((extent.XMin - source.xmin) / cell_size))
+    col1 = int(math.ceil((extent.XMax - source.xmin) / cell_size))
+    row0 = int(math.floor((source.ymax - extent.YMax) / cell_size))
+    row1 = int(math.ceil((source.ymax - extent.YMin) / cell_size))
+    old_snap, old_extent = arcpy.env.snapRaster, arcpy.env.extent
+    arcpy.env.snapRaster = None
+    arcpy.env.extent = arcpy.Extent(source.xmin + col0 * cell_size, source.ymax - row1 * cell_size,
+                                    source.xmin + col1 * cell_size, source.ymax - row0 * cell_size)
+    try:
+        arcpy.PolygonToRaster_conversion(net_harvestable_area, block_field, out_raster, "CELL_CENTER", "", cell_size / float(subdivide))
+    finally:
+        arcpy.env.snapRaster, arcpy.env.extent = old_snap, old_extent
+    # a text field gets a value per distinct string, the strings are in the attribute table
+    block_ids = {}
+    with arcpy.da.SearchCursor(out_raster, ["Value", block_field]) as cursor:
+        for value, block_id in cursor:
+            block_ids[int(value)] = block_id
+    return out_raster, block_ids
+
+
+# Function to turn the tiled totals into rows for the results store (same names as the batch results)
+def result_rows(totals):
+    rows = []
+    for block_id, areas in totals.items():
+        percent = areas["influence"] / areas["harvestable"] * 100 if areas["harvestable"] else 0.0
+        rows.append({"Block_ID": block_id, "Harvestable_Area": areas["harvestable"], "Forest_Influence_Area": areas["influence"],
+                     "Forest_Influence_Pct": percent})
+    return rows
+
+def main():
+    import os
+    import resultstore
+    chm = arcpy.GetParameterAsText(0)
+    net_harvestable_area = arcpy.GetParameterAsText(1)  # net harvestable area of every block in the operating area
+    block_field = arcpy.GetParameterAsText(2) or "SubSettingName"
+    workspace = arcpy.GetParameterAsText(3)
+    cell_size = float(arcpy.GetParameterAsText(4) or 5)  # Optional - generalized CHM cell size
+    tile_size = int(arcpy.GetParameterAsText(5) or 512)  # Optional - tile width in generalized cells
+    use_label_raster = arcpy.GetParameterAsText(6).lower() == "true"  # Optional - rasterize the blocks once with arcpy
+    processes = int(arcpy.GetParameterAsText(7) or 1)  # Optional - worker processes, more than 1 runs parallel_tiled_influence
+    cutblocks = arcpy.GetParameterAsText(8)  # Optional - gross cutblocks, the source ring is around these
+    subdivide = int(arcpy.GetParameterAsText(9) or 5)  # Optional - output pixels per generalized cell along each axis (odd)
+
+    reader = chmreader.WindowedRasterReader(chm)
+    factor = max(int(round(cell_size / reader.cell_size)), 1)
+    if use_label_raster:
+        label_raster, block_ids = build_label_raster(net_harvestable_area, block_field, reader,
+                                                     os.path.join(workspace, "block_labels.tif"), factor, subdivide)
+        labels = RasterLabels(chmreader.WindowedRasterReader(label_raster), block_ids)
+    else:
+        labels = PolygonLabels.from_dataset(net_harvestable_area, block_field)
+    if not cutblocks:
+        cs.writelog("No cutblocks given, the source ring is around the net harvestable area")
+    sources = SourceRing.from_dataset(cutblocks or net_harvestable_area)
+
+    st.start_run(workspace, "tiled_influence_trace")
+    try:
+        if processes > 1:
+            totals = parallel_tiled_influence(reader, labels, tile_size, factor, subdivide=subdivide, processes=processes, sources=sources)
+        else:
+            totals = tiled_influence(reader, labels, tile_size, factor, subdivide=subdivide, sources=sources)
+    finally:
+        st.finish_run()
+    results = resultstore.ResultStore(os.path.join(workspace, resultstore.store_name))
+    run_id = results.start_run("tiled_influence", {"chm": chm, "net_harvestable_area": net_harvestable_area, "cell_size": cell_size,
+                                                 "subdivide": subdivide})
+    results.upsert(result_rows(totals), run_id)
+    results.finish_run(run_id)
+    results.close()
+    cs.writelog("Tiled forest influence done for " + str(len(totals)) + " blocks")
+
+if __name__ == "__main__":
+    main()
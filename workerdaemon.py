@@ -0,0 +1,213 @@
+# Long running worker for the forest influence tool, plus the thin client that talks to it
+# the worker imports arcpy and the tools once, checks out the license once, and then keeps
+# serving block jobs over a local socket - the CHM tile cache and readers, the static area totals,
+# the schema cache and the stage cache fingerprints of the input datasets stay warm between jobs
+# (they are module level, see chmreader, secondtoolrefactored.static_layer_totals and
+# stagecache.dataset_fingerprints). A block then costs its compute time only, not an interpreter
+# start and a license checkout. The worker runs forest influence blocks only, not the Immediate OM
+# tool, so the landscape index isn't used here.
+#
+#   python workerdaemon.py serve                      start the worker (blocks until stopped)
+#   python workerdaemon.py run --cutblocks ... --workspace ... [--block B1 --block B2]
+#                                                     run blocks on the worker (starts it when needed)
+#   python workerdaemon.py ping / stop
+#
+# Jobs are the same dicts batchinfluencetool.run_block takes, results are its block reports.
+# The worker only listens on localhost and every connection has to know the authkey - a random key
+# made on the first start and kept in a file only the user can read (~/.mosaictools/worker.key, or
+# MOSAIC_WORKER_KEY_FILE), or the MOSAIC_WORKER_KEY environment variable. The worker won't start
+# without a key, or with a key file other users can read.
+# This module only imports the standard library at the top, so the client starts in a moment;
+# the heavy imports happen in serve().
+
+import os, sys, json, time, argparse, subprocess
+from multiprocessing.connection import Listener, Client
+
+default_port = 6150
+
+
+# Function to get the authkey of the worker and its clients, create makes the key file when there is none
+def authkey(create=False):
+    if os.environ.get("MOSAIC_WORKER_KEY"):
+        return os.environ["MOSAIC_WORKER_KEY"].encode("utf-8")
+    path = key_path()
+    if create and not os.path.exists(path):
+        write_key(path)
+    if not os.path.exists(path):
+        raise OSError("No worker key in " + path + ", start the worker first")
+    # on Windows the file is private through the ACL of the user profile
+    if os.name != "nt" and os.stat(path).st_mode & 0o077:
+        raise OSError("Worker key " + path + " can be read by other users, make it private (chmod 600)")
+    with open(path, "rb") as f:
+        key = f.read()
+    if len(key) < 16:
+        raise OSError("Worker key " + path + " is too short")
+    return key
+
+def key_path():
+    return os.environ.get("MOSAIC_WORKER_KEY_FILE") or os.path.join(os.path.expanduser("~"), ".mosaictools", "worker.key")
+
+# Function to write a new random key, readable by the owner only
+# written to a temporary file and linked into place, so a worker and a client starting together
+# can't end up with different keys or read a half written one
+def write_key(path):
+    import secrets, tempfile
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder, 0o700)
+    handle, temp_path = tempfile.mkstemp(dir=folder)  # mkstemp files are 0600
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(secrets.token_bytes(32))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:  # made by another process in the meantime
+            pass
+    finally:
+        os.remove(temp_path)
+
+# Function to run the worker - serves one connection at a time (arcpy is not thread safe),
+# a connection can send any number of requests
+def serve(port=default_port):
+    key = authkey(create=True)
+    import commonstuff as cs
+    import batchinfluencetool as batch
+    listener = Listener(("localhost", port), authkey=key)
+    started, served = time.time(), 0
+    cs.writelog("Worker " + str(os.getpid()) + " listening on localhost:" + str(port))
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:  # e.g. a client with the wrong authkey
+                cs.writelog("Worker refused a connection: " + str(e))
+                continue
+            try:
+                while True:
+                    try:
+                        request = conn.recv()
+                    except EOFError:
+                        break
+                    action = request.get("action")
+                    try:
+                        if action == "block":
+                            response = batch.run_block(request["job"])
+                            served += 1
+                        elif action == "list_blocks":
+                            response = batch.list_block_ids(request["cutblocks"], request.get("block_field", batch.block_field))
+                        elif action == "write_results":
+                            response = batch.write_results(request["reports"], request["workspace"])
+                        elif action == "ping":
+                            response = {"status": "ok", "pid": os.getpid(), "served": served, "uptime": time.time() - started}
+                        elif action == "shutdown":
+                            conn.send({"status": "stopping"})
+                            return
+                        else:
+                            response = {"status": "error", "message": "Unknown action " + str(action)}
+                    except Exception as e:
+                        cs.writelog("Worker request " + str(action) + " failed: " + str(e))
+                        response = {"status": "error", "message": str(e)}
+                    conn.send(response)
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+        cs.writelog("Worker stopped after " + str(served) + " blocks")
+
+# Function to connect to the worker, waiting up to timeout seconds for it to come up
+def connect(port=default_port, timeout=0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(("localhost", port), authkey=authkey())
+        except (ConnectionRefusedError, OSError):
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.25)
+
+def request(conn, message):
+    conn.send(message)
+    return conn.recv()
+
+# Function to start the worker in the background when it isn't running yet
+# uses python.exe next to the ArcGIS application when this runs inside ArcGIS
+def start_worker(port=default_port, timeout=120):
+    authkey(create=True)
+    try:
+        return connect(port)
+    except OSError:
+        pass
+    python_exe = os.path.join(sys.exec_prefix, "python.exe")
+    if os.path.basename(sys.executable).lower().startswith("python") or not os.path.exists(python_exe):
+        python_exe = sys.executable
+    flags = getattr(subprocess, "DETACHED_PROCESS", 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+    with open(os.devnull, "w") as devnull:
+        subprocess.Popen([python_exe, os.path.abspath(__file__), "serve", "--port", str(port)], cwd=os.getcwd(),
+                         stdout=devnull, stderr=devnull, creationflags=flags, close_fds=True)
+    return connect(port, timeout)
+
+# Function to run jobs on the worker, yields the block reports in order
+def run_jobs(jobs, port=default_port, start=True):
+    conn = start_worker(port) if start else connect(port)
+    try:
+        for job in jobs:
+            yield request(conn, {"action": "block", "job": job})
+    finally:
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm worker for the forest influence tool")
+    parser.add_argument("command", choices=["serve", "run", "ping", "stop"])
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--cutblocks")
+    parser.add_argument("--retention", default="")
+    parser.add_argument("--non-merch", default="")
+    parser.add_argument("--tree-layer", default="")
+    parser.add_argument("--chm", default="")
+    parser.add_argument("--adjacent-cutblocks", default="")
+    parser.add_argument("--workspace")
+    parser.add_argument("--single-trees", default="")
+    parser.add_argument("--engine", default="POLYGON", choices=["POLYGON", "RASTER"])
+    parser.add_argument("--block-field", default="SubSettingName")
+    parser.add_argument("--stage-cache", default="", help="folder for the stage cache")
+    parser.add_argument("--block", action="append", help="block id to run, every block when left out")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        try:
+            serve(args.port)
+        except OSError as e:
+            print("Worker not started: " + str(e))
+            return 1
+        return 0
+    if args.command in ("ping", "stop"):
+        try:
+            conn = connect(args.port)
+        except OSError:
+            print("No worker on port " + str(args.port))
+            return 1
+        print(json.dumps(request(conn, {"action": "ping" if args.command == "ping" else "shutdown"})))
+        conn.close()
+        return 0
+
+    if not args.cutblocks or not args.workspace:
+        parser.error("run needs --cutblocks and --workspace")
+    conn = start_worker(args.port)
+    reports = []
+    try:
+        block_ids = args.block or request(conn, {"action": "list_blocks", "cutblocks": args.cutblocks, "block_field": args.block_field})
+        for block_id in block_ids:
+            report = request(conn, {"action": "block", "job": {
+                "block_id": block_id, "block_field": args.block_field, "cutblocks": args.cutblocks,
+                "retention_areas": args.retention, "non_merch_areas": args.non_merch, "tree_layer": args.tree_layer,
+                "chm": args.chm, "adjacent_cutblocks": args.adjacent_cutblocks, "workspace": args.workspace,
+                "single_trees_path": args.single_trees, "influence_engine": args.engine, "stage_cache": args.stage_cache}})
+            reports.append(report)
+            print(json.dumps(dict((k, v) for k, v in report.items() if k != "Trace"), default=str))
+        request(conn, {"action": "write_results", "reports": reports, "workspace": args.workspace})
+    finally:
+        conn.close()
+    return 0 if all(r.get("Status") == "OK" for r in reports) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())